@@ -5,11 +5,27 @@ import json
 import uuid
 from sqlalchemy.orm import Session, sessionmaker, declarative_base
 from sqlalchemy import create_engine, Column, Integer, String, JSON, DateTime, inspect
-from utils.logger import Logger
-from utils.system_profiler import SystemProfiler
+from utils.logger import Logger, Payload
+from agent.integrity import IntegrityScanner
+from agent.log_shipper import LogShipper
+from agent.sampler import Sampler
+from agent.watchers import ProfileCache
+from utils.metrics import MetricsRegistry, MetricsServer, message_bytes
+from utils.profiling import Profiler
+from utils.ws_options import ChannelOptions
+from utils.tls import server_context
 
 Base = declarative_base()
 
+METRICS = MetricsRegistry()
+WEBSOCKET_BYTES = METRICS.counter('thintrust_websocket_bytes_total', 'Websocket message bytes, by direction.')
+ACTIVE_CONNECTIONS = METRICS.gauge('thintrust_active_connections', 'Open websocket connections.')
+SETTINGS_UPDATES = METRICS.counter('thintrust_settings_updates_total', 'Settings updated by the server.')
+ROUTE_SECONDS = METRICS.histogram('thintrust_route_seconds', 'Time taken to handle each type of message.')
+# Messages timed under their own label, anything else is timed as 'unknown'
+ROUTED_MESSAGES = ('OK', 'client_id?', 'system_info?', 'integrity?', 'integrity_key', 'integrity_scan', 'logs?', 'samples?',
+                   'profile', 'settings', 'update_setting', 'Connection closed')
+
 class settings(Base):
     __tablename__ = 'settings'
     id = Column(Integer, primary_key=True)
@@ -23,7 +39,9 @@ class settings(Base):
 
 class ThinAgent(Logger):
     def __init__(self):
-        super().__init__(self.__class__.__name__, 'thinagent.log', 'INFO')
+        # The agent runs on thin clients where the log directory is on tmpfs, keep at most 32 MiB of compressed logs
+        super().__init__(self.__class__.__name__, 'thinagent.log', 'INFO', max_bytes=4 * 1024 * 1024, async_logging=True,
+                         compression='gzip', budget_bytes=32 * 1024 * 1024)
         self.engine = create_engine('sqlite:///thinagent.db')
         Base.metadata.create_all(self.engine)
         self.Session = sessionmaker(bind=self.engine)
@@ -32,7 +50,21 @@ class ThinAgent(Logger):
         if 'agent_id' not in self.settings:
             agent_id = uuid.uuid4().hex
             self.new_setting('agent_id', agent_id)
-        self.websocket = None
+        self.integrity_scanner = None
+        # The public key the baseline is checked with, delivered by the server over wss and kept in memory only, a
+        # key stored next to the baseline could be replaced along with it
+        self.integrity_public_key = None
+        self.log_shipper = LogShipper(self.file_handler.baseFilename)
+        self.profiler = Profiler(self.logger, 'thinagent')
+        self.profile_cache = ProfileCache(self.logger)
+        agent_settings = self.settings
+        self.sampler = Sampler(self.logger, float(agent_settings.get('sample_interval', 10)),
+                               int(agent_settings.get('sample_capacity', 8640)), agent_settings.get('sample_disk', '/'))
+        try:
+            self.channel_options = ChannelOptions.from_settings(agent_settings)
+        except (TypeError, ValueError) as e:
+            self.logger.error(f'Invalid websocket settings, using the defaults: {e}')
+            self.channel_options = ChannelOptions()
         self.logger.debug(f'Agent ID: {self.settings["agent_id"]}')
         
     @property
@@ -47,24 +79,26 @@ class ThinAgent(Logger):
         # Query the database for the setting
         setting = self.session.query(settings).filter_by(key=key).first()
 
-        # If the setting exists, update its value
-        if setting is not None:
-            setting.value = new_value
+        # Settings the agent does not have yet, such as tls_cert, are created
+        if setting is None:
+            self.new_setting(key, new_value)
+            SETTINGS_UPDATES.inc()
+            self.logger.debug(f'Setting {key} created with {new_value}')
+            return True
 
-            # Commit the changes to the database
-            self.session.commit()
+        # Otherwise update its value
+        setting.value = new_value
+        SETTINGS_UPDATES.inc()
 
-            # Update the value in the dictionary as well
-            self.logger.debug(f'Setting {key} updated to {new_value}')
-            self.settings[key] = new_value
-            
-            # Return True to indicate success
-            self.logger.debug(f'Setting {key} updated to {new_value}')
-            return True
-        else:
-            # Log an error if the setting was not found and return False
-            self.logger.error(f'Setting {key} not found in the database.')
-            return False
+        # Commit the changes to the database
+        self.session.commit()
+
+        # Update the value in the dictionary as well
+        self.settings[key] = new_value
+
+        # Return True to indicate success
+        self.logger.debug(f'Setting {key} updated to {new_value}')
+        return True
         
     def new_setting(self, key, value):
         # Create a new setting object
@@ -80,70 +114,191 @@ class ThinAgent(Logger):
         self.settings[key] = value
         
     def get_system_info(self):
-        profiler = SystemProfiler(logger=self.logger)
-        system_info = profiler.system_profile
-        return system_info
+        # Only the first call collects the whole profile, the watchers keep the cached one up to date
+        return self.profile_cache.snapshot()
+
+    async def stream_events(self, websocket):
+        """
+        Push the changes of the system profile to the server until it disconnects.
+
+        The server gets the current profile first, then an event with the new value of each section that changes.
+        The connection is only used for the events from then on, the server polls over its other connections.
+
+        Args:
+            websocket (websockets.WebSocketServerProtocol): The connection of the subscribed server.
+
+        Returns:
+            bool: True, the connection is over once the server disconnects.
+        """
+        queue = self.profile_cache.subscribe()
+        closed = asyncio.ensure_future(websocket.wait_closed())
+        try:
+            await websocket.send(json.dumps({'message': 'Subscribed.', 'client_id': self.agent_id,
+                                             'profile': self.get_system_info()}))
+            self.logger.info('Server subscribed to events.')
+            while True:
+                event = asyncio.ensure_future(queue.get())
+                await asyncio.wait({event, closed}, return_when=asyncio.FIRST_COMPLETED)
+                if not event.done():
+                    event.cancel()
+                    break
+                data = json.dumps(event.result())
+                WEBSOCKET_BYTES.inc(message_bytes(data), direction='out')
+                await websocket.send(data)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.profile_cache.unsubscribe(queue)
+            closed.cancel()
+            self.logger.info('Server unsubscribed from events.')
+        return True
       
-    async def route(self, data):
-        self.logger.debug(f'Routing: {data}')
+    def get_integrity_scanner(self):
+        # The scanner is only available once the server has delivered the public key the baseline is checked with
+        if self.integrity_public_key is None:
+            return None
+        if self.integrity_scanner is None or self.integrity_scanner.public_key != self.integrity_public_key:
+            self.integrity_scanner = IntegrityScanner(
+                self.logger, self.settings.get('integrity_baseline', '/etc/thintrust/integrity_baseline.json'),
+                self.integrity_public_key)
+        return self.integrity_scanner
+
+    async def run_integrity_scan(self):
+        scanner = self.get_integrity_scanner()
+        if scanner is None:
+            self.logger.debug('No integrity key set, skipping integrity scan.')
+            return None
+        # The scan runs in its own low priority threads, off the event loop
+        return await self.loop.run_in_executor(None, scanner.scan)
+
+    async def integrity_loop(self):
+        while True:
+            await self.run_integrity_scan()
+            await asyncio.sleep(float(self.settings.get('integrity_interval', 6 * 60 * 60)))
+
+    async def route(self, websocket, data):
+        """
+        Handle a message of the server and reply on the connection it came from.
+
+        Args:
+            websocket (websockets.WebSocketServerProtocol): The connection the message came from.
+            data (dict): The message.
+
+        Returns:
+            bool: True if the connection is over.
+        """
+        message = data.get('message') if isinstance(data, dict) else None
+        if message == 'subscribe_events':
+            # Not timed, the subscription lasts as long as the connection
+            return await self.stream_events(websocket)
+        with ROUTE_SECONDS.time(message=message if message in ROUTED_MESSAGES else 'unknown'):
+            return await self._route(websocket, data)
+
+    async def _route(self, websocket, data):
+        self.logger.debug('Routing: %s', Payload(data), extra={'step': 'route'})
         if 'message' in data and data['message'] == 'OK':
-            await self.send({'message': 'OK'})
+            await self.send(websocket, {'message': 'OK'})
         if 'message' in data and data['message'] == 'client_id?':
-            await self.send({'client_id': self.agent_id})
+            await self.send(websocket, {'client_id': self.agent_id})
         elif 'message' in data and data['message'] == 'system_info?':
             try:
                 system_info = self.get_system_info()
-                await self.send(system_info)
+                await self.send(websocket, system_info)
             except Exception as e:
                 self.logger.error(f'Error getting system info: {e}')
+        elif 'message' in data and data['message'] == 'integrity?':
+            scanner = self.get_integrity_scanner()
+            report = scanner.last_report if scanner else None
+            await self.send(websocket, report or {'status': 'unavailable' if scanner is None else 'pending'})
+        elif 'message' in data and data['message'] == 'integrity_key':
+            if isinstance(data.get('key'), str) and '-----BEGIN PUBLIC KEY-----' in data['key']:
+                self.integrity_public_key = data['key']
+                asyncio.ensure_future(self.run_integrity_scan())
+                await self.send(websocket, {'message': 'Integrity key set.'})
+            else:
+                await self.send(websocket, {'message': 'Invalid request.'})
+        elif 'message' in data and data['message'] == 'integrity_scan':
+            asyncio.ensure_future(self.run_integrity_scan())
+            await self.send(websocket, {'message': 'Integrity scan started.'})
+        elif 'message' in data and data['message'] == 'logs?':
+            try:
+                batch = await self.loop.run_in_executor(None, self.log_shipper.read_batch, data.get('segment'),
+                                                        data.get('offset', 0))
+                await self.send(websocket, batch)
+            except Exception as e:
+                self.logger.error(f'Error reading logs: {e}')
+                await self.send(websocket, {'message': 'Error reading logs.'})
+        elif 'message' in data and data['message'] == 'samples?':
+            # Samples from an earlier run of the agent are gone, start from the beginning of the new ring
+            since = data.get('since', 0) if data.get('ring') == self.sampler.ring.id else 0
+            await self.send(websocket, self.sampler.ring.since(since))
+        elif 'message' in data and data['message'] == 'profile':
+            if data.get('action') == 'stop':
+                output = self.profiler.stop()
+                await self.send(websocket, {'message': 'Profile written.' if output else 'Not profiling.', 'output': output})
+            else:
+                try:
+                    output = self.profiler.start(data.get('duration', 30), data.get('mode', 'sample'))
+                    await self.send(websocket, {'message': 'Profiling started.' if output else 'Already profiling.',
+                                     'output': output})
+                except ValueError as e:
+                    await self.send(websocket, {'message': str(e)})
         elif 'message' in data and data['message'] == 'settings':
-            await self.send(self.settings)
+            await self.send(websocket, self.settings)
         elif 'message' in data and data['message'] == 'update_setting':
             if 'key' in data and 'value' in data:
                 self.update_setting(data['key'], data['value'])
-                await self.send({'message': 'Setting updated.'})
+                await self.send(websocket, {'message': 'Setting updated.'})
             else:
-                await self.send({'message': 'Invalid request.'})
+                await self.send(websocket, {'message': 'Invalid request.'})
         elif 'message' in data and data['message'] == 'Connection closed':
-            await self.websocket.close()
-            self.websocket = None
+            await websocket.close()
             return True
             
     async def websocket_handler(self, websocket):
-        self.websocket = websocket
+        # Each connection is handled on its own, the server may keep a subscription open while it polls
+        ACTIVE_CONNECTIONS.inc()
+        try:
+            await self._handle_messages(websocket)
+        finally:
+            ACTIVE_CONNECTIONS.dec()
+
+    async def _handle_messages(self, websocket):
         while True:
             try:
-                response = await asyncio.wait_for(self.receive(), 5)
+                response = await asyncio.wait_for(self.receive(websocket), self.channel_options.idle_timeout)
                 try:
                     response = json.loads(response)
                 except json.JSONDecodeError as e:
                     self.logger.error(f'Error decoding response: {e}')
-                self.logger.debug(f'Received: {response}')
-                stop = await self.route(response)
+                self.logger.debug('Received: %s', Payload(response), extra={'step': 'receive'})
+                stop = await self.route(websocket, response)
                 if stop:
                     break
+            except asyncio.TimeoutError:
+                # The server is done with the connection without closing it, such as a kept-alive one it dropped
+                self.logger.debug(f'Closing the connection, idle for {self.channel_options.idle_timeout}s.')
+                break
             except websockets.exceptions.ConnectionClosedError as e:
                 self.logger.error(f'Connection closed: {e}')
-                self.websocket = None
                 break
             except websockets.exceptions.ConnectionClosedOK as e:
                 self.logger.error(f'Connection closed: {e}')
-                self.websocket = None
                 break
             except Exception as e:
                 self.logger.error(f'Error handling websocket: {e}')
-                self.websocket = None
                 break
             
                 
-    async def send(self, data):
+    async def send(self, websocket, data):
         if type(data) == dict:
             try:
                 data = json.dumps(data)
             except Exception as e:
                 self.logger.error(f'Error converting data to json: {e}')
             try:
-                await self.websocket.send(data)
+                WEBSOCKET_BYTES.inc(message_bytes(data), direction='out')
+                await websocket.send(data)
             except websockets.exceptions.ConnectionClosedError as e:
                 self.logger.error(f'Connection closed abnormally: {e}')
             except websockets.exceptions.ConnectionClosedOK as e:
@@ -154,9 +309,11 @@ class ThinAgent(Logger):
             self.logger.error('Data must be a dictionary.')
         
     
-    async def receive(self):
+    async def receive(self, websocket):
         try:
-            return await self.websocket.recv()
+            data = await websocket.recv()
+            WEBSOCKET_BYTES.inc(message_bytes(data), direction='in')
+            return data
         except websockets.exceptions.ConnectionClosedError as e:
             return json.dumps({'message': 'Connection closed'})
         except websockets.exceptions.ConnectionClosedOK as e:
@@ -165,8 +322,33 @@ class ThinAgent(Logger):
             return json.dumps({'message': f"Error receiving data. {e}"})
     
     async def main(self):
-        async with websockets.serve(self.websocket_handler, 'localhost', 8765):
+        settings = self.settings
+        ssl_context = None
+        if settings.get('tls_cert'):
+            # wss, with the client certificates verified too when the CA is set. An agent configured for TLS never
+            # falls back to plain ws, which would send the profile, the logs and the integrity key in the clear.
+            try:
+                ssl_context = server_context(settings['tls_cert'], settings['tls_key'], settings.get('tls_ca'))
+            except (OSError, KeyError) as e:
+                self.logger.critical(f'Error loading the TLS certificate, not starting the agent: {e}')
+                return False
+        integrity = asyncio.ensure_future(self.integrity_loop())
+        sampler = asyncio.ensure_future(self.sampler.run())
+        self.profile_cache.start_watchers()
+        self.profiler.install_signal_handler()
+        metrics_port = int(self.settings.get('metrics_port', 9101))
+        if metrics_port:
+            try:
+                await MetricsServer(metrics_port).start()
+            except OSError as e:
+                self.logger.error(f'Error starting metrics server on port {metrics_port}: {e}')
+        async with websockets.serve(self.websocket_handler, 'localhost', 8765, ssl=ssl_context,
+                                    **self.channel_options.server_kwargs()):
             await asyncio.Future()
+        integrity.cancel()
+        sampler.cancel()
+        self.profile_cache.stop_watchers()
+        return True
      
     @property
     def loop(self):
@@ -176,7 +358,8 @@ class ThinAgent(Logger):
 if __name__ == '__main__':
     agent = ThinAgent()
     try:
-        agent.loop.run_until_complete(agent.main())
+        if not agent.loop.run_until_complete(agent.main()):
+            exit(1)
     except KeyboardInterrupt:
         agent.logger.info('Exiting...')
         agent.loop.stop()
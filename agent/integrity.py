@@ -0,0 +1,361 @@
+import base64
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from utils.hash_cache import HashCache
+from utils.hashtools import HashTools
+
+# overlayroot mounts the read-only lower filesystem here when the root is an overlay
+LOWER_ROOT = '/media/root-ro'
+DEFAULT_EXCLUDES = ['proc', 'sys', 'dev', 'run', 'tmp', 'var/tmp', 'var/cache', 'var/log', 'media', 'mnt', 'lost+found']
+
+
+def _canonical(manifest):
+    return json.dumps(manifest, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def _openssl(*args, data=None):
+    result = subprocess.run(['openssl', *args], input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"openssl {args[0]} failed: {result.stderr.decode('utf-8', errors='replace').strip()}")
+    return result.stdout
+
+
+def generate_signing_key(private_key, public_key):
+    """
+    Generate the ECDSA P-256 key pair baselines are signed with.
+
+    The private key stays on the machine building the baselines. The agents only get the public key, so an endpoint
+    can check a baseline but cannot sign one.
+
+    Args:
+        private_key (str): The path to write the PEM private key to.
+        public_key (str): The path to write the PEM public key to.
+    """
+    _openssl('genpkey', '-algorithm', 'EC', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-out', private_key)
+    os.chmod(private_key, 0o600)
+    _openssl('pkey', '-in', private_key, '-pubout', '-out', public_key)
+
+
+def sign_manifest(manifest, private_key):
+    """
+    Sign a manifest with ECDSA P-256 and SHA-256.
+
+    Args:
+        manifest (dict): The manifest to sign.
+        private_key (str): The path of the PEM private key.
+
+    Returns:
+        str: The base64 signature of the canonical JSON of the manifest.
+    """
+    return base64.b64encode(_openssl('dgst', '-sha256', '-sign', private_key, data=_canonical(manifest))).decode('ascii')
+
+
+def verify_manifest(manifest, signature, public_key):
+    """
+    Check the signature of a manifest.
+
+    Args:
+        manifest (dict): The manifest.
+        signature (str): The base64 signature of the manifest.
+        public_key (str): The PEM public key of the key pair the manifest was signed with.
+
+    Returns:
+        bool: True if the signature is valid.
+    """
+    with tempfile.TemporaryDirectory(prefix='thintrust-integrity-') as workdir:
+        key_path = os.path.join(workdir, 'public.pem')
+        signature_path = os.path.join(workdir, 'signature')
+        with open(key_path, 'w') as f:
+            f.write(public_key)
+        with open(signature_path, 'wb') as f:
+            f.write(base64.b64decode(signature or ''))
+        try:
+            _openssl('dgst', '-sha256', '-verify', key_path, '-signature', signature_path, data=_canonical(manifest))
+        except RuntimeError:
+            return False
+    return True
+
+
+class _Throttle:
+    """
+    Keep the scan within an I/O and CPU budget.
+
+    The I/O budget is a token bucket of bytes per second shared by every scan thread. The CPU budget is a duty cycle:
+    after each file, a thread sleeps long enough for its CPU time to stay below cpu_fraction of the wall time.
+    """
+
+    def __init__(self, bytes_per_second, cpu_fraction):
+        self.bytes_per_second = bytes_per_second
+        self.cpu_fraction = cpu_fraction
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def consume(self, size):
+        if not self.bytes_per_second:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now) + size / self.bytes_per_second
+            delay = self._next - now - 1  # Allow a one second burst
+        if delay > 0:
+            time.sleep(delay)
+
+    def pace(self, cpu_seconds):
+        if self.cpu_fraction and self.cpu_fraction < 1:
+            time.sleep(cpu_seconds * (1 / self.cpu_fraction - 1))
+
+
+class IntegrityScanner:
+    """
+    Verify the read-only lower root filesystem of an overlayroot thin client against a signed baseline.
+
+    The baseline is a manifest of every file of a known-good image (size, mtime and sha256), signed with an ECDSA key
+    whose private half never leaves the machine building the baselines, so a corrupted or tampered baseline is
+    rejected and an endpoint cannot sign one. A scan walks the baseline in a small thread pool with the lowest CPU and
+    I/O priority, within a byte rate and CPU duty cycle budget so it does not slow down the desktop session. Files
+    whose device, inode, size, mtime and ctime did not change since the previous scan are not read again thanks to a
+    persistent HashCache, so only the first scan after boot of a new image reads the whole filesystem.
+
+    Attributes:
+        logger (logging.Logger): The logger used to report progress.
+        root (str): The root of the filesystem to scan, the overlayroot lower root by default.
+        baseline_path (str): The path of the signed baseline.
+        public_key (str): The PEM public key the baseline signature is checked with.
+        excludes (list): Directories, relative to the root, that are not scanned.
+        max_workers (int): The number of scan threads.
+        last_report (dict): The report of the last scan, or None.
+
+    Args:
+        logger (logging.Logger): The logger used to report progress.
+        baseline_path (str): The path of the signed baseline.
+        public_key (str): The PEM public key the baseline signature is checked with. Only needed to scan.
+        root (str): The root of the filesystem to scan. Defaults to the overlayroot lower root, or / without overlayroot.
+        cache_path (str): The path of the hash cache database.
+        bytes_per_second (int): The maximum read rate. The default value is 20 MiB/s, None or 0 disables the limit.
+        cpu_fraction (float): The maximum fraction of a CPU used by each scan thread. The default value is 0.25.
+        max_workers (int): The number of scan threads. The default value is 2.
+        excludes (list): Directories, relative to the root, that are not scanned.
+
+    Methods:
+        build_baseline(output, private_key): Builds and signs a baseline of the root filesystem.
+        load_baseline() -> dict: Loads the baseline and checks its signature.
+        scan(fail_fast) -> dict: Scans the root filesystem against the baseline.
+    """
+
+    def __init__(self, logger, baseline_path, public_key=None, root=None, cache_path='integrity_cache.db',
+                 bytes_per_second=20 * 1024 * 1024, cpu_fraction=0.25, max_workers=2, excludes=None):
+        self.logger = logger
+        self.root = root or (LOWER_ROOT if os.path.ismount(LOWER_ROOT) else '/')
+        self.baseline_path = baseline_path
+        self.public_key = public_key
+        self.cache_path = cache_path
+        self.excludes = DEFAULT_EXCLUDES if excludes is None else excludes
+        self.max_workers = max_workers
+        self.throttle = _Throttle(bytes_per_second, cpu_fraction)
+        self.last_report = None
+        self._scan_lock = threading.Lock()
+
+    def _walk(self):
+        """
+        Walk the regular files of the root, skipping excluded directories and other filesystems.
+
+        Yields:
+            str: The path of each file relative to the root.
+        """
+        root_dev = os.stat(self.root).st_dev
+        excludes = {os.path.join(self.root, exclude) for exclude in self.excludes}
+        for directory, dirs, files in os.walk(self.root):
+            dirs[:] = sorted(d for d in dirs if os.path.join(directory, d) not in excludes
+                             and not os.path.islink(os.path.join(directory, d))
+                             and os.lstat(os.path.join(directory, d)).st_dev == root_dev)
+            for name in sorted(files):
+                path = os.path.join(directory, name)
+                if os.path.isfile(path) and not os.path.islink(path):
+                    yield os.path.relpath(path, self.root)
+
+    @staticmethod
+    def _lower_priority():
+        """
+        Give the current scan thread the lowest CPU and I/O priority.
+
+        On Linux both the nice value and the I/O class apply to single threads, so the agent's event loop keeps its
+        normal priority while the scan threads only use otherwise idle CPU and disk time.
+        """
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+            subprocess.call(['ionice', '-c', '3', '-p', str(threading.get_native_id())],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except Exception:
+            pass
+
+    def _hash(self, hashtools, cache, relpath, check_size=None):
+        """
+        Hash a file within the budget, skipping it when the cache has its hash.
+
+        Args:
+            hashtools (HashTools): The HashTools instance to hash with.
+            cache (HashCache): The hash cache.
+            relpath (str): The path of the file relative to the root.
+            check_size (int): When given, a file of another size is not hashed.
+
+        Returns:
+            tuple: The stat of the file, its sha256 (None when skipped) and whether it came from the cache.
+        """
+        path = os.path.join(self.root, relpath)
+        stat = os.stat(path)
+        if check_size is not None and stat.st_size != check_size:
+            return stat, None, False
+        digest = cache.get(stat, 'sha256')
+        if digest is not None:
+            return stat, digest, True
+        self.throttle.consume(stat.st_size)
+        cpu = time.thread_time()
+        digest = hashtools.hash_file_multi(path, ['sha256'], force=True)['sha256']
+        self.throttle.pace(time.thread_time() - cpu)
+        return stat, digest, False
+
+    def build_baseline(self, output, private_key):
+        """
+        Build and sign a baseline of the root filesystem.
+
+        Run on a freshly provisioned, known-good image. The baseline is written to output and can then be shipped
+        to every endpoint running the same image.
+
+        Args:
+            output (str): The path to write the signed baseline to.
+            private_key (str): The path of the PEM private key to sign the baseline with.
+
+        Returns:
+            dict: The signed baseline.
+        """
+        self.logger.info(f'Building integrity baseline of {self.root}...')
+        cache = HashCache(self.cache_path)
+        hashtools = HashTools('sha256', cache=cache)
+        files = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers, initializer=self._lower_priority) as executor:
+                relpaths = list(self._walk())
+                for relpath, (stat, digest, _) in zip(relpaths, executor.map(
+                        lambda relpath: self._hash(hashtools, cache, relpath), relpaths)):
+                    files[relpath] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'digests': {'sha256': digest}}
+        finally:
+            cache.close()
+        manifest = {'version': 1, 'algorithms': ['sha256'], 'created': datetime.now().timestamp(), 'files': files}
+        baseline = {'manifest': manifest, 'signature': sign_manifest(manifest, private_key)}
+        with open(f'{output}.partial', 'w') as f:
+            json.dump(baseline, f)
+        os.replace(f'{output}.partial', output)
+        self.logger.info(f'Integrity baseline of {len(files)} files written to {output}')
+        return baseline
+
+    def load_baseline(self):
+        """
+        Load the baseline and check its signature.
+
+        Returns:
+            dict: The baseline manifest.
+
+        Raises:
+            ValueError: If the baseline signature does not match.
+        """
+        with open(self.baseline_path, 'r') as f:
+            baseline = json.load(f)
+        if not self.public_key or not verify_manifest(baseline['manifest'], baseline.get('signature'), self.public_key):
+            raise ValueError('Integrity baseline signature mismatch')
+        return baseline['manifest']
+
+    def scan(self, fail_fast=False):
+        """
+        Scan the root filesystem against the baseline.
+
+        Args:
+            fail_fast (bool): Stop at the first drifted file. The default value is False.
+
+        Returns:
+            dict: The report, with the status ('clean', 'drift', 'error' or 'busy'), counters, and the list of drifted
+            files, each with its path and reason ('missing', 'size', 'sha256' or 'unexpected').
+        """
+        if not self._scan_lock.acquire(blocking=False):
+            return {'status': 'busy'}
+        start = time.monotonic()
+        report = {'status': 'error', 'root': self.root, 'started': datetime.now().timestamp(), 'files': 0,
+                  'hashed': 0, 'cached': 0, 'bytes_hashed': 0, 'drift': []}
+        cache = None
+        try:
+            manifest = self.load_baseline()
+            cache = HashCache(self.cache_path)
+            hashtools = HashTools('sha256', cache=cache)
+            stop = threading.Event()
+            counters = threading.Lock()
+
+            def check(relpath, expected):
+                if stop.is_set():
+                    return None
+                try:
+                    stat, digest, cached = self._hash(hashtools, cache, relpath, expected['size'])
+                except FileNotFoundError:
+                    return {'path': relpath, 'reason': 'missing'}
+                if digest is None:
+                    return {'path': relpath, 'reason': 'size'}
+                with counters:
+                    report['cached' if cached else 'hashed'] += 1
+                    report['bytes_hashed'] += 0 if cached else stat.st_size
+                if digest != expected['digests']['sha256']:
+                    return {'path': relpath, 'reason': 'sha256'}
+                return None
+
+            with ThreadPoolExecutor(max_workers=self.max_workers, initializer=self._lower_priority) as executor:
+                for mismatch in executor.map(lambda item: check(*item), manifest['files'].items()):
+                    report['files'] += 1
+                    if mismatch:
+                        report['drift'].append(mismatch)
+                        if fail_fast:
+                            stop.set()
+            if not (fail_fast and report['drift']):
+                report['drift'] += [{'path': relpath, 'reason': 'unexpected'} for relpath in self._walk()
+                                    if relpath not in manifest['files']]
+            report['status'] = 'drift' if report['drift'] else 'clean'
+        except Exception as e:
+            self.logger.error(f'Error scanning filesystem integrity: {e}')
+            report['error'] = str(e)
+        finally:
+            if cache:
+                cache.close()
+            report['duration'] = round(time.monotonic() - start, 2)
+            self.last_report = report
+            self._scan_lock.release()
+        if report['drift']:
+            self.logger.warning(f"Integrity drift detected in {len(report['drift'])} files under {self.root}")
+        self.logger.info(f"Integrity scan {report['status']}: {report['files']} files, {report['hashed']} hashed, "
+                         f"{report['cached']} cached in {report['duration']}s")
+        return report
+
+
+if __name__ == '__main__':
+    import sys
+    import logging
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 4 or sys.argv[1] not in ('keygen', 'build', 'scan'):
+        print('Usage: python -m agent.integrity keygen <private key> <public key>\n'
+              '       python -m agent.integrity build <baseline> <private key> [root]\n'
+              '       python -m agent.integrity scan <baseline> <public key> [root]')
+        exit(1)
+    if sys.argv[1] == 'keygen':
+        generate_signing_key(sys.argv[2], sys.argv[3])
+        exit(0)
+    root = sys.argv[4] if len(sys.argv) > 4 else None
+    if sys.argv[1] == 'build':
+        IntegrityScanner(logging.getLogger('IntegrityScanner'), sys.argv[2], root=root).build_baseline(sys.argv[2],
+                                                                                                      sys.argv[3])
+    else:
+        with open(sys.argv[3], 'r') as f:
+            public_key = f.read()
+        scanner = IntegrityScanner(logging.getLogger('IntegrityScanner'), sys.argv[2], public_key, root=root)
+        print(json.dumps(scanner.scan(), indent=4))
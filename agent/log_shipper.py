@@ -0,0 +1,182 @@
+import base64
+import gzip
+import io
+import os
+import shutil
+import subprocess
+import zlib
+
+from utils.logger import COMPRESSION_EXTENSIONS, HandlerRegistry
+
+# The largest batch of log lines sent in one message, before compression
+MAX_BATCH_BYTES = 256 * 1024
+
+
+class LogShipper:
+    """
+    Read the agent log in compressed batches for the TEC server, resuming at a byte offset.
+
+    The server keeps the position it has read up to, the segment (the log file, identified by its inode and a CRC of
+    its first line, as inodes are reused) and a byte offset in it, and asks for the next batch from that position, so
+    no line is sent twice and none is lost across disconnects or agent restarts. A batch ends on a line boundary and is
+    at most max_batch_bytes long before it is compressed with zlib.
+
+    When the log file was rotated since the last batch, the segment no longer matches the current file. It is then
+    looked up among every rotated segment, compressed with gzip or zstd or not, and finished first, and the newer
+    rotated segments are read in turn before the current file. Compressing a segment writes a new file, so a compressed
+    segment is matched by the CRC of its first line only. A log file without a complete first line yet, such as one
+    just rotated, has no segment: its batches have no segment and no data, and it is read from its start once it has
+    one. Segments removed in the meantime, such as by the log budget,
+    or that cannot be read, are skipped and counted in the lost field of the batch. The log budget of the
+    HandlerRegistry keeps the newest rotated segment until the server has moved on to the current log file.
+
+    Attributes:
+        path (str): The path of the log file.
+        max_batch_bytes (int): The maximum size of a batch before compression.
+
+    Args:
+        path (str): The path of the log file.
+        max_batch_bytes (int): The maximum size of a batch before compression. The default value is 256 KiB.
+
+    Methods:
+        read_batch(segment: str, offset: int) -> dict: Reads the next batch of log lines after a position.
+        shipped() -> bool: Checks if every rotated segment was shipped.
+    """
+
+    def __init__(self, path, max_batch_bytes=MAX_BATCH_BYTES):
+        self.path = path
+        self.max_batch_bytes = max_batch_bytes
+        self._live_segment = None  # The current log file, once the server asked for a position in it
+        HandlerRegistry().set_shipper(path, self.shipped)
+
+    def shipped(self):
+        # Every rotated segment was shipped if the server was last in the file that is still the current one
+        try:
+            with open(self.path, 'rb') as f:
+                current = self._segment(f, os.fstat(f.fileno()))
+                return current is not None and current == self._live_segment
+        except OSError:
+            return False
+
+    def _rotated_segments(self):
+        # The rotated segments, the newest first
+        return [path for _, path, _ in HandlerRegistry.rotated_segments(self.path)]
+
+    @staticmethod
+    def _open(path):
+        """
+        Open a rotated segment, compressed or not.
+
+        Args:
+            path (str): The path of the segment.
+
+        Returns:
+            file: The uncompressed segment opened for binary reading, or None if it was removed or cannot be read.
+        """
+        try:
+            if path.endswith(COMPRESSION_EXTENSIONS['gzip']):
+                return gzip.open(path, 'rb')
+            if path.endswith(COMPRESSION_EXTENSIONS['zstd']):
+                if not shutil.which('zstd'):
+                    return None
+                result = subprocess.run(['zstd', '-d', '-c', '-q', path], stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+                return io.BytesIO(result.stdout) if result.returncode == 0 else None
+            return open(path, 'rb')
+        except OSError:
+            return None
+
+    def _matches(self, segment, path, f):
+        signature = self._segment(f, os.stat(path))
+        if signature is None:
+            return False
+        if path.endswith(tuple(COMPRESSION_EXTENSIONS.values())):
+            return signature.split(':')[1] == segment.split(':')[-1]
+        return signature == segment
+
+    def _read(self, f, offset, size):
+        f.seek(offset)
+        data = f.read(size)
+        if len(data) == size:
+            # Only send whole lines, the rest is sent with the next batch
+            end = data.rfind(b'\n') + 1
+            data = data[:end] if end else data
+        return data
+
+    @staticmethod
+    def _segment(f, stat):
+        f.seek(0)
+        first_line = f.readline(256)
+        if len(first_line) < 256 and not first_line.endswith(b'\n'):
+            # Empty, or its first line is still being written, the CRC would change with the next write
+            return None
+        return f'{stat.st_ino}:{zlib.crc32(first_line):08x}'
+
+    def read_batch(self, segment=None, offset=0):
+        """
+        Read the next batch of log lines after a position.
+
+        Args:
+            segment (str): The segment of the last position, or None to start from the beginning.
+            offset (int): The byte offset of the last position.
+
+        Returns:
+            dict: The batch, with the new position (segment and offset, None and 0 while the log file has no complete
+            first line), the lines compressed with zlib and encoded in base64 (data), whether more lines are waiting
+            (more) and the number of segments skipped because they were removed or could not be read since the last
+            position (lost).
+        """
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            current = self._segment(f, stat)
+            if segment is None and current is None:
+                return self._batch(None, 0, b'', False)
+            if segment is None or segment == current:
+                self._live_segment = current  # The server is done with the rotated segments
+                if segment is None or offset > stat.st_size:
+                    offset = 0  # From the beginning, or the file was truncated
+                data = self._read(f, offset, self.max_batch_bytes)
+                return self._batch(current, offset + len(data), data, offset + len(data) < stat.st_size)
+            # The log file was rotated since the last batch, finish the segment of the position first
+            rotated = self._rotated_segments()
+            lost = 0
+            newer = None
+            for index, path in enumerate(rotated):
+                previous = self._open(path)
+                if previous is None:
+                    continue
+                with previous:
+                    if self._matches(segment, path, previous):
+                        data = self._read(previous, offset, self.max_batch_bytes)
+                        if data:
+                            return self._batch(segment, offset + len(data), data, True)
+                        newer = rotated[:index]
+                        break
+            if newer is None:
+                # The segment is gone, resume with the oldest segment left
+                lost = 1
+                newer = rotated
+            # Then the newer rotated segments, oldest first, from their start
+            for path in reversed(newer):
+                following = self._open(path)
+                if following is None:
+                    lost += 1
+                    continue
+                with following:
+                    data = self._read(following, 0, self.max_batch_bytes)
+                    if data:
+                        return self._batch(self._segment(following, os.stat(path)), len(data), data, True, lost)
+            if current is None:
+                return self._batch(None, 0, b'', False, lost)
+            data = self._read(f, 0, self.max_batch_bytes)
+            return self._batch(current, len(data), data, len(data) < stat.st_size, lost)
+
+    @staticmethod
+    def _batch(segment, offset, data, more, lost=0):
+        return {
+            'segment': segment,
+            'offset': offset,
+            'data': base64.b64encode(zlib.compress(data, 6)).decode('ascii'),
+            'more': more,
+            'lost': lost,
+        }
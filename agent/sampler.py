@@ -0,0 +1,128 @@
+import asyncio
+import os
+import time
+import uuid
+from array import array
+
+import psutil
+
+# The values of a sample, in the order they are stored and sent
+SAMPLE_FIELDS = ('time', 'memory_available', 'memory_used', 'swap_used', 'disk_free', 'disk_percent', 'load_1m',
+                 'cpu_percent', 'net_bytes_sent', 'net_bytes_recv')
+# The most samples sent in one message, about 40 KiB of JSON
+MAX_BATCH_SAMPLES = 500
+
+
+class SampleRing:
+    """
+    A fixed-size ring buffer of samples, stored in one flat array of doubles.
+
+    The ring never grows: once it is full, each new sample overwrites the oldest one. Every sample gets a sequence
+    number, one more than the previous sample, so a reader can ask for the samples after the last one it saw and learn
+    how many it missed if the ring wrapped around in the meantime. The ring lives in memory only, as the agent's disk
+    is tmpfs, and gets a new random ID when it is created, so readers notice when the agent restarted.
+
+    Attributes:
+        id (str): The random ID of the ring.
+        fields (tuple): The names of the values of a sample.
+        capacity (int): The number of samples the ring holds.
+        seq (int): The sequence number of the last sample, 0 while the ring is empty.
+
+    Args:
+        capacity (int): The number of samples the ring holds.
+        fields (tuple): The names of the values of a sample. The default value is SAMPLE_FIELDS.
+
+    Methods:
+        append(values: tuple) -> int: Adds a sample.
+        since(seq: int, limit: int) -> dict: Gets the samples after a sequence number.
+    """
+
+    def __init__(self, capacity, fields=SAMPLE_FIELDS):
+        self.id = uuid.uuid4().hex
+        self.fields = fields
+        self.capacity = capacity
+        self.seq = 0
+        self._width = len(fields)
+        self._values = array('d', bytes(8 * capacity * self._width))  # Zero filled, without a temporary list
+
+    @property
+    def first_seq(self):
+        # The sequence number of the oldest sample still in the ring
+        return max(1, self.seq - self.capacity + 1)
+
+    def append(self, values):
+        start = self.seq % self.capacity * self._width
+        self._values[start:start + self._width] = array('d', values)
+        self.seq += 1
+        return self.seq
+
+    def since(self, seq=0, limit=MAX_BATCH_SAMPLES):
+        """
+        Get the samples after a sequence number, oldest first.
+
+        Args:
+            seq (int): The sequence number of the last sample already read. The default value is 0, for all samples.
+            limit (int): The maximum number of samples returned. The default value is MAX_BATCH_SAMPLES.
+
+        Returns:
+            dict: The ID of the ring (ring), the names of the values (fields), the samples as lists of values
+            (samples), the sequence number of the last sample returned (seq), the number of samples overwritten before
+            they were read (lost) and whether more samples are waiting (more).
+        """
+        seq = min(max(seq, 0), self.seq)
+        first = max(seq + 1, self.first_seq)
+        last = min(self.seq, first + limit - 1)
+        samples = []
+        for number in range(first, last + 1):
+            start = (number - 1) % self.capacity * self._width
+            samples.append(self._values[start:start + self._width].tolist())
+        return {'ring': self.id, 'fields': self.fields, 'samples': samples, 'seq': max(last, seq),
+                'lost': first - seq - 1, 'more': last < self.seq}
+
+
+class Sampler:
+    """
+    Sample memory, disk, CPU and network usage at a fixed interval into a SampleRing.
+
+    A sample costs a handful of reads from /proc and a statvfs call, so it is taken on the event loop without a thread.
+    The ring keeps the history between two polls of the TEC server, so short memory spikes or a disk filling up and
+    being cleaned are seen even when the server polls much less often than the agent samples.
+
+    Attributes:
+        logger (logging.Logger): The logger used to report sampling errors.
+        interval (float): The time between samples in seconds.
+        disk (str): The mount point whose usage is sampled.
+        ring (SampleRing): The samples.
+
+    Args:
+        logger (logging.Logger): The logger used to report sampling errors.
+        interval (float): The time between samples in seconds. The default value is 10.
+        capacity (int): The number of samples kept. The default value is 8640, a day at the default interval.
+        disk (str): The mount point whose usage is sampled. The default value is '/'.
+
+    Methods:
+        sample() -> tuple: Takes a sample.
+        run(): Samples until cancelled.
+    """
+
+    def __init__(self, logger, interval=10, capacity=8640, disk='/'):
+        self.logger = logger
+        self.interval = interval
+        self.disk = disk
+        self.ring = SampleRing(capacity)
+        psutil.cpu_percent()  # The first call only sets the reference the next one is measured against
+
+    def sample(self):
+        memory = psutil.virtual_memory()
+        disk = psutil.disk_usage(self.disk)
+        network = psutil.net_io_counters()
+        return (time.time(), memory.available, memory.used, psutil.swap_memory().used, disk.free, disk.percent,
+                os.getloadavg()[0], psutil.cpu_percent(), network.bytes_sent, network.bytes_recv)
+
+    async def run(self):
+        while True:
+            try:
+                self.ring.append(self.sample())
+            except Exception as e:
+                self.logger.error(f'Error sampling system usage: {e}')
+            await asyncio.sleep(self.interval)
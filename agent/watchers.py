@@ -0,0 +1,334 @@
+import asyncio
+import os
+from abc import ABC, abstractmethod
+import select
+import socket
+import time
+
+import psutil
+
+from utils.system_profiler import SystemProfiler
+
+# Netlink constants, from linux/netlink.h and linux/rtnetlink.h
+NETLINK_ROUTE = 0
+NETLINK_KOBJECT_UEVENT = 15
+RTMGRP_IPV4_IFADDR = 0x10
+UEVENT_KERNEL_GROUP = 1
+# Changes come in bursts, a DHCP lease or a USB disk with several partitions, refresh once the burst is over
+DEBOUNCE_SECONDS = 0.5
+# Events waiting to be sent to a slow subscriber, older events are dropped as each event carries the whole section
+MAX_PENDING_EVENTS = 100
+# Sections no watcher reports changes of, refreshed on a timer. The CPU and the BIOS only change across reboots
+TIMED_SECTIONS = ('hostname', 'mac')
+REFRESH_SECONDS = 300
+
+
+class Watcher(ABC):
+    """
+    Base class of the watchers, which wake up the event loop when a part of the system profile changes.
+
+    A watcher registers a file descriptor with the event loop and schedules a refresh of its section of the profile
+    when the kernel reports a change, so nothing runs while nothing changes. Subclasses implement open, changed and
+    close, a watcher missing one of them cannot be created.
+
+    Attributes:
+        section (str): The section of the profile the watcher refreshes.
+        cache (ProfileCache): The profile cache refreshed.
+
+    Methods:
+        start(): Starts watching. Raises OSError if the kernel interface is not available.
+        stop(): Stops watching.
+    """
+    section = None
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._fd = None
+
+    @abstractmethod
+    def open(self):
+        # Opens the kernel interface, returns the file descriptor to watch
+        pass
+
+    @abstractmethod
+    def changed(self):
+        # Reads what the kernel reported, returns True if the section should be refreshed
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+    def _ready(self):
+        try:
+            if self.changed():
+                self.cache.schedule(self.section)
+        except Exception as e:
+            self.cache.logger.error(f'Error reading {self.section} changes: {e}')
+
+    def start(self):
+        self._fd = self.open()
+        asyncio.get_event_loop().add_reader(self._fd, self._ready)
+
+    def stop(self):
+        if self._fd is not None:
+            asyncio.get_event_loop().remove_reader(self._fd)
+            self.close()
+            self._fd = None
+
+
+class AddressWatcher(Watcher):
+    # IPv4 addresses added to or removed from any interface, from the rtnetlink address group
+    section = 'ips'
+
+    def open(self):
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.socket.setblocking(False)
+        self.socket.bind((0, RTMGRP_IPV4_IFADDR))
+        return self.socket.fileno()
+
+    def changed(self):
+        # Drain the socket, the messages themselves are not needed as the addresses are read again
+        changed = False
+        while True:
+            try:
+                changed = bool(self.socket.recv(65536)) or changed
+            except BlockingIOError:
+                return changed
+
+    def close(self):
+        self.socket.close()
+
+
+class BlockDeviceWatcher(Watcher):
+    # Disks and partitions plugged in or removed, from the kernel uevents
+    section = 'disks'
+
+    def open(self):
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        self.socket.setblocking(False)
+        self.socket.bind((0, UEVENT_KERNEL_GROUP))
+        return self.socket.fileno()
+
+    def changed(self):
+        changed = False
+        while True:
+            try:
+                message = self.socket.recv(65536)
+            except BlockingIOError:
+                return changed
+            # A uevent is a header followed by KEY=VALUE pairs, all separated by null bytes
+            fields = dict(field.split(b'=', 1) for field in message.split(b'\0') if b'=' in field)
+            if fields.get(b'SUBSYSTEM') == b'block' and fields.get(b'ACTION') in (b'add', b'remove', b'change'):
+                changed = True
+
+    def close(self):
+        self.socket.close()
+
+
+class MountWatcher(Watcher):
+    """
+    Watch filesystems being mounted or unmounted.
+
+    The kernel flags /proc/self/mountinfo with POLLPRI when the mount table changes, which the event loop cannot wait
+    for directly, so the file is registered with an epoll object whose own descriptor becomes readable instead.
+    """
+    section = 'disks'
+
+    def open(self):
+        self.file = open('/proc/self/mountinfo', 'rb')
+        self.epoll = select.epoll()
+        self.epoll.register(self.file.fileno(), select.EPOLLPRI | select.EPOLLERR)
+        self.epoll.poll(0)  # Clear the event pending from before the file was opened
+        return self.epoll.fileno()
+
+    def changed(self):
+        # Checking the epoll descriptor already consumed the event, which the kernel reports once per change
+        self.epoll.poll(0)
+        self.file.seek(0)
+        self.file.read()
+        return True
+
+    def close(self):
+        self.epoll.close()
+        self.file.close()
+
+
+WATCHERS = (AddressWatcher, BlockDeviceWatcher, MountWatcher)
+WATCHED_SECTIONS = {watcher_class.section for watcher_class in WATCHERS}
+
+
+class ProfileCache:
+    """
+    Keep the system profile of the agent up to date without collecting it again on every request.
+
+    The full profile is only collected once. Afterwards the IP addresses and the disks are refreshed when a watcher
+    reports a change, and the changed section is pushed to every subscriber, so the TEC server learns about a new
+    address or a hot-plugged disk as it happens. The memory and disk usage change all the time and are cheap to read,
+    so they are read again for every snapshot, along with any section whose watcher could not be started. The hostname
+    and the MAC address have no watcher, they are refreshed every refresh_interval seconds while the watchers run and
+    published like the other sections. The CPU and BIOS sections are never refreshed, they only change across reboots.
+
+    A snapshot is a new dictionary, and the cache replaces its sections rather than changing them in place, so a
+    snapshot being sent is never changed by a later refresh.
+
+    Attributes:
+        logger (logging.Logger): The logger used to report changes and errors.
+        profile (dict): The cached system profile, None until the first snapshot.
+        watchers (list): The watchers running.
+        subscribers (set): The asyncio.Queue of each subscriber, receiving the events.
+
+    Args:
+        logger (logging.Logger): The logger used to report changes and errors.
+        debounce (float): The time in seconds to wait for a burst of changes to end. The default value is
+            DEBOUNCE_SECONDS.
+        refresh_interval (float): The time in seconds between two refreshes of the TIMED_SECTIONS. The default value
+            is REFRESH_SECONDS.
+
+    Methods:
+        snapshot() -> dict: Gets the current system profile.
+        start_watchers() -> list: Starts the watchers available on this system, and the timer of the TIMED_SECTIONS.
+        stop_watchers(): Stops the watchers and the timer.
+        schedule(section: str): Refreshes a section once the current burst of changes is over.
+        refresh(section: str) -> bool: Refreshes a section and publishes it if it changed.
+        subscribe() -> asyncio.Queue: Gets a queue receiving the events.
+        unsubscribe(queue: asyncio.Queue): Stops sending events to a queue.
+    """
+
+    def __init__(self, logger, debounce=DEBOUNCE_SECONDS, refresh_interval=REFRESH_SECONDS):
+        self.logger = logger
+        self.debounce = debounce
+        self.refresh_interval = refresh_interval
+        self.profile = None
+        self.watchers = []
+        self.subscribers = set()
+        self.profiler = SystemProfiler(logger=logger, collect=False)
+        self._collectors = {'ips': self.profiler.get_ips, 'disks': self.profiler.get_disks,
+                            'hostname': socket.gethostname, 'mac': self.profiler.get_mac_address}
+        self._pending = {}
+        self._timer = None
+
+    @property
+    def watched(self):
+        return {watcher.section for watcher in self.watchers}
+
+    def snapshot(self):
+        if self.profile is None:
+            self.profile = self.profiler.system_profile()
+            return dict(self.profile)
+        self.profile['memory'] = self.profiler.get_system_memory()
+        for section in WATCHED_SECTIONS - self.watched:
+            self.profile[section] = self._collectors[section]()
+        if self.profile['disks']:
+            # New disk dictionaries, the previous snapshots keep the usage they were sent with
+            self.profile['disks'] = [self._with_usage(disk) for disk in self.profile['disks']]
+        return dict(self.profile)
+
+    @staticmethod
+    def _with_usage(disk):
+        try:
+            return dict(disk, usage=psutil.disk_usage(disk['mountpoint']))
+        except OSError:
+            return disk  # Unmounted since, the mount watcher refreshes the disks
+
+    def start_watchers(self):
+        for watcher_class in WATCHERS:
+            watcher = watcher_class(self)
+            try:
+                watcher.start()
+                self.watchers.append(watcher)
+            except (OSError, AttributeError) as e:
+                # Not Linux, or netlink is not allowed here, the section is read again for every snapshot instead
+                self.logger.warning(f'{watcher_class.__name__} unavailable, {watcher.section} will be polled: {e}')
+        self._timer = asyncio.get_event_loop().call_later(self.refresh_interval, self._refresh_timed)
+        return self.watchers
+
+    def stop_watchers(self):
+        for watcher in self.watchers:
+            watcher.stop()
+        self.watchers = []
+        for handle in self._pending.values():
+            handle.cancel()
+        self._pending = {}
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def schedule(self, section):
+        if section in self._pending:
+            self._pending[section].cancel()
+        self._pending[section] = asyncio.get_event_loop().call_later(self.debounce, self._refresh_pending, section)
+
+    def _refresh_pending(self, section):
+        del self._pending[section]
+        self.refresh(section)
+
+    def _refresh_timed(self):
+        for section in TIMED_SECTIONS:
+            try:
+                self.refresh(section)
+            except Exception as e:
+                self.logger.error(f'Error refreshing {section}: {e}')
+        self._timer = asyncio.get_event_loop().call_later(self.refresh_interval, self._refresh_timed)
+
+    def refresh(self, section):
+        """
+        Collect a section of the profile again and publish it to the subscribers if it changed.
+
+        Args:
+            section (str): The section, 'ips', 'disks', 'hostname' or 'mac'.
+
+        Returns:
+            bool: True if the section changed.
+        """
+        if self.profile is None:
+            return False  # Nothing cached yet, the first snapshot collects everything
+        value = self._collectors[section]()
+        if section == 'disks':
+            # The usage changes all the time, only the disks themselves are compared
+            changed = self._disk_keys(value) != self._disk_keys(self.profile.get('disks'))
+        else:
+            changed = value != self.profile.get(section)
+        self.profile[section] = value
+        if changed:
+            self.logger.info(f'System profile changed: {section}')
+            self.publish({'message': 'event', 'event': section, 'time': time.time(), 'data': {section: value}})
+        return changed
+
+    @staticmethod
+    def _disk_keys(disks):
+        return sorted((disk['device'], disk['mountpoint'], disk['fstype'], disk['opts']) for disk in disks or [])
+
+    def publish(self, event):
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def subscribe(self):
+        queue = asyncio.Queue(MAX_PENDING_EVENTS)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+
+if __name__ == '__main__':
+    # Print the events of this machine until interrupted, e.g. while running 'ip addr add' or mounting a filesystem
+    import logging
+    logging.basicConfig(level=logging.INFO)
+
+    async def main():
+        cache = ProfileCache(logging.getLogger('watchers'))
+        cache.snapshot()
+        cache.start_watchers()
+        print(f'Watching {", ".join(sorted(cache.watched)) or "nothing"} in process {os.getpid()}')
+        queue = cache.subscribe()
+        while True:
+            print(await queue.get())
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import random
+import uuid
+
+import websockets
+
+
+def synthetic_profile(seed):
+    """
+    Build a realistic system profile, as returned by SystemProfiler, for a simulated thin client.
+
+    Args:
+        seed (int): The seed of the profile. The same seed always gives the same hardware.
+
+    Returns:
+        dict: The system profile.
+    """
+    rng = random.Random(seed)
+    total_memory = rng.choice([4, 8, 16]) * 1024 ** 3
+    disk_size = rng.choice([32, 64, 128, 256]) * 1000 ** 3
+    used = int(disk_size * rng.uniform(0.1, 0.6))
+    return {
+        'hostname': f'thinclient-{seed:05d}',
+        'cpu': {'architecture': 'x86_64', 'vendor': rng.choice(['GenuineIntel', 'AuthenticAMD']),
+                'model': rng.choice(['Intel(R) Celeron(R) J4125 CPU @ 2.00GHz', 'AMD GX-420GI SOC with Radeon(TM) R7E',
+                                     'Intel(R) Pentium(R) Silver N5030 CPU @ 1.10GHz']),
+                'cores': '4', 'threads': '4'},
+        'bios': {'vendor': rng.choice(['HP', 'Dell Inc.', 'LENOVO']), 'version': f'{rng.randint(1, 2)}.{rng.randint(0, 30)}.0',
+                 'release_date': f'{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/20{rng.randint(18, 24)}',
+                 'is_virtual': False},
+        'memory': {'total': total_memory, 'available': int(total_memory * 0.7), 'used': int(total_memory * 0.3),
+                   'free': int(total_memory * 0.6)},
+        'disks': [{'device': '/dev/sda', 'mountpoint': '/media/root-ro', 'fstype': 'ext4', 'opts': 'ro,relatime',
+                   'usage': [disk_size, used, disk_size - used, round(used / disk_size * 100, 1)], 'size': disk_size},
+                  {'device': 'tmpfs-root', 'mountpoint': '/media/root-rw', 'fstype': 'tmpfs', 'opts': 'rw,relatime',
+                   'usage': [total_memory // 2, 0, total_memory // 2, 0.0], 'size': total_memory // 2}],
+        'ips': ['127.0.0.1', f'10.{seed // 65536 % 256}.{seed // 256 % 256}.{seed % 256}'],
+        'mac': ':'.join(f'{rng.randint(0, 255):02x}' for _ in range(6)),
+    }
+
+
+class FakeAgent:
+    """
+    A lightweight stand-in for ThinAgent that answers the TEC server with a synthetic profile.
+
+    It speaks the same websocket protocol as ThinAgent for the messages the server sends when polling, without a
+    database, profiler or log file, so thousands of them can run in one event loop. Slow and unreliable endpoints
+    are simulated with a profiling latency, a failure rate and a churn rate of the changing parts of the profile.
+
+    Attributes:
+        client_id (str): The client ID of the agent.
+        profile (dict): The system profile returned to the server.
+        port (int): The port the agent listens on, once started.
+
+    Args:
+        seed (int): The seed of the synthetic profile.
+        client_id (str): The client ID. A random one is used by default.
+        latency (float): The mean time in seconds taken to build the profile, exponentially distributed.
+        failure_rate (float): The probability that a connection is dropped instead of answered.
+        churn (float): The probability that the memory, disk usage and IPs changed since the last poll.
+
+    Methods:
+        start(host, port, ssl): Starts listening for the server, over TLS with an ssl.SSLContext.
+        stop(): Stops listening.
+        handler(websocket): Handles a connection from the server.
+        answer(message) -> dict: Builds the answer to a message.
+    """
+
+    def __init__(self, seed, client_id=None, latency=0, failure_rate=0, churn=0):
+        self.client_id = client_id or uuid.uuid4().hex
+        self.profile = synthetic_profile(seed)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.churn = churn
+        self.port = None
+        self.server = None
+        self._random = random.Random(seed)
+
+    async def start(self, host='127.0.0.1', port=0, ssl=None):
+        self.server = await websockets.serve(self.handler, host, port, ssl=ssl)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def _churn(self):
+        memory = self.profile['memory']
+        memory['available'] = int(memory['total'] * self._random.uniform(0.2, 0.9))
+        memory['used'] = memory['total'] - memory['available']
+        for disk in self.profile['disks']:
+            used = int(disk['size'] * self._random.uniform(0.05, 0.9))
+            disk['usage'] = [disk['size'], used, disk['size'] - used, round(used / disk['size'] * 100, 1)]
+        self.profile['ips'][1] = '10.' + '.'.join(str(self._random.randint(1, 254)) for _ in range(3))
+
+    def answer(self, message):
+        if message == 'OK':
+            return {'message': 'OK'}
+        if message == 'client_id?':
+            return {'client_id': self.client_id}
+        if message == 'system_info?':
+            return self.profile
+        if message == 'integrity?':
+            return {'status': 'unavailable'}
+        if message == 'samples?':
+            return {'ring': None, 'fields': [], 'samples': [], 'seq': 0, 'lost': 0, 'more': False}
+        if message == 'logs?':
+            return {'segment': None, 'offset': 0, 'data': 'eJwDAAAAAAE=', 'more': False}  # zlib of b''
+        return None
+
+    async def handler(self, websocket):
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            await websocket.close(1011, 'Simulated failure')
+            return
+        async for raw in websocket:
+            message = json.loads(raw).get('message')
+            if message == 'Connection closed.':
+                break
+            if message == 'system_info?':
+                if self.latency:
+                    await asyncio.sleep(self._random.expovariate(1 / self.latency))
+                if self.churn and self._random.random() < self.churn:
+                    self._churn()
+            answer = self.answer(message)
+            if answer is not None:
+                await websocket.send(json.dumps(answer))
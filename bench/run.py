@@ -0,0 +1,399 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import zlib
+from argparse import ArgumentParser
+from datetime import datetime
+
+BENCHMARKS = {}
+# A result worse than the baseline by more than this fraction is reported as a regression
+TOLERANCE = 0.2
+# The checked-in reference results, used when --baseline or --save-baseline is given without a path
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def benchmark(name):
+    """
+    Register a benchmark.
+
+    A benchmark is a function taking the parsed arguments and returning a dictionary of metric names to a tuple of
+    the value, the unit, and whether higher values are better.
+    """
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def per_call(func, number, repeat=5):
+    """
+    Time a function.
+
+    Args:
+        func (callable): The function to time, called without arguments.
+        number (int): The number of calls per measurement.
+        repeat (int): The number of measurements. The median is kept.
+
+    Returns:
+        float: The median time per call in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return statistics.median(times)
+
+
+def quiet(logger):
+    # Only keep warnings, so benchmarks measure the code and not the console
+    logger.setLevel(logging.WARNING)
+    return logger
+
+
+@benchmark('profiler')
+def bench_profiler(args):
+    from utils.system_profiler import SystemProfiler
+    profiler = SystemProfiler(logger=quiet(logging.getLogger('bench.profiler')))
+    results = {'system_profile_ms': (per_call(lambda: SystemProfiler.system_profile(profiler), 3) * 1000, 'ms', False)}
+    for collector in ('get_cpu_info', 'get_bios_info', 'get_system_memory', 'get_disks', 'get_ips', 'get_mac_address'):
+        results[f'{collector}_ms'] = (per_call(getattr(profiler, collector), 3) * 1000, 'ms', False)
+    return results
+
+
+class FakeWebsocket:
+    # Stands in for the server connection of ThinAgent.route, counting what is sent
+    def __init__(self):
+        self.sent = 0
+
+    async def send(self, data):
+        self.sent += len(data)
+
+
+@benchmark('route')
+def bench_route(args):
+    from agent.agent import ThinAgent
+    agent = ThinAgent()
+    quiet(agent.logger)
+    websocket = FakeWebsocket()
+    loop = asyncio.new_event_loop()
+    results = {}
+    try:
+        for message in ('OK', 'client_id?', 'settings', 'integrity?'):
+            seconds = per_call(lambda: loop.run_until_complete(agent.route(websocket, {'message': message})), 200)
+            results[f'{message.rstrip("?")}_us'] = (seconds * 1e6, 'us', False)
+    finally:
+        loop.close()
+    return results
+
+
+@benchmark('poll')
+def bench_poll(args):
+    from bench.fake_agent import FakeAgent
+    from tec.tec_server import TECServer
+    server = TECServer()
+    quiet(server.logger)
+
+    async def run():
+        agents = [await FakeAgent(index).start() for index in range(args.agents)]
+        latencies = []
+        start = time.perf_counter()
+        try:
+            for _ in range(args.rounds):
+                for agent in agents:
+                    poll_start = time.perf_counter()
+                    await server.poll_client('ws', '127.0.0.1', agent.port)
+                    latencies.append(time.perf_counter() - poll_start)
+        finally:
+            for agent in agents:
+                await agent.stop()
+        return len(latencies) / (time.perf_counter() - start), latencies
+
+    throughput, latencies = asyncio.run(run())
+    latencies.sort()
+    return {
+        'polls_per_s': (throughput, 'polls/s', True),
+        'p50_ms': (latencies[len(latencies) // 2] * 1000, 'ms', False),
+        'p99_ms': (latencies[int(len(latencies) * 0.99)] * 1000, 'ms', False),
+    }
+
+
+@benchmark('upsert')
+def bench_upsert(args):
+    from bench.fake_agent import synthetic_profile
+    from tec.tec_server import TECServer
+    server = TECServer()
+    quiet(server.logger)
+    profiles = [(f'bench-{index:05d}', synthetic_profile(index)) for index in range(args.rows)]
+    results = {}
+    for phase in ('insert', 'update'):
+        start = time.perf_counter()
+        for client_id, profile in profiles:
+            server.upsert_client(client_id, dict(profile, last_seen=time.time()))
+        results[f'{phase}_rows_per_s'] = (len(profiles) / (time.perf_counter() - start), 'rows/s', True)
+    return results
+
+
+@benchmark('fleet')
+def bench_fleet(args):
+    from bench.fake_agent import synthetic_profile
+    from tec.tec_server import TECServer, thinclients
+    server = TECServer()
+    quiet(server.logger)
+    for index in range(args.rows):
+        server.upsert_client(f'fleet-{index:05d}', dict(synthetic_profile(index), last_seen=time.time(), status='online'))
+    server.session.expunge_all()
+    orm = per_call(lambda: [client.to_dict() for client in server.session.query(thinclients)], 1, 3)
+    server.session.expunge_all()
+    return {
+        'orm_status_ms': (orm * 1000, 'ms', False),
+        'cache_status_ms': (per_call(server.fleet_status, 10) * 1000, 'ms', False),
+        'cache_load_ms': (per_call(lambda: server.fleet.load(server.session, thinclients), 1, 3) * 1000, 'ms', False),
+    }
+
+
+def channel_messages(count):
+    # The messages of a polling session, as the agent sends them: profiles, log batches and sample batches
+    from bench.fake_agent import FakeAgent
+    from agent.sampler import SAMPLE_FIELDS
+    agent = FakeAgent(0, churn=1)
+    rng = random.Random(0)
+    messages = []
+    for index in range(count):
+        agent._churn()
+        messages.append(json.dumps(agent.profile).encode())
+        if index % 10 == 0:
+            log = ''.join(f'2024-05-01 12:{line // 60 % 60:02d}:{line % 60:02d},{rng.randint(0, 999):03d} - ThinAgent - '
+                          f'INFO - Polled by server {rng.randint(1, 254)}, {rng.randint(0, 10 ** 6)} bytes sent.\n'
+                          for line in range(2000)).encode()
+            messages.append(json.dumps({'segment': '1:2', 'offset': index, 'more': False,
+                                        'data': base64.b64encode(zlib.compress(log)).decode()}).encode())
+            messages.append(json.dumps({'ring': 'r', 'fields': SAMPLE_FIELDS, 'seq': index, 'lost': 0, 'more': False,
+                                        'samples': [[1.7e9 + index * 600 + second * 10, rng.randint(1e9, 6e9),
+                                                     rng.randint(1e9, 6e9), 0.0, rng.randint(1e10, 3e10),
+                                                     round(rng.uniform(5, 95), 1), rng.random(), rng.uniform(0, 100),
+                                                     1.2e7 + index * 1e5, 4.4e7 + index * 3e5] for second in range(60)]
+                                        }).encode())
+    return messages
+
+
+@benchmark('wsdeflate')
+def bench_wsdeflate(args):
+    # Compress the messages as permessage-deflate does, one stream per connection with a sync flush per message
+    messages = channel_messages(args.rounds * 10)
+    raw = sum(len(message) for message in messages)
+    results = {}
+    for window_bits, mem_level in ((15, 8), (12, 5), (10, 4), (9, 1)):
+        start = time.process_time()
+        compressed = 0
+        for _ in range(5):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -window_bits, mem_level)
+            compressed = sum(len(compressor.compress(message) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+                             for message in messages)
+        seconds = (time.process_time() - start) / 5
+        name = f'w{window_bits}_m{mem_level}'
+        results[f'{name}_saved_pct'] = ((1 - compressed / raw) * 100, '%', True)
+        results[f'{name}_us_per_kb'] = (seconds / (raw / 1024) * 1e6, 'us/KiB', False)
+    return results
+
+
+@benchmark('tls')
+def bench_tls(args):
+    from bench.fake_agent import FakeAgent
+    from tec.tec_server import TECServer
+    from utils.tls import LocalCA, client_context, server_context
+    ca = LocalCA(quiet(logging.getLogger('bench.tls')), 'tls')
+    if not ca.create():
+        raise RuntimeError('the local CA could not be created')
+    cert, key = ca.issue('agent', ['127.0.0.1'])
+    server = TECServer()
+    quiet(server.logger)
+    server.ssl_context = client_context(ca.cert)
+    handshakes = args.agents * args.rounds * 4
+
+    async def echo(reader, writer):
+        writer.write(await reader.read(1))
+        await writer.drain()
+        writer.close()
+
+    async def connect(port, context, resume):
+        # Both ends run in this process, so a handshake costs the work of the client and the agent
+        reused = 0
+        start = time.perf_counter()
+        for _ in range(handshakes):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port, ssl=context)
+            writer.write(b'x')
+            await reader.read(1)
+            ssl_object = writer.get_extra_info('ssl_object')
+            reused += ssl_object.session_reused
+            if resume:
+                context.remember('127.0.0.1', ssl_object)
+            writer.close()
+            await writer.wait_closed()
+        return handshakes / (time.perf_counter() - start), reused / handshakes * 100
+
+    async def poll(agent, resume, keep_alive):
+        start = time.perf_counter()
+        for _ in range(args.rounds * 4):
+            await server.poll_client('wss', '127.0.0.1', agent.port, keep_alive=keep_alive)
+            if not resume:
+                server.ssl_context.forget('127.0.0.1')
+        await server.close_connections()
+        return args.rounds * 4 / (time.perf_counter() - start)
+
+    async def run():
+        results = {}
+        listener = await asyncio.start_server(echo, '127.0.0.1', 0, ssl=server_context(cert, key))
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            for name, resume in (('full', False), ('resumed', True)):
+                rate, reused = await connect(port, client_context(ca.cert), resume)
+                results[f'{name}_handshakes_per_s'] = (rate, 'handshakes/s', True)
+            results['resumed_pct'] = (reused, '%', True)
+        finally:
+            listener.close()
+            await listener.wait_closed()
+        agent = await FakeAgent(0).start(ssl=server_context(cert, key))
+        try:
+            for name, resume, keep_alive in (('full', False, False), ('resumed', True, False),
+                                             ('keep_alive', True, True)):
+                results[f'wss_{name}_polls_per_s'] = (await poll(agent, resume, keep_alive), 'polls/s', True)
+        finally:
+            await agent.stop()
+        return results
+
+    return asyncio.run(run())
+
+
+@benchmark('hashtools')
+def bench_hashtools(args):
+    from utils.hashtools import HashTools
+    return {f"{mode.replace(' ', '_')}_mb_per_s": (mb_per_s, 'MB/s', True)
+            for mode, mb_per_s in HashTools().benchmark(size=args.hash_mb * 1024 * 1024, files=4).items()}
+
+
+@benchmark('sevenzip')
+def bench_sevenzip(args):
+    from utils.sevenzip import SevenZip, _sample_payloads
+    sevenzip = SevenZip(logger=quiet(logging.getLogger('bench.sevenzip')))
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='sevenzip-bench-') as workdir:
+        payload = _sample_payloads(workdir)['logs']
+        for codec, suffix in (('lzma2', '.7z'), ('zstd', '.tar.zst'), ('xz', '.tar.xz')):
+            archive = os.path.join(workdir, f'logs{suffix}')
+            start = time.perf_counter()
+            if not sevenzip.compress(payload, archive, codec=codec):
+                continue  # The codec is not available here
+            compress = time.perf_counter() - start
+            ratio = sevenzip.last_stats['ratio']
+            start = time.perf_counter()
+            sevenzip.decompress(archive, os.path.join(workdir, f'out-{codec}'))
+            decompress = time.perf_counter() - start
+            size = sevenzip.last_stats['input_bytes'] / 1024 ** 2
+            results[f'{codec}_compress_mb_per_s'] = (size / compress, 'MB/s', True)
+            results[f'{codec}_decompress_mb_per_s'] = (size / decompress, 'MB/s', True)
+            results[f'{codec}_ratio'] = (ratio, 'ratio', False)
+            os.remove(archive)
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Compare results with a baseline.
+
+    Args:
+        results (dict): The results of this run.
+        baseline (dict): The results of the baseline run.
+        tolerance (float): The fraction by which a metric may get worse before it is reported as a regression.
+
+    Returns:
+        list: A tuple of the metric, the baseline value, the new value, the relative change and whether it is a
+        regression, for each metric present in both runs.
+    """
+    changes = []
+    for name, metric in results['metrics'].items():
+        if name not in baseline['metrics'] or not baseline['metrics'][name]['value']:
+            continue
+        old = baseline['metrics'][name]['value']
+        change = (metric['value'] - old) / old
+        worse = -change if metric['higher_is_better'] else change
+        changes.append((name, old, metric['value'], change, worse > tolerance))
+    return changes
+
+
+def main():
+    parser = ArgumentParser(description='Run the ThinTrust benchmarks. No network access is needed.')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help=f'The benchmarks to run, all of them by default: {", ".join(BENCHMARKS)}.')
+    parser.add_argument('-o', '--output', help='Write the results to this JSON file instead of stdout.')
+    parser.add_argument('--baseline', nargs='?', const=BASELINE, metavar='PATH',
+                        help='Compare the results with this results file, bench/baseline.json without a path.')
+    parser.add_argument('--save-baseline', nargs='?', const=BASELINE, metavar='PATH',
+                        help='Also write the results to this baseline file, bench/baseline.json without a path.')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='Allowed regression, as a fraction.')
+    parser.add_argument('--agents', type=int, default=8, help='Number of fake agents polled by the poll benchmark.')
+    parser.add_argument('--rounds', type=int, default=10, help='Number of times each fake agent is polled.')
+    parser.add_argument('--rows', type=int, default=1000, help='Number of clients upserted by the upsert benchmark.')
+    parser.add_argument('--hash-mb', type=int, default=64, help='Size of the file hashed by the hashtools benchmark.')
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f'unknown benchmarks: {", ".join(unknown)}')
+
+    results = {
+        'created': datetime.now().timestamp(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'metrics': {},
+    }
+    # The agent and server create their databases and logs in the working directory
+    with tempfile.TemporaryDirectory(prefix='thintrust-bench-') as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            for name in args.benchmarks or BENCHMARKS:
+                print(f'Running {name}...', file=sys.stderr)
+                try:
+                    metrics = BENCHMARKS[name](args)
+                except Exception as e:
+                    print(f'Error running {name}: {e}', file=sys.stderr)
+                    continue
+                for metric, (value, unit, higher_is_better) in metrics.items():
+                    results['metrics'][f'{name}.{metric}'] = {'value': round(value, 3), 'unit': unit,
+                                                              'higher_is_better': higher_is_better}
+        finally:
+            os.chdir(cwd)
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            f.write(output)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        changes = compare(results, baseline, args.tolerance)
+        print(f"{'metric':<44}{'baseline':>12}{'current':>12}{'change':>9}", file=sys.stderr)
+        for name, old, new, change, regression in changes:
+            print(f"{name:<44}{old:>12.3f}{new:>12.3f}{change:>+9.1%}{'  REGRESSION' if regression else ''}",
+                  file=sys.stderr)
+        if any(regression for *_, regression in changes):
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from bench.fake_agent import FakeAgent
+
+AGENT_PORT = 8765
+
+
+def swarm_address(index):
+    """
+    Get the loopback address of a simulated agent.
+
+    Linux routes the whole 127.0.0.0/8 network to the loopback interface, so every agent gets its own address and
+    listens on the real agent port, like a fleet of thin clients would.
+
+    Args:
+        index (int): The index of the agent in the swarm.
+
+    Returns:
+        str: The address, from 127.1.0.1 up, skipping the .0 and .255 host parts.
+    """
+    block, host = divmod(index, 254)
+    return f'127.{1 + block // 256}.{block % 256}.{host + 1}'
+
+
+def raise_nofile_limit():
+    # Every agent listens on its own socket and every poll opens one more on each side
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def rss_mb():
+    # The current and the peak resident set size of this process
+    status = {}
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            status[key] = value.strip()
+    return int(status['VmRSS'].split()[0]) / 1024, int(status['VmHWM'].split()[0]) / 1024
+
+
+def run_agents(start, count, options, connection):
+    """
+    Run a slice of the swarm in its own process and event loop until the parent asks it to stop.
+
+    Args:
+        start (int): The index of the first agent of the slice.
+        count (int): The number of agents in the slice.
+        options (dict): The latency, failure_rate and churn of the agents.
+        connection (multiprocessing.connection.Connection): The pipe to the parent, 'ready' is sent once every agent
+            listens and the slice stops when anything is received.
+    """
+    raise_nofile_limit()
+
+    async def main():
+        agents = []
+        for index in range(start, start + count):
+            agents.append(await FakeAgent(index, **options).start(swarm_address(index), AGENT_PORT))
+        connection.send('ready')
+        await asyncio.get_running_loop().run_in_executor(None, connection.recv)
+        for agent in agents:
+            agent.server.close()
+
+    asyncio.run(main())
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+
+def main():
+    parser = ArgumentParser(description='Drive the TEC server against a swarm of simulated agents on loopback.')
+    parser.add_argument('-n', '--agents', type=int, default=10000, help='Number of simulated agents.')
+    parser.add_argument('-p', '--processes', type=int, default=1, help='Number of processes running the agents.')
+    parser.add_argument('-c', '--concurrency', type=int, default=200, help='Number of clients polled at once.')
+    parser.add_argument('-r', '--rounds', type=int, default=1, help='Number of times the whole swarm is polled.')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Mean time agents take to build a profile.')
+    parser.add_argument('--failure-rate', type=float, default=0.01, help='Fraction of polls the agents drop.')
+    parser.add_argument('--churn', type=float, default=0.2, help='Fraction of polls with a changed profile.')
+    parser.add_argument('--log-level', default='WARNING', help='Log level of the server during the run.')
+    args = parser.parse_args()
+
+    limit = raise_nofile_limit()
+    if args.agents + args.concurrency * 2 > limit:
+        print(f'The open files limit is {limit}, too low for {args.agents} agents.', file=sys.stderr)
+        exit(1)
+    options = {'latency': args.latency_ms / 1000, 'failure_rate': args.failure_rate, 'churn': args.churn}
+    context = multiprocessing.get_context('spawn')
+    workers = []
+    per_process = -(-args.agents // args.processes)
+    for start in range(0, args.agents, per_process):
+        parent, child = context.Pipe()
+        process = context.Process(target=run_agents, args=(start, min(per_process, args.agents - start), options,
+                                                           child), daemon=True)
+        process.start()
+        workers.append((process, parent))
+    print(f'Starting {args.agents} agents in {len(workers)} processes...', file=sys.stderr)
+    for _, connection in workers:
+        connection.recv()
+
+    # The server creates its database and log in the working directory
+    cwd = os.getcwd()
+    workdir = tempfile.TemporaryDirectory(prefix='thintrust-swarm-')
+    os.chdir(workdir.name)
+    try:
+        from tec.tec_server import TECServer
+        server = TECServer()
+        server.logger.setLevel(args.log_level)
+        clients = [(swarm_address(index), AGENT_PORT) for index in range(args.agents)]
+        rounds = []
+        for number in range(args.rounds):
+            print(f'Polling round {number + 1}...', file=sys.stderr)
+            start = time.perf_counter()
+            results = asyncio.run(server.poll_clients(clients, args.concurrency))
+            duration = time.perf_counter() - start
+            latencies = sorted(result['duration'] * 1000 for result in results if result['ok'])
+            rounds.append({
+                'round': number + 1,
+                'polls': len(results),
+                'succeeded': len(latencies),
+                'failed': len(results) - len(latencies),
+                'seconds': round(duration, 3),
+                'polls_per_s': round(len(results) / duration, 2),
+                'p50_ms': round(percentile(latencies, 0.5), 3) if latencies else None,
+                'p99_ms': round(percentile(latencies, 0.99), 3) if latencies else None,
+                'mean_ms': round(statistics.mean(latencies), 3) if latencies else None,
+            })
+        rss, peak = rss_mb()
+        report = {
+            'agents': args.agents,
+            'processes': len(workers),
+            'concurrency': args.concurrency,
+            'options': options,
+            'rounds': rounds,
+            'server_rss_mb': round(rss, 1),
+            'server_peak_rss_mb': round(peak, 1),
+        }
+        print(json.dumps(report, indent=4))
+    finally:
+        os.chdir(cwd)
+        workdir.cleanup()
+        for process, connection in workers:
+            connection.send('stop')
+            process.join(10)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+import os
+import shutil
+import subprocess
+import tempfile
+from datetime import datetime
+
+import requests
+
+from utils.hashtools import HashTools
+from utils.sevenzip import SevenZip
+
+BUNDLE_NAME = 'thintrust-bundle'
+RESOURCES = [
+    'plymouththeme.7z',
+    'wallpapers/wallpapernologo.png',
+    'wallpapers/wallpaper.svg',
+    'wallpapers/wallpaper.png',
+]
+# Only the files the setup reads from the bundle, config.json and setup.json are always read from the install
+CONFIG_FILES = ['setup/default_theme.sh']
+
+
+class ProvisioningBundle:
+    """
+    Class representing an offline provisioning bundle.
+
+    A provisioning bundle is built once on a machine with network access and then applied on every thin client from
+    local disk or a USB stick, so a lab of machines does not download the same packages and themes again and again.
+    The bundle contains the .deb files of every required package and its dependencies, the theme archives, the
+    wallpapers and the default theme script, plus a HashTools manifest with the size and sha256 hash of every
+    file. It is compressed into a single 7z archive.
+
+    Used as a context manager, the bundle removes the directory an archive was extracted to on exit:
+        with ProvisioningBundle(logger, release) as bundle:
+            bundle_dir = bundle.open('thintrust-bundle.7z')
+
+    Layout of the bundle:
+        thintrust-bundle/manifest.json
+        thintrust-bundle/debs/*.deb
+        thintrust-bundle/resources/plymouththeme.7z
+        thintrust-bundle/resources/wallpapers/*
+        thintrust-bundle/config/default_theme.sh
+
+    Attributes:
+        logger (logging.Logger): The logger used to report progress.
+        distro_release (str): The ThinTrust release the resources are fetched for.
+        hashtools (HashTools): Instance of the HashTools class used to hash the bundle files.
+        extract_dir (str): The temporary directory an archive was extracted to by open(), until cleanup().
+
+    Methods:
+        build(packages, destination): Builds a bundle archive.
+        open(source): Extracts a bundle archive, or uses an extracted bundle directory, and verifies it.
+        verify(bundle_dir): Verifies the files of an extracted bundle against its manifest.
+        cleanup(): Removes the directory an archive was extracted to.
+    """
+
+    def __init__(self, logger, distro_release):
+        self.logger = logger
+        self.distro_release = distro_release
+        self.hashtools = HashTools('sha256')
+        self.extract_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
+
+    def cleanup(self):
+        """
+        Removes the directory the last archive was extracted to by open(). An extracted bundle directory passed to
+        open() is never removed.
+        """
+        if self.extract_dir:
+            shutil.rmtree(self.extract_dir, ignore_errors=True)
+            self.extract_dir = None
+
+    def build(self, packages, destination):
+        """
+        Builds a bundle archive.
+
+        Args:
+            packages (list): The packages to include. Their dependencies are resolved and included as well.
+            destination (str): The path of the 7z archive to create.
+
+        Returns:
+            bool: True if the bundle is built successfully, False otherwise.
+        """
+        self.logger.info(f'Building provisioning bundle {destination}...')
+        staging = tempfile.mkdtemp(prefix='thintrust-bundle-')
+        bundle_dir = os.path.join(staging, BUNDLE_NAME)
+        try:
+            os.makedirs(os.path.join(bundle_dir, 'debs'))
+            if not self._download_packages(packages, os.path.join(bundle_dir, 'debs')):
+                return False
+            for resource in RESOURCES:
+                path = os.path.join(bundle_dir, 'resources', resource)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                url = f'https://thintrust.com/release/{self.distro_release}/resources/{resource}'
+                self.logger.debug(f'Fetching {url}')
+                response = requests.get(url)
+                response.raise_for_status()
+                with open(path, 'wb') as f:
+                    f.write(response.content)
+            for config_file in CONFIG_FILES:
+                path = os.path.join(bundle_dir, 'config', os.path.basename(config_file))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                shutil.copy2(config_file, path)
+            manifest = self.hashtools.build_manifest(bundle_dir)
+            manifest.update({
+                'distro_release': self.distro_release,
+                'created': datetime.now().timestamp(),
+                'packages': packages,
+            })
+            self.hashtools.save_manifest(manifest, os.path.join(bundle_dir, 'manifest.json'))
+            self.logger.info(f"Bundle contains {len(manifest['files'])} files, compressing...")
+            if os.path.exists(destination):
+                os.remove(destination)
+            if not SevenZip(logger=self.logger).compress(bundle_dir, destination):
+                self.logger.error('Error compressing provisioning bundle.')
+                return False
+            self.logger.info(f'Provisioning bundle written to {destination}')
+            return True
+        except Exception as e:
+            self.logger.error(f'Error building provisioning bundle: {e}')
+            return False
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def _download_packages(self, packages, debs_dir):
+        """
+        Downloads the .deb files of the packages and all of their dependencies.
+
+        The dependency closure is resolved with apt-cache, so the bundle can be installed on a machine that does not
+        have any of the packages yet. Recommends and suggests are left out as apt-get install does not pull them in
+        offline either.
+
+        Args:
+            packages (list): The packages to download.
+            debs_dir (str): The directory to download the .deb files to.
+
+        Returns:
+            bool: True if the packages are downloaded successfully, False otherwise.
+        """
+        try:
+            output = subprocess.check_output(['apt-cache', 'depends', '--recurse', '--no-recommends', '--no-suggests',
+                                              '--no-conflicts', '--no-breaks', '--no-replaces', '--no-enhances',
+                                              *packages], stderr=subprocess.DEVNULL).decode('utf-8')
+            # Package names start at the beginning of the line, virtual packages are wrapped in <>
+            closure = sorted({line.strip() for line in output.splitlines()
+                              if line and not line[0].isspace() and not line.startswith('<')})
+            self.logger.info(f'Downloading {len(closure)} packages...')
+            subprocess.check_output(['apt-get', 'download', *closure], cwd=debs_dir, stderr=subprocess.STDOUT)
+            return True
+        except subprocess.CalledProcessError as e:
+            self.logger.error(f"Error downloading packages: {e.output.decode('utf-8', errors='replace') if e.output else e}")
+            return False
+
+    def open(self, source):
+        """
+        Extracts a bundle archive, or uses an extracted bundle directory, and verifies it.
+
+        Args:
+            source (str): The path of a bundle archive or of an extracted bundle directory.
+
+        Returns:
+            str: The path of the verified bundle directory, or None if the bundle is missing or invalid.
+        """
+        self.cleanup()
+        if os.path.isdir(source):
+            bundle_dir = source
+        elif os.path.isfile(source):
+            self.logger.info(f'Extracting provisioning bundle {source}...')
+            self.extract_dir = tempfile.mkdtemp(prefix='thintrust-bundle-')
+            try:
+                extracted = SevenZip(logger=self.logger).decompress(source, self.extract_dir)
+            except Exception as e:
+                self.logger.error(f'Error extracting provisioning bundle: {e}')
+                extracted = False
+            if not extracted:
+                self.logger.error('Error extracting provisioning bundle.')
+                self.cleanup()
+                return None
+            bundle_dir = os.path.join(self.extract_dir, BUNDLE_NAME)
+        else:
+            self.logger.error(f'Provisioning bundle {source} not found.')
+            return None
+        if not self.verify(bundle_dir):
+            self.cleanup()
+            return None
+        return bundle_dir
+
+    def verify(self, bundle_dir):
+        """
+        Verifies the files of an extracted bundle against its manifest.
+
+        Args:
+            bundle_dir (str): The path of the extracted bundle directory.
+
+        Returns:
+            bool: True if every file in the manifest exists and has the expected size and hash, False otherwise.
+        """
+        try:
+            manifest = self.hashtools.load_manifest(os.path.join(bundle_dir, 'manifest.json'))
+        except Exception as e:
+            self.logger.error(f'Error loading bundle manifest: {e}')
+            return False
+        if manifest.get('distro_release') != self.distro_release:
+            self.logger.error(f"Bundle was built for {manifest.get('distro_release')}, not {self.distro_release}.")
+            return False
+        mismatches = self.hashtools.verify_manifest(bundle_dir, manifest, fail_fast=True)
+        if mismatches:
+            self.logger.error(f"Bundle file {mismatches[0]['path']} is corrupted ({mismatches[0]['reason']} mismatch).")
+            return False
+        self.logger.info(f"Provisioning bundle verified ({len(manifest['files'])} files).")
+        return True
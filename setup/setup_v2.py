@@ -5,25 +5,35 @@ import shutil
 import subprocess
 import requests
 
+from setup.bundle import ProvisioningBundle
 from utils.sevenzip import SevenZip
 
+# Packages required by the setup steps on top of the initial and rebrand packages
+SETUP_PACKAGES = ['overlayroot', 'p7zip-full']
+
 class InitialSetup():
     """
     Class representing the initial setup of the ThinTrust system.
 
     Attributes:
         setup_config (dict): Configuration data for the setup.
-        sevenzip (SevenZip): Instance of the SevenZip class for handling 7zip operations.
+        sevenzip (SevenZip): Instance of the SevenZip class for handling 7zip operations, created once the packages are installed.
         rebrand_status (dict): Status of the rebranding process.
+        bundle (str): Path of an offline provisioning bundle archive or directory, or None to use the network.
+        bundle_dir (str): Path of the verified, extracted provisioning bundle once run() opened it.
+        plan (PackagePlan): The packages installed by install_packages, reused by the later setup steps.
 
     Methods:
         __init__(): Initializes the InitialSetup object.
         sanity_check(): Performs a sanity check on the system.
+        install_packages(): Installs every package required by the setup in a single apt transaction.
+        require_packages(*packages): Makes sure packages are installed, reusing the plan of install_packages.
+        fetch_resource(resource): Gets a release resource from the provisioning bundle or the ThinTrust website.
         setup_overlayroot(): Sets up overlayroot on the system.
         rebrand_os(): Rebrands the operating system.
     """
 
-    def __init__(self, thintrust_class: object):
+    def __init__(self, thintrust_class: object, bundle: str = None):
         """
         Initializes the InitialSetup object.
 
@@ -31,6 +41,7 @@ class InitialSetup():
 
         Args:
             thintrust_class (object): The ThinTrust class.
+            bundle (str): Path of an offline provisioning bundle to install from instead of the network.
 
         Returns:
             None
@@ -41,8 +52,11 @@ class InitialSetup():
                 setattr(self, key, getattr(self.thintrust, key))
         script_dir = os.path.dirname(os.path.abspath(__file__))
         setup_file = f'{script_dir}/setup.json'
-        self.logger.name = 'InitialSetup'
-        self.sevenzip = SevenZip()
+        self.logger = self.thintrust.logger.getChild('InitialSetup') # Logs through the ThinTrust handlers
+        self.sevenzip = None
+        self.bundle = bundle
+        self.bundle_dir = None
+        self.plan = None
         if os.path.exists(setup_file):
             with open(setup_file, 'r') as f:
                 self.setup_config = json.load(f)
@@ -56,6 +70,23 @@ class InitialSetup():
 
     def run(self):
         self.logger.info(f'Starting initial setup of ThinTrust GNU/Linux {self.distro_version} {self.distro_release.capitalize()}...')
+        # The extracted bundle is removed once the setup ends, whether it succeeded or not
+        with ProvisioningBundle(self.logger, self.distro_release) as bundle:
+            if self.bundle:
+                self.bundle_dir = bundle.open(self.bundle)
+                if not self.bundle_dir:
+                    self.logger.error(f'Error opening provisioning bundle {self.bundle}.')
+                    exit(1)
+            try:
+                self._run()
+            finally:
+                self.bundle_dir = None
+
+    def _run(self):
+        if not self.install_packages():
+            self.logger.error('Error installing required packages. Try installing them manually and running ThinTrust again.')
+            exit(1)
+        self.sevenzip = SevenZip(logger=self.logger)
         if not self.setup_overlayroot():
             self.logger.error('Error setting up overlayroot.')
             exit(1)
@@ -94,12 +125,69 @@ class InitialSetup():
             self.logger.error('A minimum disk size of 32gb required.')
             return {'error': 'Insufficient disk space'}
         return True
+
+    def install_packages(self):
+        """
+        Installs every package required by the setup in a single apt transaction.
+
+        This method collects the initial packages from the ThinTrust config, overlayroot, the 7zip binary and the
+        rebrand packages into one PackagePlan, so apt only reads the package cache and takes the dpkg lock once.
+        Packages that are already installed are skipped. With a provisioning bundle the packages are installed from
+        the .deb files in the bundle without touching the network.
+
+        Args:
+            None
+
+        Returns:
+            bool: True if all packages are installed successfully, False otherwise.
+        """
+        self.logger.info('Installing required packages...')
+        self.plan = self.package_plan(*SETUP_PACKAGES, *self.setup_config['rebrand_os_packages'])
+        return self.plan.run(archives=os.path.join(self.bundle_dir, 'debs') if self.bundle_dir else None)
+
+    def require_packages(self, *packages):
+        """
+        Makes sure packages are installed, reusing the plan of install_packages.
+
+        The packages that are part of the plan were installed by install_packages, as the setup stops when it fails,
+        so they are not looked up again. Only the packages missing from the plan are added to it and installed.
+
+        Args:
+            *packages (str): The names of the packages the setup step needs.
+
+        Returns:
+            bool: True if the packages are installed, False otherwise.
+        """
+        if self.plan is None:
+            self.plan = self.package_plan()
+        missing = [package for package in packages if package not in self.plan.packages]
+        if not missing:
+            return True
+        return self.plan.add(*missing).run(update=False)
+
+    def fetch_resource(self, resource):
+        """
+        Gets a release resource from the provisioning bundle or the ThinTrust website.
+
+        Args:
+            resource (str): The path of the resource relative to the release resources, e.g. wallpapers/wallpaper.png.
+
+        Returns:
+            bytes: The content of the resource.
+        """
+        if self.bundle_dir:
+            self.logger.debug(f'Loading {resource} from provisioning bundle')
+            with open(os.path.join(self.bundle_dir, 'resources', resource), 'rb') as f:
+                return f.read()
+        self.logger.debug(f'Fetching {resource} from https://thintrust.com/release/{self.distro_release}/resources/{resource}')
+        return requests.get(f'https://thintrust.com/release/{self.distro_release}/resources/{resource}').content
     
     def setup_overlayroot(self):
         """
         Sets up overlayroot on the system.
 
-        This method installs overlayroot if it is not already installed.
+        This method installs overlayroot if it is not already installed. It is normally installed by install_packages,
+        in which case neither dpkg nor apt is run again.
 
         Args:
             None
@@ -108,16 +196,11 @@ class InitialSetup():
             bool: True if overlayroot is set up successfully, False otherwise.
         """
         self.logger.info('Setting up overlayroot...')
-        try:
-            result = subprocess.check_output('apt-get install -y overlayroot', shell=True)
-            if 'overlayroot is already the newest version' in result.decode('utf-8'):
-                self.logger.info('Overlayroot already installed, skipping...')
-                return True
-            self.logger.info('Overlayroot installation completed.')
-            return True
-        except Exception as e:
-            self.logger.error(f'Error setting up overlayroot: {e}')
+        if not self.require_packages('overlayroot'):
+            self.logger.error('Error setting up overlayroot.')
             return False
+        self.logger.info('Overlayroot installation completed.')
+        return True
     
     def set_hostname(self):
         """
@@ -160,7 +243,8 @@ class InitialSetup():
             """
             Installs the rebrand packages.
 
-            This method installs the rebrand packages specified in the setup configuration.
+            This method installs the rebrand packages specified in the setup configuration that are not installed yet.
+            They are normally installed by install_packages already, in which case neither dpkg nor apt is run again.
 
             Args:
                 None
@@ -168,19 +252,10 @@ class InitialSetup():
             Returns:
                 bool: True if the packages are installed successfully, False otherwise.
             """
-            try:
-                packages = self.setup_config['rebrand_os_packages']
-                self.logger.info('Installing rebrand packages...')
-                self.logger.debug(f'Installing rebrand packages: {packages}')
-                process = subprocess.Popen(f'apt-get install -y {" ".join(packages)}', shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                for line in iter(process.stdout.readline, b''):
-                    self.logger.debug(line.decode().strip())
-                process.stdout.close()
-                process.wait()
-                return process.returncode == 0
-            except Exception as e:
-                self.logger.error(f'Error installing rebrand packages: {e}')
-                return False
+            packages = self.setup_config['rebrand_os_packages']
+            self.logger.info('Installing rebrand packages...')
+            self.logger.debug(f'Installing rebrand packages: {packages}')
+            return self.require_packages(*packages)
             
         def change_issue(self):
             """
@@ -299,12 +374,12 @@ class InitialSetup():
                 if os.path.exists('/usr/share/plymouth/themes/thintrust'):
                     shutil.rmtree('/usr/share/plymouth/themes/thintrust')
                 os.makedirs('/usr/share/plymouth/themes/thintrust')
-                if not os.path.exists('plymouththeme.7z'):
-                    with open('plymouththeme.7z', 'wb') as f:
-                        self.logger.debug(f'Fetching theme from https://thintrust.com/release/{self.distro_release}/resources/plymouththeme.7z')
-                        f.write(requests.get(f'https://thintrust.com/release/{self.distro_release}/resources/plymouththeme.7z').content)
+                theme_archive = os.path.join(self.bundle_dir, 'resources', 'plymouththeme.7z') if self.bundle_dir else 'plymouththeme.7z'
+                if not os.path.exists(theme_archive):
+                    with open(theme_archive, 'wb') as f:
+                        f.write(self.fetch_resource('plymouththeme.7z'))
                     self.logger.debug('Theme downloaded, decompressing...')
-                self.sevenzip.decompress('plymouththeme.7z', '/usr/share/plymouth/themes/')
+                self.sevenzip.decompress(theme_archive, '/usr/share/plymouth/themes/')
                 self.logger.info('Decompressed theme, please wait as it is set as the default theme)')
                 self.logger.debug('Decompressed theme, setting as default theme (Note: This may take a few seconds as it regenerates the initramfs)')
                 subprocess.check_output('plymouth-set-default-theme -R thintrust', shell=True)
@@ -328,7 +403,7 @@ class InitialSetup():
             blkid = subprocess.check_output('blkid -s UUID -o value /dev/sda2', shell=True).decode('utf-8').strip()
             try:
                 with open('/boot/grub/thintrust.png', 'wb') as f:
-                    f.write(requests.get(f'https://thintrust.com/release/{self.distro_release}/resources/wallpapers/wallpapernologo.png').content)
+                    f.write(self.fetch_resource('wallpapers/wallpapernologo.png'))
                 with open('/etc/grub.d/40_custom', 'w') as f:
                     f.write("#!/bin/sh\n"
                         "exec tail -n +3 $0\n"
@@ -425,10 +500,11 @@ class InitialSetup():
             if not os.path.exists('/usr/share/wallpapers'):
                 os.makedirs('/usr/share/wallpapers')
             with open('/usr/share/wallpapers/wallpaper.svg', 'wb') as f:
-                f.write(requests.get(f'https://thintrust.com/release/{self.distro_release}/resources/wallpapers/wallpaper.svg').content)
+                f.write(self.fetch_resource('wallpapers/wallpaper.svg'))
             try:
                 os.chmod('/usr/share/wallpapers/wallpaper.svg', 0o644)
-                subprocess.check_output('cp setup/default_theme.sh /usr/local/etc/', shell=True)
+                theme_script = os.path.join(self.bundle_dir, 'config', 'default_theme.sh') if self.bundle_dir else 'setup/default_theme.sh'
+                shutil.copy(theme_script, '/usr/local/etc/default_theme.sh')
                 os.chmod('/usr/local/etc/default_theme.sh', 0o755)
                 os.chown('/usr/local/etc/default_theme.sh', 1000, 1000)
                 if not os.path.exists('/home/user/.config/autostart'):
@@ -471,7 +547,7 @@ class InitialSetup():
             """
             try:
                 with open('/usr/share/wallpapers/wallpaper.png', 'wb') as f:
-                    f.write(requests.get(f'https://thintrust.com/release/{self.distro_release}/resources/wallpapers/wallpaper.png').content)
+                    f.write(self.fetch_resource('wallpapers/wallpaper.png'))
                 os.chmod('/usr/share/wallpapers/wallpaper.png', 0o644)
                 if not os.path.exists('/etc/lightdm/lightdm-gtk-greeter.conf.d'):
                     os.makedirs('/etc/lightdm/lightdm-gtk-greeter.conf.d')
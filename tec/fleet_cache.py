@@ -0,0 +1,181 @@
+import threading
+import time
+
+# The columns the cache holds, read straight from the database without building ORM objects
+CACHED_COLUMNS = ('id', 'hostname', 'status', 'last_seen', 'ips')
+
+
+def primary_ip(ips):
+    """
+    Get the address a client is reached on.
+
+    Args:
+        ips (list): The addresses of the client, as reported by SystemProfiler.get_ips.
+
+    Returns:
+        str: The first address that is not a loopback or link-local address, the first address if there is none, or
+        None without addresses.
+    """
+    if not ips:
+        return None
+    for ip in ips:
+        if not ip.startswith(('127.', '169.254.', '::1', 'fe80:')):
+            return ip
+    return ips[0]
+
+
+class ClientRecord:
+    """
+    The hot fields of a client, kept in memory by FleetCache.
+
+    The record uses __slots__, so it has no per-instance dictionary and costs a fraction of a thinclients ORM object,
+    which also carries its JSON columns and SQLAlchemy state.
+
+    Attributes:
+        id (str): The client ID.
+        hostname (str): The hostname of the client.
+        status (str): The status of the client.
+        last_seen (float): The timestamp of the last successful poll.
+        primary_ip (str): The address the client is reached on.
+    """
+    __slots__ = ('id', 'hostname', 'status', 'last_seen', 'primary_ip')
+
+    def __init__(self, id, hostname=None, status=None, last_seen=None, primary_ip=None):
+        self.id = id
+        self.hostname = hostname
+        self.status = status
+        self.last_seen = last_seen
+        self.primary_ip = primary_ip
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f'ClientRecord({self.id!r}, {self.hostname!r}, {self.status!r}, {self.last_seen!r}, {self.primary_ip!r})'
+
+
+class FleetCache:
+    """
+    An in-memory view of the fleet for status queries and polling schedules.
+
+    The cache is filled once from the thinclients table with a column query, then kept in sync by the server on every
+    write, so reading the state of the whole fleet never loads the JSON columns or builds ORM objects.
+
+    Example:
+        fleet = FleetCache()
+        fleet.load(session, thinclients)
+        fleet.update(client_id, system_info)  # After writing system_info to the database
+        fleet.status_counts()  # {'online': 49712, 'offline': 288}
+
+    Attributes:
+        records (dict): The ClientRecord of each client, by client ID.
+
+    Methods:
+        load(session, model) -> int: Fills the cache from the database.
+        update(client_id, fields) -> ClientRecord: Applies the fields written to the database for a client.
+        remove(client_id): Removes a client.
+        get(client_id) -> ClientRecord: Gets the record of a client.
+        status_counts(offline_after, now) -> dict: Counts the clients by status.
+        stale(max_age, now) -> list: Lists the clients not seen for a while, for the polling schedule.
+    """
+
+    def __init__(self):
+        self.records = {}
+        self._lock = threading.Lock()
+
+    def load(self, session, model):
+        """
+        Fill the cache from the database, replacing its content.
+
+        Args:
+            session (sqlalchemy.orm.Session): The database session.
+            model (type): The thinclients model.
+
+        Returns:
+            int: The number of clients loaded.
+        """
+        rows = session.query(*(getattr(model, column) for column in CACHED_COLUMNS))
+        records = {client_id: ClientRecord(client_id, hostname, status, last_seen, primary_ip(ips))
+                   for client_id, hostname, status, last_seen, ips in rows.yield_per(1000)}
+        with self._lock:
+            self.records = records
+        return len(records)
+
+    def update(self, client_id, fields):
+        """
+        Apply the fields written to the database for a client, adding the client if it is new.
+
+        Args:
+            client_id (str): The client ID.
+            fields (dict): The columns written, the fields the cache does not hold are ignored.
+
+        Returns:
+            ClientRecord: The record of the client.
+        """
+        with self._lock:
+            record = self.records.get(client_id)
+            if record is None:
+                record = self.records[client_id] = ClientRecord(client_id)
+            if 'hostname' in fields:
+                record.hostname = fields['hostname']
+            if 'status' in fields:
+                record.status = fields['status']
+            if 'last_seen' in fields:
+                record.last_seen = fields['last_seen']
+            if 'ips' in fields:
+                record.primary_ip = primary_ip(fields['ips'])
+            return record
+
+    def remove(self, client_id):
+        with self._lock:
+            self.records.pop(client_id, None)
+
+    def get(self, client_id):
+        return self.records.get(client_id)
+
+    def __contains__(self, client_id):
+        return client_id in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self.records.values()))
+
+    def status_counts(self, offline_after=None, now=None):
+        """
+        Count the clients by status.
+
+        Args:
+            offline_after (float): The time in seconds since the last successful poll after which an online client is
+                counted as offline. The default value is None, the stored status is counted as is.
+            now (float): The current timestamp. The default value is the current time.
+
+        Returns:
+            dict: The number of clients of each status, 'unknown' for clients without one.
+        """
+        cutoff = (now if now is not None else time.time()) - offline_after if offline_after is not None else None
+        counts = {}
+        for record in self:
+            status = record.status or 'unknown'
+            if status == 'online' and cutoff is not None and (record.last_seen or 0) < cutoff:
+                status = 'offline'  # Not polled successfully for too long, whatever the last poll stored
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    def stale(self, max_age, now=None):
+        """
+        List the clients not seen for a while, such as the clients due for a poll.
+
+        Args:
+            max_age (float): The time in seconds since the last successful poll after which a client is stale.
+            now (float): The current timestamp. The default value is the current time.
+
+        Returns:
+            list: The ClientRecord of the stale clients, the longest unseen first. Clients never seen come first.
+        """
+        cutoff = (now if now is not None else time.time()) - max_age
+        stale = [record for record in self if record.last_seen is None or record.last_seen < cutoff]
+        stale.sort(key=lambda record: record.last_seen or 0)
+        return stale
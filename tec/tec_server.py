@@ -1,16 +1,41 @@
+import base64
 import json
 import asyncio
 import os
+import time
+import zlib
 import websockets
+from websockets.protocol import State
 from datetime import datetime
 
 from fastapi import FastAPI, WebSocket
-from sqlalchemy.orm import Session, sessionmaker, declarative_base
-from sqlalchemy import create_engine, Column, Integer, String, JSON, DateTime, inspect, Float
-from utils.logger import Logger
+from sqlalchemy.orm import Session, sessionmaker, declarative_base, scoped_session
+from sqlalchemy import create_engine, Column, Integer, String, JSON, DateTime, inspect, Float, LargeBinary, Index, text
+from utils.logger import Logger, Payload, elapsed_ms
+from utils.metrics import MetricsRegistry, MetricsServer, message_bytes
+from utils.profiling import Profiler
+from utils.ws_options import ChannelOptions
+from utils.tls import client_context
+from tec.fleet_cache import FleetCache
 
 Base = declarative_base()
 
+METRICS = MetricsRegistry()
+POLLS_STARTED = METRICS.counter('thintrust_polls_started_total', 'Client polls started.')
+POLLS_SUCCEEDED = METRICS.counter('thintrust_polls_succeeded_total', 'Client polls that completed.')
+POLLS_FAILED = METRICS.counter('thintrust_polls_failed_total', 'Client polls that failed or were refused.')
+POLL_SECONDS = METRICS.histogram('thintrust_poll_seconds', 'Duration of client polls.')
+POLL_PHASE_SECONDS = METRICS.histogram('thintrust_poll_phase_seconds', 'Duration of each phase of client polls.')
+DB_COMMIT_SECONDS = METRICS.histogram('thintrust_db_commit_seconds', 'Duration of database commits.')
+WEBSOCKET_BYTES = METRICS.counter('thintrust_websocket_bytes_total', 'Websocket message bytes, by direction.')
+ACTIVE_CONNECTIONS = METRICS.gauge('thintrust_active_connections', 'Open websocket connections.')
+# Clients not polled successfully for this long are counted as offline, in seconds, unless offline_after is configured
+OFFLINE_AFTER = 15 * 60
+# Usage samples older than this are deleted, in days, unless sample_retention_days is configured
+SAMPLE_RETENTION_DAYS = 30
+# The time between two rounds of polls, in seconds, unless poll_interval is configured
+POLL_INTERVAL = 60
+
 class thinclients(Base):
     __tablename__ = 'thinclients'
     id = Column(String, primary_key=True)
@@ -28,10 +53,102 @@ class thinclients(Base):
     last_seen = Column(Float)
     status = Column(String)
     last_settings_update = Column(Float)
+    integrity = Column(JSON)
+    log_position = Column(JSON)
+    sample_position = Column(JSON)
+    _column_keys = None
     
     def to_dict(self):
-        return {
-            c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs}
+        if thinclients._column_keys is None:
+            # The columns never change, inspect the mapper once instead of on every call
+            thinclients._column_keys = tuple(c.key for c in inspect(self).mapper.column_attrs)
+        return {key: getattr(self, key) for key in thinclients._column_keys}
+
+
+class client_logs(Base):
+    # Log lines forwarded by the agents, stored as the zlib compressed batches they were sent in
+    __tablename__ = 'client_logs'
+    id = Column(Integer, primary_key=True)
+    client_id = Column(String)
+    start_time = Column(Float)
+    end_time = Column(Float)
+    lines = Column(Integer)
+    data = Column(LargeBinary)
+    __table_args__ = (Index('ix_client_logs_client_time', 'client_id', 'start_time', 'end_time'),)
+
+
+class client_samples(Base):
+    # Usage samples taken by the agents between polls, one row per sample. lost is the number of samples overwritten
+    # on the agent before they were fetched, just before this one, or None without a gap.
+    __tablename__ = 'client_samples'
+    id = Column(Integer, primary_key=True)
+    client_id = Column(String)
+    seq = Column(Integer)
+    time = Column(Float)
+    values = Column(JSON)
+    lost = Column(Integer)
+    __table_args__ = (Index('ix_client_samples_client_time', 'client_id', 'time'),)
+
+
+# Columns added to the tables of released versions, which create_all does not add to existing databases
+ADDED_COLUMNS = {
+    'thinclients': ('integrity', 'log_position', 'sample_position'),
+}
+
+
+def upgrade_schema(engine):
+    """
+    Add the columns of ADDED_COLUMNS missing from the existing tables.
+
+    create_all only creates the missing tables, so a database created by an older version lacks the columns added to
+    the models since. They are added as nullable columns, which the code already handles as not polled yet.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): The engine of the database.
+
+    Returns:
+        list: The added columns, as table.column.
+    """
+    added = []
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as connection:
+        for table_name, column_names in ADDED_COLUMNS.items():
+            if not inspector.has_table(table_name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table_name)}
+            for name in column_names:
+                if name not in existing:
+                    column_type = Base.metadata.tables[table_name].columns[name].type.compile(dialect=engine.dialect)
+                    connection.execute(text(f'ALTER TABLE {quote(table_name)} ADD COLUMN {quote(name)} {column_type}'))
+                    added.append(f'{table_name}.{name}')
+    return added
+
+
+def current_task():
+    # The scope of the database sessions: each poll runs in its own task, code outside the event loop shares one
+    try:
+        return asyncio.current_task()
+    except RuntimeError:
+        return None
+
+
+def parse_log_time(line):
+    """
+    Get the timestamp of a log line, in the plain text or the structured format of Logger.
+
+    Args:
+        line (str): The log line.
+
+    Returns:
+        float: The timestamp of the line, or None for lines without one, such as traceback lines.
+    """
+    try:
+        if line.startswith('{'):
+            line = json.loads(line)['time']
+        return datetime.strptime(line[:23], '%Y-%m-%d %H:%M:%S,%f').timestamp()
+    except (ValueError, KeyError, TypeError):
+        return None
 
 class TECServer(Logger):
     def __init__(self):
@@ -42,59 +159,490 @@ class TECServer(Logger):
         else:
             with open(config_path, 'r') as f:
                 self.config = json.load(f)
-        super().__init__(self.__class__.__name__, 'tec_server.log', self.config['log_level'])
+        super().__init__(self.__class__.__name__, 'tec_server.log', self.config['log_level'],
+                         async_logging=self.config.get('async_logging', True),
+                         structured=self.config.get('structured_logging', False),
+                         rotation=self.config.get('log_rotation', 'size'), compression=self.config.get('log_compression'),
+                         budget_bytes=self.config.get('log_budget_bytes'))
         self.engine = create_engine('sqlite:///tec_server.db')
+        for column in upgrade_schema(self.engine):
+            self.logger.info(f'Added column {column} to the database.')
         Base.metadata.create_all(self.engine)
         self.Session = sessionmaker(bind=self.engine)
-        self.session = self.Session()
+        # Concurrent polls must not commit or roll back each other's changes, each task gets its own session. No
+        # transaction is kept open while waiting for a client, so the sessions never wait for each other's connection.
+        self.session = scoped_session(self.Session, scopefunc=current_task)
+        self.fleet = FleetCache()
+        self.logger.info(f'Loaded {self.fleet.load(self.session, thinclients)} clients in the fleet cache.')
         #self.api = FastAPI()
         #self.api.add_websocket_route('/ws', self.websocket_handler)
-        self.websocket = None
+        self.profiler = Profiler(self.logger, 'tec_server')
+        self.channel_options = ChannelOptions.from_settings(self.config)
+        self.ssl_context = None
+        if self.config.get('tls_ca'):
+            # wss connections verify the agents with the local CA, and present a certificate if one is set
+            self.ssl_context = client_context(self.config['tls_ca'], self.config.get('tls_cert'),
+                                              self.config.get('tls_key'))
+        self.protocol = 'wss' if self.ssl_context is not None else 'ws'
+        self.integrity_public_key = None
+        if self.config.get('integrity_public_key'):
+            # Made with 'python -m agent.integrity keygen', the private key stays where the baselines are built
+            try:
+                with open(self.config['integrity_public_key'], 'r') as f:
+                    self.integrity_public_key = f.read()
+            except OSError as e:
+                self.logger.error(f'Error loading the integrity public key: {e}')
+            if self.integrity_public_key and '-----BEGIN PUBLIC KEY-----' not in self.integrity_public_key:
+                self.logger.error(f"{self.config['integrity_public_key']} is not a PEM public key, not sending it.")
+                self.integrity_public_key = None
+        self.keep_alive = self.config.get('keep_alive', False)
+        self.connections = {}
         
     async def connect_to_client(self, protocol, client_ip, client_port):
         self.logger.info(f'Connecting to client @ {protocol}://{client_ip}:{client_port}')
         uri = f'{protocol}://{client_ip}:{client_port}'
-        self.websocket = await websockets.connect(uri)
+        if protocol == 'wss' and self.ssl_context is not None:
+            return await websockets.connect(uri, ssl=self.ssl_context, **self.channel_options.client_kwargs())
+        return await websockets.connect(uri, **self.channel_options.client_kwargs())
         
-    async def send_data(self, data):
-        await self.websocket.send(data)
+    async def send_data(self, websocket, data):
+        WEBSOCKET_BYTES.inc(message_bytes(data), direction='out')
+        await websocket.send(data)
     
-    async def receive_data(self):
-        return await self.websocket.recv()
+    async def receive_data(self, websocket):
+        data = await websocket.recv()
+        WEBSOCKET_BYTES.inc(message_bytes(data), direction='in')
+        return data
+
+    def commit(self):
+        with DB_COMMIT_SECONDS.time():
+            self.session.commit()
     
-    async def poll_client(self, protocol, ip, port):
-        await self.connect_to_client(protocol, ip, port)
-        await self.send_data(json.dumps({'message': 'client_id?'}))
-        client_id = json.loads(await self.receive_data())['client_id']
-        self.logger.debug(f"Client ID: {client_id}")
-        await self.send_data(json.dumps({'message': 'OK'}))
-        response = await self.receive_data()
-        if json.loads(response) == {'message': 'OK'}:
-            await self.send_data(json.dumps({'message': 'system_info?'}))
-            response = await self.receive_data()
-            self.logger.debug(f'System Info: {response}')
+    async def poll_client(self, protocol, ip, port, keep_alive=None):
+        # Each poll has its own connection, so several clients can be polled concurrently. With keep_alive, the
+        # connection is kept open for the next poll of the client, which then skips the TCP and TLS handshakes.
+        keep_alive = self.keep_alive if keep_alive is None else keep_alive
+        start = time.perf_counter()
+        POLLS_STARTED.inc()
+        polled = False
+        key = (protocol, ip, str(port))
+        try:
+            websocket = self.connections.pop(key, None)
+            if websocket is not None and websocket.state is not State.OPEN:
+                # The client closed the kept-alive connection since the last poll
+                ACTIVE_CONNECTIONS.dec()
+                await websocket.close()
+                websocket = None
+            if websocket is None:
+                websocket = await self.connect_to_client(protocol, ip, port)
+                ACTIVE_CONNECTIONS.inc()
+            keep = False
+            try:
+                polled = await self._poll_client(websocket, start, close=not keep_alive)
+                self.remember_session(ip, websocket)
+                keep = keep_alive and polled
+            finally:
+                if keep:
+                    self.connections[key] = websocket
+                else:
+                    ACTIVE_CONNECTIONS.dec()
+                    await websocket.close()
+                    self.logger.info('Connection closed.')
+            return polled
+        finally:
+            self.session.remove()
+            (POLLS_SUCCEEDED if polled else POLLS_FAILED).inc()
+            POLL_SECONDS.observe(time.perf_counter() - start)
+
+    def remember_session(self, ip, websocket):
+        # Keep the TLS session of the client, so the next connection to it resumes the session
+        if self.ssl_context is not None:
+            self.ssl_context.remember(ip, websocket.transport.get_extra_info('ssl_object'))
+
+    async def close_connections(self):
+        connections, self.connections = self.connections, {}
+        for websocket in connections.values():
+            ACTIVE_CONNECTIONS.dec()
+            await websocket.close()
+
+    async def _poll_client(self, websocket, start, close=True):
+        await self.send_data(websocket, json.dumps({'message': 'client_id?'}))
+        client_id = json.loads(await self.receive_data(websocket))['client_id']
+        self.logger.debug('Client ID: %s', client_id, extra={'client_id': client_id, 'step': 'connect',
+                                                              'duration_ms': self._phase('connect', start)})
+        await self.send_data(websocket, json.dumps({'message': 'OK'}))
+        response = await self.receive_data(websocket)
+        polled = json.loads(response) == {'message': 'OK'}
+        if polled:
+            start = time.perf_counter()
+            await self.send_data(websocket, json.dumps({'message': 'system_info?'}))
+            response = await self.receive_data(websocket)
+            self.logger.debug('System Info: %s', Payload(response), extra={'client_id': client_id, 'step': 'system_info',
+                                                                           'duration_ms': self._phase('system_info', start)})
             system_info = json.loads(response)
+            system_info['status'] = 'online'
+            # Everything the poll writes is gathered first and committed once at the end
+            log_position, sample_position = self.positions(client_id)
+            start = time.perf_counter()
+            system_info['integrity'] = await self.poll_integrity(websocket, client_id)
+            self._phase('integrity', start)
+            start = time.perf_counter()
+            logs, system_info['log_position'] = await self.poll_logs(websocket, client_id, log_position)
+            self._phase('logs', start)
+            start = time.perf_counter()
+            samples, system_info['sample_position'] = await self.poll_samples(websocket, client_id, sample_position)
+            self._phase('samples', start)
+            start = time.perf_counter()
             system_info['last_seen'] = datetime.now().timestamp()
-            if self.session.query(thinclients).filter_by(id=client_id).first():
-                self.session.query(thinclients).filter_by(id=client_id).update(system_info)
-                self.session.commit()
-                self.logger.info(f'System info updated in database for client {client_id}')
-            else:
-                self.session.add(thinclients(id=client_id, **system_info))
-                self.session.commit()
-                self.logger.info(f"System info saved to database for client {client_id}")
-            
+            updated = self.save_poll(client_id, system_info, logs, samples)
+            self.logger.info('System info %s database for client %s', 'updated in' if updated else 'saved to', client_id,
+                             extra={'client_id': client_id, 'step': 'upsert', 'duration_ms': self._phase('upsert', start)})
         else:
             self.logger.error('Error connecting to client.')
-        self.logger.info('Closing connection...')
-        await self.send_data(json.dumps({'message': 'Connection closed.'}))
-        await self.websocket.close()
-        await self.websocket.wait_closed()
-        self.logger.info('Connection closed.')
-                
+        if close:
+            self.logger.info('Closing connection...')
+            await self.send_data(websocket, json.dumps({'message': 'Connection closed.'}))
+        return polled
+
+    async def watch_client(self, protocol, ip, port, on_event=None):
+        """
+        Subscribe to the events of a client and apply them to the database until the connection closes.
+
+        The client sends its profile when the subscription starts, then the new value of each section of the profile
+        that changes, such as its IP addresses or its disks, as the change happens.
+
+        Args:
+            protocol (str): The websocket protocol, ws or wss.
+            ip (str): The address of the client.
+            port (int): The port of the client.
+            on_event (callable): Called with the client ID and each event once it is applied.
+
+        Returns:
+            int: The number of events received.
+        """
+        events = 0
+        websocket = await self.connect_to_client(protocol, ip, port)
+        ACTIVE_CONNECTIONS.inc()
+        try:
+            await self.send_data(websocket, json.dumps({'message': 'subscribe_events'}))
+            subscribed = json.loads(await self.receive_data(websocket))
+            self.remember_session(ip, websocket)
+            client_id = subscribed['client_id']
+            self.upsert_client(client_id, dict(subscribed['profile'], last_seen=datetime.now().timestamp(),
+                                               status='online'))
+            self.logger.info(f'Watching client {client_id} @ {ip}:{port}', extra={'client_id': client_id,
+                                                                                  'step': 'watch'})
+            while True:
+                try:
+                    event = json.loads(await self.receive_data(websocket))
+                except websockets.exceptions.ConnectionClosed:
+                    break
+                events += 1
+                self.logger.info(f"Client {client_id} changed: {event['event']}", extra={'client_id': client_id,
+                                                                                         'step': 'event'})
+                self.upsert_client(client_id, dict(event['data'], last_seen=event['time']))
+                if on_event:
+                    on_event(client_id, event)
+        finally:
+            self.session.remove()
+            ACTIVE_CONNECTIONS.dec()
+            await websocket.close()
+        return events
+
+    @staticmethod
+    def _phase(phase, start):
+        # Records the duration of a poll phase, returned in milliseconds for the log
+        duration = elapsed_ms(start)
+        POLL_PHASE_SECONDS.observe(duration / 1000, phase=phase)
+        return duration
+
+    async def poll_clients(self, clients, concurrency=100, protocol='ws'):
+        """
+        Poll many clients concurrently.
+
+        Args:
+            clients (list): The (ip, port) of each client.
+            concurrency (int): The maximum number of clients polled at the same time. The default value is 100.
+            protocol (str): The websocket protocol, ws or wss.
+
+        Returns:
+            list: One dictionary per client with its ip, port, whether the poll succeeded (ok), the poll duration in
+            seconds and the error, if any.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def poll(ip, port):
+            async with semaphore:
+                start = time.perf_counter()
+                error = None
+                try:
+                    ok = await self.poll_client(protocol, ip, port)
+                except Exception as e:
+                    ok = False
+                    error = str(e) or e.__class__.__name__
+                    self.logger.error(f'Error polling client {ip}:{port}: {error}')
+                return {'ip': ip, 'port': port, 'ok': ok, 'duration': time.perf_counter() - start, 'error': error}
+
+        return await asyncio.gather(*(poll(ip, port) for ip, port in clients))
+
             
+    def upsert_client(self, client_id, system_info, commit=True):
+        # Returns True if the client was already in the database, which the fleet cache knows without a query
+        updated = client_id in self.fleet
+        if updated:
+            self.session.query(thinclients).filter_by(id=client_id).update(system_info)
+        else:
+            self.session.add(thinclients(id=client_id, **system_info))
+        if commit:
+            self.commit()
+            self.fleet.update(client_id, system_info)
+        return updated
+
+    def save_poll(self, client_id, system_info, logs, samples):
+        """
+        Write everything a poll gathered in a single transaction.
+
+        Args:
+            client_id (str): The ID of the client.
+            system_info (dict): The columns of the client, its profile, integrity report and positions included.
+            logs (list): The client_logs rows of the log batches.
+            samples (list): The client_samples rows, as dictionaries.
+
+        Returns:
+            bool: True if the client was already in the database.
+        """
+        updated = self.upsert_client(client_id, system_info, commit=False)
+        self.session.add_all(logs)
+        self.session.bulk_insert_mappings(client_samples, samples)
+        # Retention, the samples are only kept for sample_retention_days
+        cutoff = time.time() - self.config.get('sample_retention_days', SAMPLE_RETENTION_DAYS) * 24 * 60 * 60
+        self.session.query(client_samples).filter(client_samples.client_id == client_id,
+                                                  client_samples.time < cutoff).delete(synchronize_session=False)
+        self.commit()
+        self.fleet.update(client_id, system_info)
+        return updated
+
+    def fleet_status(self):
+        """
+        Get the state of the fleet from the fleet cache, without querying the database.
+
+        Returns:
+            dict: The number of clients (total) and the number of clients of each status (statuses). Online clients
+            not seen for offline_after seconds are counted as offline.
+        """
+        return {'total': len(self.fleet),
+                'statuses': self.fleet.status_counts(self.config.get('offline_after', OFFLINE_AFTER))}
+
+    def set_offline(self, client_ids):
+        # Record the clients that could not be polled, their last_seen keeps the time of their last successful poll
+        self.session.query(thinclients).filter(thinclients.id.in_(client_ids)).update({'status': 'offline'},
+                                                                                       synchronize_session=False)
+        self.commit()
+        for client_id in client_ids:
+            self.fleet.update(client_id, {'status': 'offline'})
+
+    async def poll_stale(self, max_age, port=8765, concurrency=100, protocol='ws'):
+        """
+        Poll the clients not seen for a while, as listed by the fleet cache. Clients that cannot be polled are set
+        offline.
+
+        Args:
+            max_age (float): The time in seconds since the last successful poll after which a client is polled.
+            port (int): The port of the agents. The default value is 8765.
+            concurrency (int): The maximum number of clients polled at the same time. The default value is 100.
+            protocol (str): The websocket protocol, ws or wss.
+
+        Returns:
+            list: The results of poll_clients.
+        """
+        records = [record for record in self.fleet.stale(max_age) if record.primary_ip]
+        results = await self.poll_clients([(record.primary_ip, port) for record in records], concurrency, protocol)
+        offline = [record.id for record, result in zip(records, results)
+                   if not result['ok'] and record.status != 'offline']
+        if offline:
+            self.set_offline(offline)
+        return results
+
+    async def poll_integrity(self, websocket, client_id):
+        # Returns the integrity report of the client, the poll saves it
+        await self.send_data(websocket, json.dumps({'message': 'integrity?'}))
+        report = json.loads(await self.receive_data(websocket))
+        if report.get('status') == 'unavailable' and await self.deliver_integrity_key(websocket, client_id):
+            await self.send_data(websocket, json.dumps({'message': 'integrity?'}))
+            report = json.loads(await self.receive_data(websocket))
+        if report.get('status') == 'drift':
+            self.logger.warning(f"Integrity drift on client {client_id}: {len(report['drift'])} files changed, e.g. {report['drift'][:5]}")
+        elif report.get('status') == 'error':
+            self.logger.error(f"Integrity scan failed on client {client_id}: {report.get('error')}")
+        return report
+
+    async def deliver_integrity_key(self, websocket, client_id):
+        """
+        Send the public key of the integrity baselines to a client that does not have it, such as a client that just
+        started.
+
+        The agents keep the key in memory only, so it is not stored on the device next to the baseline it checks, and
+        it is only sent over wss, so it cannot be replaced on the way.
+
+        Args:
+            websocket (websockets.WebSocketClientProtocol): The connection to the client.
+            client_id (str): The ID of the client.
+
+        Returns:
+            bool: True if the client accepted the key.
+        """
+        if not self.integrity_public_key:
+            return False
+        if websocket.transport.get_extra_info('ssl_object') is None:
+            self.logger.warning(f'Not sending the integrity key to client {client_id} without TLS.',
+                                extra={'client_id': client_id, 'step': 'integrity'})
+            return False
+        await self.send_data(websocket, json.dumps({'message': 'integrity_key', 'key': self.integrity_public_key}))
+        response = json.loads(await self.receive_data(websocket))
+        return response.get('message') == 'Integrity key set.'
+
+    def positions(self, client_id):
+        # Read the log and sample positions and end the transaction, it is not held while waiting for the client
+        row = self.session.query(thinclients.log_position, thinclients.sample_position).filter_by(id=client_id).first()
+        self.session.commit()
+        return (row[0] or {}, row[1] or {}) if row else ({}, {})
+
+    async def poll_logs(self, websocket, client_id, position, max_batches=16):
+        # Fetch the agent log from position, where the last poll stopped, at most max_batches batches per poll.
+        # Returns the client_logs rows and the new position, the poll saves them.
+        rows = []
+        for _ in range(max_batches):
+            await self.send_data(websocket, json.dumps({'message': 'logs?', 'segment': position.get('segment'),
+                                                        'offset': position.get('offset', 0)}))
+            batch = json.loads(await self.receive_data(websocket))
+            if 'data' not in batch:
+                self.logger.error(f"Error fetching logs from client {client_id}: {batch.get('message')}")
+                break
+            if batch.get('lost'):
+                self.logger.warning(f"{batch['lost']} log segments of client {client_id} were removed before they were "
+                                    f"fetched, poll it more often or raise its log budget")
+            compressed = base64.b64decode(batch['data'])
+            lines = zlib.decompress(compressed).decode('utf-8', errors='replace').splitlines()
+            if lines:
+                times = [t for t in map(parse_log_time, lines) if t is not None] or [datetime.now().timestamp()]
+                rows.append(client_logs(client_id=client_id, start_time=times[0], end_time=times[-1],
+                                        lines=len(lines), data=compressed))
+            position = {'segment': batch['segment'], 'offset': batch['offset']}
+            if not batch['more']:
+                break
+        return rows, position
+
+    async def poll_samples(self, websocket, client_id, position, max_batches=8):
+        # Fetch the usage samples taken since position, the last one stored, at most max_batches batches per poll.
+        # Returns the client_samples rows, as dictionaries, and the new position, the poll saves them.
+        rows = []
+        for _ in range(max_batches):
+            await self.send_data(websocket, json.dumps({'message': 'samples?', 'ring': position.get('ring'),
+                                                        'since': position.get('seq', 0)}))
+            batch = json.loads(await self.receive_data(websocket))
+            if 'samples' not in batch:
+                self.logger.error(f"Error fetching samples from client {client_id}: {batch.get('message')}")
+                break
+            if batch['lost']:
+                self.logger.warning(f"{batch['lost']} samples of client {client_id} were overwritten before they were "
+                                    f"fetched, poll it more often or raise its sample_capacity")
+            first = batch['seq'] - len(batch['samples']) + 1
+            rows += [{'client_id': client_id, 'seq': first + index, 'time': sample[0],
+                      'values': dict(zip(batch['fields'][1:], sample[1:])),
+                      'lost': batch['lost'] if index == 0 and batch['lost'] else None}
+                     for index, sample in enumerate(batch['samples'])]
+            position = {'ring': batch['ring'], 'seq': batch['seq']}
+            if not batch['more']:
+                break
+        return rows, position
+
+    def get_samples(self, client_id, start=None, end=None):
+        """
+        Get the usage samples of a client.
+
+        Args:
+            client_id (str): The ID of the client.
+            start (float): Only return samples taken at or after this timestamp.
+            end (float): Only return samples taken at or before this timestamp.
+
+        Returns:
+            list: The samples, oldest first, as dictionaries of their time and values. A sample taken after samples
+            that were lost on the agent also has the number of samples missing before it (lost).
+        """
+        query = self.session.query(client_samples.time, client_samples.values, client_samples.lost).filter(
+            client_samples.client_id == client_id)
+        if start is not None:
+            query = query.filter(client_samples.time >= start)
+        if end is not None:
+            query = query.filter(client_samples.time <= end)
+        return [dict(values, time=sample_time, lost=lost) if lost else dict(values, time=sample_time)
+                for sample_time, values, lost in query.order_by(client_samples.time)]
+
+    def search_logs(self, client_id, start=None, end=None, contains=None):
+        """
+        Search the logs forwarded by a client.
+
+        Args:
+            client_id (str): The ID of the client.
+            start (float): Only return lines logged at or after this timestamp.
+            end (float): Only return lines logged at or before this timestamp.
+            contains (str): Only return lines containing this string.
+
+        Returns:
+            list: The matching log lines, oldest first. Lines without a timestamp, such as tracebacks, belong to the
+            line before them.
+        """
+        query = self.session.query(client_logs).filter(client_logs.client_id == client_id)
+        if start is not None:
+            query = query.filter(client_logs.end_time >= start)
+        if end is not None:
+            query = query.filter(client_logs.start_time <= end)
+        matches = []
+        for batch in query.order_by(client_logs.start_time, client_logs.id):
+            line_time = batch.start_time
+            for line in zlib.decompress(batch.data).decode('utf-8', errors='replace').splitlines():
+                line_time = parse_log_time(line) or line_time
+                if start is not None and line_time < start or end is not None and line_time > end:
+                    continue
+                if contains is None or contains in line:
+                    matches.append(line)
+        return matches
+
+    async def poll_loop(self):
+        """
+        Poll the clients every poll_interval seconds, until cancelled.
+
+        Each round polls the agents listed in the clients setting, then the clients of the fleet cache the round did
+        not reach, on agent_port. The polls use wss when tls_ca is set, and keep their connections open for the next
+        round with keep_alive, as long as the idle_timeout of the agents is longer than poll_interval.
+        """
+        interval = float(self.config.get('poll_interval', POLL_INTERVAL))
+        port = self.config.get('agent_port', 8765)
+        clients = self.config.get('clients', ['127.0.0.1'])
+        if self.keep_alive and interval >= self.channel_options.idle_timeout:
+            # Both ends read ws_idle_timeout under the same name, the agents close the connections before the next round
+            self.logger.warning(f'keep_alive needs a ws_idle_timeout longer than poll_interval ({interval}s), the '
+                                f'agents close the connections between polls.')
+        while True:
+            start = time.monotonic()
+            await self.poll_clients([(ip, port) for ip in clients], protocol=self.protocol)
+            await self.poll_stale(interval, port, protocol=self.protocol)
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - start)))
+
+    async def main(self):
+        self.profiler.install_signal_handler()
+        metrics = None
+        if self.config.get('metrics_port'):
+            metrics = await MetricsServer(self.config['metrics_port']).start()
+        try:
+            await self.poll_loop()
+        finally:
+            await self.close_connections()
+            if metrics:
+                await metrics.stop()
+
     def run(self):
-        asyncio.run(self.poll_client('ws', '127.0.0.1', '8765'))
+        asyncio.run(self.main())
     
 if __name__ == '__main__':
     server = TECServer()
@@ -0,0 +1,50 @@
+import asyncio
+import json
+import logging
+
+import pytest
+
+from agent.agent import ThinAgent
+
+
+class FakeWebsocket:
+    # A server connection, with the messages sent to it
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, data):
+        self.sent.append(json.loads(data))
+
+    async def recv(self):
+        await asyncio.Future()  # The server sends nothing more
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture
+def agent(tmp_path, monkeypatch):
+    # The agent keeps its database and its log in the working directory
+    monkeypatch.chdir(tmp_path)
+    return ThinAgent()
+
+
+def test_replies_on_the_connection_of_the_message(agent):
+    first, second = FakeWebsocket(), FakeWebsocket()
+
+    async def run():
+        await agent.route(first, {'message': 'client_id?'})
+        await agent.route(second, {'message': 'integrity?'})
+        await agent.route(first, {'message': 'OK'})
+
+    asyncio.run(run())
+    assert first.sent == [{'client_id': agent.agent_id}, {'message': 'OK'}]
+    assert second.sent == [{'status': 'unavailable'}]
+
+
+def test_idle_connections_are_closed_quietly(agent, caplog):
+    agent.channel_options.idle_timeout = 0.01
+    with caplog.at_level(logging.DEBUG, logger=agent.logger.name):
+        asyncio.run(agent._handle_messages(FakeWebsocket()))
+    assert 'Closing the connection, idle for 0.01s.' in caplog.messages
+    assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
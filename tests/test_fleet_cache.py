@@ -0,0 +1,76 @@
+import time
+import tracemalloc
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from bench.fake_agent import synthetic_profile
+from tec.fleet_cache import FleetCache, primary_ip
+from tec.tec_server import Base, thinclients
+
+CLIENTS = 2000
+
+
+@pytest.fixture
+def session(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "fleet.db"}')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    now = time.time()
+    session.add_all(thinclients(id=f'client-{index:05d}', status='online', last_seen=now - index,
+                                **synthetic_profile(index)) for index in range(CLIENTS))
+    session.commit()
+    session.expunge_all()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def test_primary_ip_skips_loopback_and_link_local_addresses():
+    assert primary_ip(['127.0.0.1', '169.254.3.4', '10.0.0.7']) == '10.0.0.7'
+    assert primary_ip(['127.0.0.1']) == '127.0.0.1'
+    assert primary_ip([]) is None
+
+
+def test_load_and_query(session):
+    fleet = FleetCache()
+    assert fleet.load(session, thinclients) == CLIENTS
+    assert fleet.status_counts() == {'online': CLIENTS}
+    assert [record.id for record in fleet.stale(10)][:1] == [f'client-{CLIENTS - 1:05d}']
+    assert fleet.get('client-00000').hostname == 'thinclient-00000'
+
+
+def test_update_adds_and_changes_records():
+    fleet = FleetCache()
+    fleet.update('new', {'status': 'online', 'ips': ['127.0.0.1', '10.0.0.2'], 'cpu': {'cores': 4}})
+    fleet.update('new', {'status': 'offline'})
+    assert fleet.get('new').to_dict() == {'id': 'new', 'hostname': None, 'status': 'offline', 'last_seen': None,
+                                          'primary_ip': '10.0.0.2'}
+    assert fleet.stale(60)[0].id == 'new'  # Never seen
+    fleet.remove('new')
+    assert 'new' not in fleet
+
+
+def test_cache_is_smaller_than_orm_objects(session):
+    tracemalloc.start()
+    fleet = FleetCache()
+    fleet.load(session, thinclients)
+    cache_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    tracemalloc.start()
+    clients = [client.to_dict() for client in session.query(thinclients)]
+    orm_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(clients) == len(fleet)
+    assert cache_bytes * 5 < orm_bytes, (cache_bytes, orm_bytes)
+
+
+def test_status_counts_clients_not_seen_for_too_long_as_offline():
+    fleet = FleetCache()
+    fleet.update('recent', {'status': 'online', 'last_seen': 990})
+    fleet.update('old', {'status': 'online', 'last_seen': 100})
+    fleet.update('never', {'status': 'online'})
+    fleet.update('down', {'status': 'offline', 'last_seen': 995})
+    assert fleet.status_counts() == {'online': 3, 'offline': 1}
+    assert fleet.status_counts(offline_after=60, now=1000) == {'online': 1, 'offline': 3}
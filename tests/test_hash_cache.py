@@ -0,0 +1,23 @@
+import os
+import time
+
+from utils.hash_cache import HashCache
+from utils.hashtools import HashTools
+
+
+def test_file_with_its_mtime_restored_is_rehashed(tmp_path):
+    path = tmp_path / 'hostname'
+    path.write_text('thin\n')
+    old = time.time() - 60
+    os.utime(path, (old, old))
+    time.sleep(1.1)  # Past the racily clean second of the ctime
+    cache = HashCache(str(tmp_path / 'cache.db'))
+    hashtools = HashTools('sha256', cache=cache)
+    original = hashtools.hash_file(str(path))
+    assert cache.get(os.stat(path), 'sha256') == original
+    # Tampered with, then given its size and mtime back as 'touch -d' would
+    path.write_text('evil\n')
+    os.utime(path, (old, old))
+    assert cache.get(os.stat(path), 'sha256') is None
+    assert hashtools.hash_file(str(path)) != original
+    cache.close()
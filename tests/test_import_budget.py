@@ -0,0 +1,23 @@
+import pytest
+
+from utils.import_budget import COMMANDS, check, parse_importtime
+
+IMPORTTIME = """import time: self [us] | cumulative | imported package
+import time:       100 |        100 |   _io
+import time:       200 |        300 | site
+import time:       500 |        500 |     json.decoder
+import time:       700 |       1200 |   json
+import time:       300 |       1500 | thintrust
+import time:       400 |        400 | argparse
+"""
+
+
+def test_parse_importtime_skips_the_interpreter_startup():
+    total_ms, modules = parse_importtime(IMPORTTIME)
+    assert total_ms == 1.9
+    assert modules == ['json.decoder', 'json', 'thintrust', 'argparse']
+
+
+@pytest.mark.parametrize('arguments', COMMANDS, ids=' '.join)
+def test_command_within_import_budget(arguments):
+    assert check(arguments) == []
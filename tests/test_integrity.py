@@ -0,0 +1,45 @@
+import logging
+import shutil
+
+import pytest
+
+from agent.integrity import IntegrityScanner, generate_signing_key, sign_manifest, verify_manifest
+
+pytestmark = pytest.mark.skipif(not shutil.which('openssl'), reason='openssl is not installed')
+
+
+@pytest.fixture
+def keys(tmp_path):
+    private_key, public_key = str(tmp_path / 'integrity.key'), str(tmp_path / 'integrity.pem')
+    generate_signing_key(private_key, public_key)
+    with open(public_key) as f:
+        return private_key, f.read()
+
+
+def test_signature_is_checked_with_the_public_key(keys):
+    private_key, public_key = keys
+    manifest = {'files': {'etc/hostname': {'size': 5}}}
+    signature = sign_manifest(manifest, private_key)
+    assert verify_manifest(manifest, signature, public_key)
+    assert not verify_manifest({'files': {'etc/hostname': {'size': 6}}}, signature, public_key)
+    assert not verify_manifest(manifest, '', public_key)
+
+
+def test_scan_rejects_a_tampered_baseline(tmp_path, keys):
+    private_key, public_key = keys
+    root = tmp_path / 'root'
+    (root / 'etc').mkdir(parents=True)
+    (root / 'etc' / 'hostname').write_text('thin\n')
+    baseline = str(tmp_path / 'baseline.json')
+    logger = logging.getLogger('test')
+    IntegrityScanner(logger, baseline, root=str(root), cache_path=str(tmp_path / 'cache.db'),
+                     excludes=[]).build_baseline(baseline, private_key)
+    scanner = IntegrityScanner(logger, baseline, public_key, root=str(root), cache_path=str(tmp_path / 'cache.db'),
+                               excludes=[])
+    assert scanner.scan()['status'] == 'clean'
+    with open(baseline) as f:
+        tampered = f.read().replace('"size":5', '"size":6').replace('"size": 5', '"size": 6')
+    with open(baseline, 'w') as f:
+        f.write(tampered)
+    report = scanner.scan()
+    assert report['status'] == 'error' and 'signature' in report['error']
@@ -0,0 +1,117 @@
+import base64
+import gzip
+import os
+import shutil
+import zlib
+
+import pytest
+
+from agent.log_shipper import LogShipper
+
+
+def lines(batch):
+    return zlib.decompress(base64.b64decode(batch['data'])).decode().splitlines()
+
+
+def read_all(shipper, segment=None, offset=0):
+    # Read batches until the shipper has nothing more, as the server does
+    read, lost = [], 0
+    while True:
+        batch = shipper.read_batch(segment, offset)
+        read += lines(batch)
+        lost += batch['lost']
+        segment, offset = batch['segment'], batch['offset']
+        if not batch['more']:
+            return read, lost, segment, offset
+
+
+def write(path, first, count):
+    with open(path, 'a') as f:
+        f.writelines(f'line {number}\n' for number in range(first, first + count))
+
+
+def rotate(path, compression=None):
+    # As RotatingFileHandler with backupCount=5 does, then compress the new segment
+    for index in range(4, 0, -1):
+        for extension in ('', '.gz', '.zst'):
+            if os.path.exists(f'{path}.{index}{extension}'):
+                os.rename(f'{path}.{index}{extension}', f'{path}.{index + 1}{extension}')
+    os.rename(path, f'{path}.1')
+    if compression == 'gzip':
+        with open(f'{path}.1', 'rb') as src, gzip.open(f'{path}.1.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(f'{path}.1')
+    elif compression == 'zstd':
+        os.system(f'zstd -q --rm {path}.1 -o {path}.1.zst')
+    open(path, 'w').close()
+
+
+@pytest.fixture
+def log_file(tmp_path):
+    path = str(tmp_path / 'agent.log')
+    write(path, 0, 10)
+    return path
+
+
+def test_reads_every_line_once_across_rotations(log_file):
+    shipper = LogShipper(log_file, max_batch_bytes=32)
+    read, lost, segment, offset = read_all(shipper)
+    write(log_file, 10, 5)
+    rotate(log_file, 'gzip')
+    write(log_file, 15, 5)
+    rotate(log_file)
+    write(log_file, 20, 5)
+    more, lost, segment, offset = read_all(shipper, segment, offset)
+    assert read + more == [f'line {number}' for number in range(25)] and lost == 0
+    assert shipper.shipped()
+
+
+@pytest.mark.skipif(not shutil.which('zstd'), reason='zstd is not installed')
+def test_reads_zstd_segments(log_file):
+    shipper = LogShipper(log_file)
+    read, _, segment, offset = read_all(shipper)
+    write(log_file, 10, 5)
+    rotate(log_file, 'zstd')
+    more, lost, _, _ = read_all(shipper, segment, offset)
+    assert read + more == [f'line {number}' for number in range(15)] and lost == 0
+
+
+def test_reports_removed_segments(log_file):
+    shipper = LogShipper(log_file)
+    _, _, segment, offset = read_all(shipper)
+    write(log_file, 10, 5)
+    rotate(log_file, 'gzip')
+    write(log_file, 15, 5)
+    rotate(log_file)
+    assert not shipper.shipped()
+    os.remove(f'{log_file}.2.gz')
+    more, lost, _, _ = read_all(shipper, segment, offset)
+    assert more == [f'line {number}' for number in range(15, 20)] and lost == 1
+
+
+@pytest.mark.parametrize('partial', ['', 'line 10 is be'])
+def test_waits_for_the_first_line_of_a_new_log_file(log_file, partial):
+    shipper = LogShipper(log_file)
+    rotate(log_file)
+    with open(log_file, 'w') as f:
+        f.write(partial)
+    read, lost, segment, offset = read_all(shipper)
+    assert read == [] and (segment, offset) == (None, 0)
+    with open(log_file, 'w') as f:
+        f.write('line 10 is being written\n')
+    more, lost, _, _ = read_all(shipper, segment, offset)
+    assert more == ['line 10 is being written'] and lost == 0
+
+
+def test_finishes_rotated_segments_before_a_new_log_file(log_file):
+    shipper = LogShipper(log_file, max_batch_bytes=32)
+    _, _, segment, offset = read_all(shipper)
+    write(log_file, 10, 5)
+    rotate(log_file)
+    more, lost, segment, offset = read_all(shipper, segment, offset)
+    assert more == [f'line {number}' for number in range(10, 15)] and lost == 0
+    assert (segment, offset) == (None, 0) and not shipper.shipped()
+    write(log_file, 15, 5)
+    more, lost, _, _ = read_all(shipper, segment, offset)
+    assert more == [f'line {number}' for number in range(15, 20)] and lost == 0
+    assert shipper.shipped()
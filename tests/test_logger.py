@@ -0,0 +1,75 @@
+import logging
+import os
+
+import pytest
+
+from utils.logger import HandlerRegistry, Logger, Payload
+
+
+@pytest.fixture(autouse=True)
+def log_directory(tmp_path, monkeypatch):
+    # Logger writes to log/ in the working directory
+    monkeypatch.chdir(tmp_path)
+
+
+def test_creating_loggers_again_does_not_add_handlers():
+    registry = HandlerRegistry()
+    handlers = len(registry.handlers)
+    fds = len(os.listdir('/proc/self/fd'))
+    for i in range(1000):
+        logger = Logger('test', 'test.log', 'DEBUG')
+        Logger(f'test{i % 10}', 'test.log', 'DEBUG', async_logging=True)
+    assert len(logger.logger.handlers) == 2, logger.logger.handlers
+    assert len(logging.getLogger('test0').handlers) == 1, logging.getLogger('test0').handlers
+    # One file handler, one queue handler and one listener, plus the console handler unless it already existed
+    assert len(registry.handlers) - handlers <= 4, registry.handlers
+    assert len(os.listdir('/proc/self/fd')) <= fds + 1, 'Logger leaked file descriptors'  # The log file itself
+
+
+def test_every_enabled_level_is_written():
+    logger = Logger('levels', 'levels.log', 'DEBUG')
+    for level in range(0, 2100, 100):
+        logger.logger.log(level, 'Custom level %d message', level)
+    logger.logger.debug('This is a debug message')
+    logger.file_handler.flush()
+    with open(logger.file_handler.baseFilename) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 21  # Level 0 is below DEBUG
+    assert lines[-1].endswith('DEBUG - This is a debug message')
+
+
+def test_queued_payloads_are_not_changed_by_the_caller():
+    logger = Logger('frozen', 'frozen.log', 'DEBUG', async_logging=True)
+    payload = {'a': 1}
+    values = [1]
+    logger.logger.info('payload %s list %s', Payload(payload), values)
+    payload['a'] = 2
+    values.append(2)
+    logger.listener.stop()
+    logger.listener.start()
+    with open(logger.file_handler.baseFilename) as f:
+        assert f.read().splitlines()[-1].endswith('payload {"a": 1} list [1]')
+
+
+def test_budget_only_removes_rotated_segments_of_its_own_files(tmp_path, monkeypatch):
+    registry = HandlerRegistry()
+    handler = logging.FileHandler(tmp_path / 'agent.log', delay=True)
+    monkeypatch.setattr(registry, 'handlers', {('file', handler.baseFilename): handler})
+    monkeypatch.setattr(registry, 'shippers', {})
+    monkeypatch.setattr(registry, 'budget_bytes', 250)
+    for index, name in enumerate(['agent.log', 'agent.log.3.gz', 'agent.log.2.zst', 'agent.log.1', 'other.log.1',
+                                  'agent.log.1.gz.partial', 'agent.log.backup']):
+        path = tmp_path / name
+        path.write_bytes(b'x' * 100)
+        os.utime(path, (index, index))
+    shipped = False
+    registry.set_shipper(handler.baseFilename, lambda: shipped)
+    # 400 bytes of agent.log files, the newest rotated segment is kept until it is shipped
+    assert registry.enforce_budget() == 200
+    assert sorted(os.listdir(tmp_path)) == ['agent.log', 'agent.log.1', 'agent.log.1.gz.partial', 'agent.log.backup',
+                                            'other.log.1']
+    registry.budget_bytes = 150
+    assert registry.enforce_budget() == 0
+    shipped = True
+    assert registry.enforce_budget() == 100
+    assert not os.path.exists(tmp_path / 'agent.log.1')
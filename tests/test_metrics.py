@@ -0,0 +1,25 @@
+from utils.metrics import Counter, Histogram, message_bytes
+
+
+def test_label_values_and_help_are_escaped():
+    counter = Counter('test_total', 'A help text\nwith a \\ backslash.')
+    counter.inc(path='C:\\logs\\"new"\nline')
+    assert counter.render() == ['# HELP test_total A help text\\nwith a \\\\ backslash.', '# TYPE test_total counter',
+                                'test_total{path="C:\\\\logs\\\\\\"new\\"\\nline"} 1']
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('test_seconds', 'Durations.', buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, phase='poll')
+    assert histogram.samples() == ['test_seconds_bucket{phase="poll",le="0.1"} 1',
+                                   'test_seconds_bucket{phase="poll",le="1"} 2',
+                                   'test_seconds_bucket{phase="poll",le="+Inf"} 3',
+                                   'test_seconds_sum{phase="poll"} 5.55',
+                                   'test_seconds_count{phase="poll"} 3']
+
+
+def test_message_bytes_counts_utf8_bytes():
+    message = '{"hostname": "poste-\u00e9l\u00e8ve"}'
+    assert message_bytes(message) == len(message) + 2  # Two characters take two bytes each
+    assert message_bytes(b'\x00\x01') == 2
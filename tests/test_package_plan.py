@@ -0,0 +1,9 @@
+import logging
+
+from utils.package_plan import PackagePlan
+
+
+def test_logs_to_the_module_logger_by_default(caplog):
+    with caplog.at_level(logging.INFO, logger='utils.package_plan'):
+        assert PackagePlan().run()
+    assert caplog.messages == ['All required packages are already installed, skipping...']
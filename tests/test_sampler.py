@@ -0,0 +1,24 @@
+from agent.sampler import SAMPLE_FIELDS, Sampler, SampleRing
+
+
+def test_ring_returns_every_sample_once_and_reports_overwritten_samples():
+    ring = SampleRing(4, fields=('value',))
+    for value in range(1, 11):
+        ring.append((value,))
+    batch = ring.since(0)
+    assert [sample[0] for sample in batch['samples']] == [7, 8, 9, 10]
+    assert batch['lost'] == 6 and batch['seq'] == 10 and not batch['more']
+    batch = ring.since(8, limit=1)
+    assert batch['samples'] == [[9.0]] and batch['seq'] == 9 and batch['more'] and not batch['lost']
+    assert ring.since(10)['samples'] == [] and ring.since(10)['seq'] == 10
+
+
+def test_empty_ring():
+    batch = SampleRing(4).since(0)
+    assert batch['samples'] == [] and batch['seq'] == 0 and batch['lost'] == 0 and not batch['more']
+
+
+def test_sample_has_every_field():
+    sample = Sampler(logger=None, capacity=1).sample()
+    assert len(sample) == len(SAMPLE_FIELDS)
+    assert all(isinstance(value, (int, float)) for value in sample)
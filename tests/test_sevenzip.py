@@ -0,0 +1,80 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+from utils.sevenzip import SevenZip
+
+
+def make_tar(path, *entries):
+    # Entries are (name, data) for regular files, or (name, type, linkname) for links
+    with tarfile.open(path, 'w') as archive:
+        for entry in entries:
+            info = tarfile.TarInfo(entry[0])
+            if len(entry) == 2:
+                info.size = len(entry[1])
+                archive.addfile(info, io.BytesIO(entry[1]))
+            else:
+                info.type, info.linkname = entry[1], entry[2]
+                archive.addfile(info)
+
+
+@pytest.fixture
+def victim(tmp_path):
+    path = tmp_path / 'victim.txt'
+    path.write_text('original')
+    return path
+
+
+def test_extracts_files(tmp_path):
+    make_tar(tmp_path / 'files.tar', ('.', tarfile.DIRTYPE, ''), ('data/a.txt', b'a'))
+    assert SevenZip().decompress(str(tmp_path / 'files.tar'), str(tmp_path / 'out'))
+    assert (tmp_path / 'out' / 'data' / 'a.txt').read_text() == 'a'
+
+
+@pytest.mark.parametrize('link_type', [tarfile.LNKTYPE, tarfile.SYMTYPE])
+def test_does_not_write_through_links_outside_the_destination(tmp_path, victim, link_type):
+    make_tar(tmp_path / 'links.tar', ('x', link_type, str(victim)), ('x', b'pwned'))
+    assert not SevenZip().decompress(str(tmp_path / 'links.tar'), str(tmp_path / 'out'))
+    assert victim.read_text() == 'original'
+
+
+def test_does_not_write_through_relative_links(tmp_path, victim):
+    make_tar(tmp_path / 'relative.tar', ('x', tarfile.SYMTYPE, '../../victim.txt'), ('x', b'pwned'))
+    assert not SevenZip().decompress(str(tmp_path / 'relative.tar'), str(tmp_path / 'out'))
+    assert victim.read_text() == 'original'
+
+
+def test_replaces_links_inside_the_destination(tmp_path):
+    make_tar(tmp_path / 'inside.tar', ('a.txt', b'a'), ('b.txt', tarfile.LNKTYPE, 'a.txt'), ('b.txt', b'b'))
+    assert SevenZip().decompress(str(tmp_path / 'inside.tar'), str(tmp_path / 'out'))
+    assert (tmp_path / 'out' / 'a.txt').read_text() == 'a'
+    assert (tmp_path / 'out' / 'b.txt').read_text() == 'b'
+    assert not os.path.islink(tmp_path / 'out' / 'b.txt')
+
+
+@pytest.fixture
+def p7zip(tmp_path):
+    # A 7z binary that lists the codecs of the Debian p7zip and fails to compress
+    path = tmp_path / '7z'
+    path.write_text('#!/bin/sh\n'
+                    'if [ "$1" = i ]; then\n'
+                    '  printf "Formats:\\n ...  7z  7z\\n\\nCodecs:\\n 0  ED  21  LZMA2\\n 0  ED  40202  BZip2\\n"\n'
+                    'else\n'
+                    '  exit 2\n'
+                    'fi\n')
+    path.chmod(0o755)
+    return str(path)
+
+
+def test_zstd_falls_back_to_py7zr_without_the_binary_codec(tmp_path, p7zip):
+    pytest.importorskip('py7zr')
+    (tmp_path / 'data').mkdir()
+    (tmp_path / 'data' / 'a.txt').write_text('a')
+    sevenzip = SevenZip()
+    sevenzip.path = p7zip
+    assert sevenzip.compress(str(tmp_path / 'data'), str(tmp_path / 'data.7z'), codec='zstd')
+    sevenzip.backend = 'binary'
+    assert not sevenzip.compress(str(tmp_path / 'data'), str(tmp_path / 'binary.7z'), codec='zstd')
+    assert sevenzip.last_error.endswith(f'{p7zip} has no zstd codec')
@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+
+from bench.fake_agent import FakeAgent
+from tec.tec_server import TECServer, thinclients
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    # The server keeps its database and its log in the working directory
+    monkeypatch.chdir(tmp_path)
+    return TECServer()
+
+
+def test_a_poll_commits_once(server, monkeypatch):
+    commits = []
+    commit = server.commit
+    monkeypatch.setattr(server, 'commit', lambda: commits.append(1) or commit())
+
+    async def run():
+        agent = await FakeAgent(1).start()
+        try:
+            for _ in range(2):  # A new client, then a known one
+                assert await server.poll_client('ws', '127.0.0.1', agent.port, keep_alive=False)
+        finally:
+            await agent.stop()
+        return agent.client_id
+
+    client_id = asyncio.run(run())
+    assert len(commits) == 2
+    client = server.session.query(thinclients).filter_by(id=client_id).one()
+    assert client.status == 'online' and client.integrity == {'status': 'unavailable'}
+    assert client.log_position == {'segment': None, 'offset': 0} and client.sample_position == {'ring': None, 'seq': 0}
@@ -0,0 +1,50 @@
+import asyncio
+import logging
+
+import pytest
+
+from agent import watchers
+from agent.watchers import ProfileCache
+
+
+def cached_profile(cache, mountpoint):
+    cache.profile = {'hostname': 'before', 'mac': '00:11:22:33:44:55', 'memory': {}, 'ips': ['10.0.0.2'],
+                     'disks': [{'device': '/dev/sda1', 'mountpoint': mountpoint, 'fstype': 'ext4', 'opts': 'rw'}]}
+
+
+def test_snapshots_do_not_share_disks(tmp_path):
+    cache = ProfileCache(logging.getLogger('test'))
+    cached_profile(cache, str(tmp_path))
+    first = cache.snapshot()
+    usage = first['disks'][0]['usage']
+    second = cache.snapshot()
+    assert first['disks'][0] is not second['disks'][0]
+    assert first['disks'][0]['usage'] is usage
+
+
+def test_timed_sections_are_refreshed_and_published(tmp_path, monkeypatch):
+    async def run():
+        cache = ProfileCache(logging.getLogger('test'), refresh_interval=0.01)
+        cached_profile(cache, str(tmp_path))
+        cache._collectors['hostname'] = lambda: 'after'
+        queue = cache.subscribe()
+        monkeypatch.setattr(watchers, 'WATCHERS', ())  # Only the timer
+        cache.start_watchers()
+        try:
+            event = await asyncio.wait_for(queue.get(), 1)
+        finally:
+            cache.stop_watchers()
+        return cache, event
+
+    cache, event = asyncio.run(run())
+    assert event['event'] == 'hostname' and event['data'] == {'hostname': 'after'}
+    assert cache.snapshot()['hostname'] == 'after'
+
+
+def test_a_watcher_must_implement_the_kernel_interface():
+    class Incomplete(watchers.Watcher):
+        def open(self):
+            return 0
+
+    with pytest.raises(TypeError):
+        Incomplete(ProfileCache(logging.getLogger('test')))
@@ -2,10 +2,31 @@
 import os
 import json
 from utils.logger import Logger
-import subprocess
 
 from argparse import ArgumentParser
 
+
+def load_config(path='config.json'):
+    """
+    Loads the ThinTrust configuration.
+
+    Args:
+        path (str): The path of the config file. The default value is 'config.json'.
+
+    Returns:
+        dict: The configuration, or None if the config file is not found.
+
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def pretty_version(config):
+    return f"v{config['distro_version']} {config['distro_release'].capitalize()}"
+
+
 class ThinTrust(Logger):
     """
     The ThinTrust class represents the main functionality of the ThinTrust application.
@@ -21,10 +42,14 @@ class ThinTrust(Logger):
     Methods:
         __init__(): Initializes the ThinTrust application.
         install_initial_packages(): Installs the initial packages required by ThinTrust.
+        package_plan(*packages): Creates a PackagePlan with the initial packages and any extra packages.
         is_package_installed(package_name): Checks if a package is installed.
         run_agent(): Runs the ThinTrust agent.
         run_server(): Runs the ThinTrust server.
-        run_initial_setup(): Runs the initial setup for ThinTrust.
+        run_initial_setup(bundle): Runs the initial setup for ThinTrust, optionally from an offline provisioning bundle.
+        build_bundle(destination): Builds an offline provisioning bundle for the initial setup.
+        issue_cert(name, hosts): Issues a certificate from the local CA, creating the CA first if needed.
+        configure_agent_tls(cert, key, ca): Makes the agent serve wss with a certificate issued by the local CA.
 
     """
 
@@ -39,26 +64,38 @@ class ThinTrust(Logger):
         if os.geteuid() != 0:
             print('ThinTrust must be run as root. Please run with sudo or as root.')
             exit(1)
-        self.config = json.load(open('config.json')) if os.path.exists('config.json') else None
+        self.config = load_config()
         if not self.config:
             print('Config file not found. Please create a config.json file.')
             exit(1)
         for key, value in self.config.items():
             setattr(self, key, value)
-        self.pretty_version = f'v{self.distro_version} {self.distro_release.capitalize()}'
-        super().__init__('ThinTrust', self.log_file, self.log_level)
+        self.pretty_version = pretty_version(self.config)
+        super().__init__('ThinTrust', self.log_file, self.log_level, async_logging=self.config.get('async_logging', False),
+                         rotation=self.config.get('log_rotation', 'size'), compression=self.config.get('log_compression'),
+                         budget_bytes=self.config.get('log_budget_bytes'))
         # if not self.install_initial_packages():
         #     self.logger.error(f'Error installing initial packages:{self.initial_packages}\n Try installing them manually and running ThinTrust again.')
         #     exit(1)
         
         
     def is_package_installed(self,package_name):
-        try:
-            output = subprocess.check_output(f"dpkg-query -s {package_name}", shell=True, stderr=subprocess.STDOUT)
-            return True
-        except subprocess.CalledProcessError:
-            return False
+        from utils.package_index import PackageIndex
+        return PackageIndex().is_installed(package_name)
+
+    def package_plan(self, *packages):
+        """
+        Creates a PackagePlan with the initial packages and any extra packages.
+
+        Args:
+            *packages (str): Extra packages to add to the plan after the initial packages.
+
+        Returns:
+            PackagePlan: The plan, ready to have more packages added or to be run.
 
+        """
+        from utils.package_plan import PackagePlan
+        return PackagePlan(self.logger).add(*self.initial_packages, *packages)
         
     def install_initial_packages(self):
         """
@@ -69,65 +106,165 @@ class ThinTrust(Logger):
 
         """
         self.logger.info('Installing initial packages...')
-        try:
-            subprocess.check_output(f'apt-get update -y', shell=True)
-            subprocess.check_output(f'apt-get install -y {" ".join(self.initial_packages)}', shell=True)
-            return True
-        except Exception as e:
-            self.logger.error(f'Error installing initial packages: {e}')
-            return False
+        return self.package_plan().run()
         
     def run_agent(self):
         from agent.agent import ThinAgent
         agent = ThinAgent()
-        agent.loop.run_until_complete(agent.connect())
+        return agent.loop.run_until_complete(agent.main())
         
     def run_server(self):
         from tec.tec_server import TECServer
         server = TECServer()
         server.run()
         
-    def run_initial_setup(self):
-        self.install_initial_packages()
+    def run_initial_setup(self, bundle=None):
+        # InitialSetup installs the initial packages together with its own in a single apt transaction
         from setup.setup_v2 import InitialSetup
-        self.initial_setup = InitialSetup(self)
+        self.initial_setup = InitialSetup(self, bundle=bundle)
         self.initial_setup.run()
+
+    def build_bundle(self, destination):
+        """
+        Builds an offline provisioning bundle for the initial setup.
+
+        The bundle contains every package, theme and script the initial setup needs, so it can be applied on
+        any number of endpoints with `--install --bundle <path>` without network access.
+
+        Args:
+            destination (str): The path of the bundle archive to create.
+
+        Returns:
+            bool: True if the bundle is built successfully, False otherwise.
+
+        """
+        from setup.bundle import ProvisioningBundle
+        from setup.setup_v2 import SETUP_PACKAGES
+        with open('setup/setup.json', 'r') as f:
+            setup_config = json.load(f)
+        plan = self.package_plan(*SETUP_PACKAGES, *setup_config['rebrand_os_packages'])
+        return ProvisioningBundle(self.logger, self.distro_release).build(plan.packages, destination)
+
+    def issue_cert(self, name, hosts):
+        """
+        Issues a certificate from the local CA, creating the CA first if needed.
+
+        Run on the TEC server, once for the server itself, whose certificate and the CA go in the tls_cert, tls_key
+        and tls_ca of tec/tec_server.json, and once for each agent, whose certificate, key and the CA are copied to the
+        thin client and set with `--agent-tls`.
+
+        Args:
+            name (str): The name of the certificate, such as the host name of the thin client.
+            hosts (list): The IP addresses and host names the certificate is valid for.
+
+        Returns:
+            tuple: The paths of the certificate, its private key and the CA certificate, or None on error.
+
+        """
+        from utils.tls import LocalCA
+        ca = LocalCA(self.logger, self.config.get('tls_dir', '/etc/thintrust/tls'))
+        if not ca.create():
+            return None
+        issued = ca.issue(name, hosts)
+        if not issued:
+            return None
+        self.logger.info(f'Issued the certificate {issued[0]} for {", ".join(hosts)}')
+        return (*issued, ca.cert)
+
+    def configure_agent_tls(self, cert, key, ca):
+        """
+        Makes the agent serve wss with a certificate issued by the local CA, and only accept the TEC server's.
+
+        The agent refuses to start if the files cannot be loaded, so they are checked before they are set.
+
+        Args:
+            cert (str): The path of the agent certificate.
+            key (str): The path of its private key.
+            ca (str): The path of the CA certificate.
+
+        Returns:
+            bool: True if the settings were saved, False otherwise.
+
+        """
+        from agent.agent import ThinAgent
+        from utils.tls import server_context
+        cert, key, ca = (os.path.abspath(path) for path in (cert, key, ca))
+        try:
+            server_context(cert, key, ca)
+        except OSError as e:
+            self.logger.error(f'Error loading the TLS certificate: {e}')
+            return False
+        agent = ThinAgent()
+        return all(agent.update_setting(setting, value)
+                   for setting, value in (('tls_cert', cert), ('tls_key', key), ('tls_ca', ca)))
         
-if __name__ == '__main__':
+def main(argv=None):
+    """
+    Runs the ThinTrust command line tool.
+
+    Arguments are parsed before anything else is loaded, and each command only imports what it needs, so --help and
+    --version return immediately and do not need root or create log files.
+
+    Args:
+        argv (list): The command line arguments. Defaults to sys.argv.
+
+    """
     parser = ArgumentParser()
-    thintrust = ThinTrust()
     parser.add_argument('-v', '--version', action='store_true', help='Display the version of ThinTrust.')
     parser.add_argument('-i', '--install', action='store_true', help='Run the initial install for ThinTrust.')
     parser.add_argument('-p', '--sysprofile', action='store_true', help='Display the system profile.')
     parser.add_argument('-a', '--agent', action='store_true', help='Run the ThinTrust agent. (If not running as a service)')
     parser.add_argument('-s', '--server', action='store_true', help='Run the ThinTrust server.')
+    parser.add_argument('-b', '--build-bundle', metavar='PATH', help='Build an offline provisioning bundle for the initial install.')
+    parser.add_argument('--bundle', metavar='PATH', help='Provisioning bundle archive or directory to use with --install.')
+    parser.add_argument('--issue-cert', nargs='+', metavar=('NAME', 'HOST'), help='Issue a certificate from the local CA for the TEC server or an agent, valid for the hosts given after its name.')
+    parser.add_argument('--agent-tls', nargs=3, metavar=('CERT', 'KEY', 'CA'), help='Make the agent serve wss with a certificate issued with --issue-cert.')
+    parser.add_argument('-q', '--query-packages', nargs='+', metavar='PACKAGE', help='Display the installed version of packages.')
     parser.description = 'ThinTrust setup and management tool.'
     parser.epilog = 'ThinTrust is a tool for setting up and managing ThinTrust OS endpoints.\n'
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     if args.version:
-        print(f'ThinTrust {thintrust.pretty_version}')
+        config = load_config()
+        if not config:
+            print('Config file not found. Please create a config.json file.')
+            exit(1)
+        print(f'ThinTrust {pretty_version(config)}')
+    elif args.query_packages:
+        from utils.package_index import PackageIndex
+        for package, version in PackageIndex().query(*args.query_packages).items():
+            print(f'{package}\t{version if version else "not installed"}')
     elif args.install:
-        thintrust.run_initial_setup()
+        ThinTrust().run_initial_setup(bundle=args.bundle)
+    elif args.build_bundle:
+        if not ThinTrust().build_bundle(args.build_bundle):
+            exit(1)
+    elif args.issue_cert:
+        if len(args.issue_cert) < 2:
+            parser.error('--issue-cert needs a name and at least one host')
+        issued = ThinTrust().issue_cert(args.issue_cert[0], args.issue_cert[1:])
+        if not issued:
+            exit(1)
+        print('\n'.join(issued))
+    elif args.agent_tls:
+        if not ThinTrust().configure_agent_tls(*args.agent_tls):
+            exit(1)
     elif args.sysprofile:
-        from utils.system_profiler import SystemProfiler
         try:
             import psutil
         except ImportError:
-            if not thintrust.is_package_installed('python3-psutil'):
-                try:
-                    if subprocess.call('apt-get install -y python3-psutil', shell=True) != 0:
-                        thintrust.logger.error('Error installing python3-psutil. Try installing it manually and running ThinTrust again.')
-                        exit(1)
-                except Exception as e:
-                    thintrust.logger.error(f'Error installing python3-psutil: {e}')
-                    exit(1)
-        sp = SystemProfiler(logger=thintrust.logger)
+            print('The system profile needs psutil. Install it with: apt-get install python3-psutil')
+            exit(1)
+        from utils.system_profiler import SystemProfiler
+        sp = SystemProfiler(logger=ThinTrust().logger)
         print(json.dumps(sp.system_profile, indent=4))
     elif args.agent:
-        thintrust.run_agent()
+        if not ThinTrust().run_agent():
+            exit(1)
     elif args.server:
-        thintrust.run_server()
+        ThinTrust().run_server()
     else:
         parser.print_help()
 
-        
\ No newline at end of file
+
+if __name__ == '__main__':
+    main()
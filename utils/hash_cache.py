@@ -0,0 +1,146 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class HashCache:
+    """
+    A persistent cache of file digests keyed on the identity and metadata of the files.
+
+    Used by HashTools to avoid re-reading files that did not change since they were last hashed. An entry is keyed on
+    the device and inode of the file and the algorithm, and is only returned while the size, mtime_ns and ctime_ns of
+    the file still match the ones recorded when it was hashed. A file that changed is simply rehashed and its entry
+    replaced. The ctime cannot be set back like the mtime can with 'touch -d', so a file modified and given its old
+    mtime back is rehashed too, which integrity scans rely on.
+
+    Files modified or changed less than a second before they were hashed are not cached, as a later write within the
+    same mtime or ctime tick would not be noticed. The cache is stored in a SQLite database and is safe to use from several threads.
+
+    Attributes:
+        path (str): The path of the SQLite database.
+        max_entries (int): The number of entries kept by evict(). The least recently used entries are removed first.
+        hits (int): The number of lookups answered from the cache.
+        misses (int): The number of lookups that needed the file to be hashed.
+
+    Args:
+        path (str): The path of the SQLite database. The default value is 'hashcache.db'.
+        max_entries (int): The number of entries kept by evict(). The default value is 1,000,000.
+
+    Methods:
+        get(stat: os.stat_result, algorithm: str) -> str: Gets the cached digest of a file.
+        put(stat: os.stat_result, algorithm: str, digest: str): Caches the digest of a file.
+        flush(): Writes pending entries to the database.
+        evict() -> int: Removes the least recently used entries above max_entries.
+        clear(): Removes every entry.
+        close(): Flushes and closes the database.
+    """
+    # Entries are written in batches, so a full-disk sweep does not commit once per file
+    FLUSH_EVERY = 1000
+
+    def __init__(self, path: str = 'hashcache.db', max_entries: int = 1000000) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._touched = {}
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                                'dev INTEGER, ino INTEGER, algorithm TEXT, size INTEGER, mtime_ns INTEGER, '
+                                'ctime_ns INTEGER, digest TEXT, last_used REAL, PRIMARY KEY (dev, ino, algorithm))')
+        self.connection.commit()
+
+    def get(self, stat: os.stat_result, algorithm: str) -> str:
+        """
+        Get the cached digest of a file.
+
+        Args:
+            stat (os.stat_result): The result of os.stat for the file.
+            algorithm (str): The hashing algorithm.
+
+        Returns:
+            str: The cached hexadecimal digest, or None if the file is not cached or changed since it was cached.
+        """
+        key = (stat.st_dev, stat.st_ino, algorithm)
+        with self._lock:
+            row = self._pending.get(key)
+            row = row[3:7] if row else self.connection.execute(
+                'SELECT size, mtime_ns, ctime_ns, digest FROM hashes WHERE dev=? AND ino=? AND algorithm=?',
+                key).fetchone()
+            if row is None or tuple(row[:3]) != (stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched[key] = time.time()
+            if len(self._touched) >= self.FLUSH_EVERY:
+                self._flush()
+            return row[3]
+
+    def put(self, stat: os.stat_result, algorithm: str, digest: str) -> None:
+        """
+        Cache the digest of a file.
+
+        Args:
+            stat (os.stat_result): The result of os.stat for the file, taken before it was hashed.
+            algorithm (str): The hashing algorithm.
+            digest (str): The hexadecimal digest of the file.
+        """
+        now = time.time()
+        if now * 1e9 - max(stat.st_mtime_ns, stat.st_ctime_ns) < 1e9:
+            return  # Racily clean, a write in the same mtime or ctime tick would go unnoticed
+        with self._lock:
+            key = (stat.st_dev, stat.st_ino, algorithm)
+            self._pending[key] = (*key, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, digest, now)
+            if len(self._pending) >= self.FLUSH_EVERY:
+                self._flush()
+
+    def _flush(self) -> None:
+        if self._pending:
+            self.connection.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)', self._pending.values())
+            self._pending = {}
+        if self._touched:
+            self.connection.executemany('UPDATE hashes SET last_used=? WHERE dev=? AND ino=? AND algorithm=?',
+                                        [(used, *key) for key, used in self._touched.items()])
+            self._touched = {}
+        self.connection.commit()
+
+    def flush(self) -> None:
+        """
+        Write pending entries to the database.
+        """
+        with self._lock:
+            self._flush()
+
+    def evict(self) -> int:
+        """
+        Remove the least recently used entries above max_entries.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        with self._lock:
+            self._flush()
+            cursor = self.connection.execute('DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes '
+                                             'ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+            self.connection.commit()
+            return cursor.rowcount
+
+    def clear(self) -> None:
+        """
+        Remove every entry.
+        """
+        with self._lock:
+            self._pending = {}
+            self._touched = {}
+            self.connection.execute('DELETE FROM hashes')
+            self.connection.commit()
+
+    def close(self) -> None:
+        """
+        Flush pending entries, evict entries above max_entries and close the database.
+        """
+        self.evict()
+        self.connection.close()
@@ -0,0 +1,91 @@
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Commands that must start fast, without root and without touching the log directory
+COMMANDS = [['-v'], ['--help']]
+BUDGET_MS = 50
+# Packages only some commands need, they must be imported lazily by those commands
+FORBIDDEN = {'sqlalchemy', 'websockets', 'psutil', 'requests', 'py7zr', 'fastapi', 'agent', 'tec', 'setup'}
+
+
+def parse_importtime(output):
+    """
+    Parse the output of python -X importtime.
+
+    The imports done by the interpreter startup, up to and including site, are left out as they depend on the Python
+    installation rather than on ThinTrust.
+
+    Args:
+        output (str): The stderr of a python -X importtime run.
+
+    Returns:
+        tuple: The total import time in milliseconds of the top-level imports, and the list of every imported module.
+    """
+    total_us = 0
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if name[1:] == name.strip():  # Top-level imports are not indented
+            if name.strip() == 'site':
+                total_us = 0
+                modules = []
+                continue
+            total_us += int(cumulative)
+        modules.append(name.strip())
+    return total_us / 1000, modules
+
+
+def log_snapshot():
+    log_dir = os.path.join(REPO_DIR, 'log')
+    if not os.path.isdir(log_dir):
+        return {}
+    return {entry.name: (entry.stat().st_size, entry.stat().st_mtime_ns) for entry in os.scandir(log_dir)}
+
+
+def check(arguments, budget_ms=BUDGET_MS, runs=5):
+    """
+    Check the import time and imports of a thintrust.py command.
+
+    Args:
+        arguments (list): The arguments of thintrust.py.
+        budget_ms (float): The maximum import time in milliseconds.
+        runs (int): The number of runs. The fastest run is compared to the budget, to ignore noise.
+
+    Returns:
+        list: The problems found, empty if the command is within budget.
+    """
+    problems = []
+    times = []
+    for _ in range(runs):
+        before = log_snapshot()
+        result = subprocess.run([sys.executable, '-X', 'importtime', 'thintrust.py', *arguments], cwd=REPO_DIR,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            return [f'thintrust.py {" ".join(arguments)} exited with {result.returncode}']
+        if log_snapshot() != before:
+            problems.append(f'thintrust.py {" ".join(arguments)} wrote to the log directory')
+        total_ms, modules = parse_importtime(result.stderr)
+        times.append(total_ms)
+        forbidden = sorted({module for module in modules if module.split('.')[0] in FORBIDDEN})
+        if forbidden:
+            problems.append(f'thintrust.py {" ".join(arguments)} imports {", ".join(forbidden)}')
+    if min(times) > budget_ms:
+        problems.append(f'thintrust.py {" ".join(arguments)} imports take {min(times):.1f} ms, budget is {budget_ms} ms')
+    print(f'thintrust.py {" ".join(arguments)}: {min(times):.1f} ms of imports (budget {budget_ms} ms)')
+    return sorted(set(problems))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Check the import time budget of the ThinTrust command line tool.')
+    parser.add_argument('--budget-ms', type=float, default=BUDGET_MS, help='The maximum import time in milliseconds.')
+    parser.add_argument('--runs', type=int, default=5, help='The number of runs per command.')
+    args = parser.parse_args()
+    problems = [problem for command in COMMANDS for problem in check(command, args.budget_ms, args.runs)]
+    for problem in problems:
+        print(f'FAIL: {problem}')
+    exit(1 if problems else 0)
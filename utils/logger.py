@@ -1,57 +1,487 @@
+import atexit
+import copy
+import json
 import logging
 import os
+import queue
 import sys
-from logging.handlers import RotatingFileHandler
+import threading
+import time
+from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler, QueueHandler, QueueListener
+
+from utils.singleton import Singleton
+
+
+# Fields present in every structured log line, set per call with extra={...}
+STRUCTURED_FIELDS = ('client_id', 'step', 'duration_ms')
+PAYLOAD_MAX_LENGTH = 2048
+# Log arguments that cannot change after the call, passed to the listener thread as they are
+IMMUTABLE_ARGS = (str, bytes, int, float, bool, type(None))
+# Log arguments copied when the record is queued, as the caller may change them before the listener formats them
+MUTABLE_ARGS = (dict, list, set, bytearray)
+COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def elapsed_ms(start):
+    """
+    Get the milliseconds elapsed since a time.perf_counter() value, for the duration_ms field.
+
+    Args:
+        start (float): The time.perf_counter() value at the start of the step.
+
+    Returns:
+        float: The elapsed time in milliseconds, rounded to a microsecond.
+    """
+    return round((time.perf_counter() - start) * 1000, 3)
+
+
+class Payload:
+    """
+    A log argument that renders a payload only when the record is actually formatted.
+
+    Pass it as a %s argument instead of formatting the payload in an f-string, so a large dict is not stringified
+    when the level is disabled, and is cut to max_length characters when it is.
+    In async mode the payload is copied when the record is queued and rendered later by the listener thread, so
+    changing it after the call does not change what is logged.
+
+    Example:
+        logger.debug('System Info: %s', Payload(response))
+
+    Args:
+        value (Any): The payload. Strings are logged as is, other values as JSON.
+        max_length (int): The maximum number of characters logged. The default value is 2048, None disables the limit.
+    """
+    __slots__ = ('value', 'max_length')
+
+    def __init__(self, value, max_length=PAYLOAD_MAX_LENGTH):
+        self.value = value
+        self.max_length = max_length
+
+    def freeze(self):
+        """
+        Get a payload that no longer shares its value with the caller.
+
+        Returns:
+            Payload: This payload if its value is immutable, otherwise a payload holding a deep copy of the value, or
+            the rendered text when the value cannot be copied.
+        """
+        if isinstance(self.value, IMMUTABLE_ARGS):
+            return self
+        try:
+            return Payload(copy.deepcopy(self.value), self.max_length)
+        except Exception:
+            return Payload(str(self), None)
+
+    def __str__(self):
+        if isinstance(self.value, str):
+            text = self.value
+        else:
+            try:
+                text = json.dumps(self.value, default=str)
+            except (TypeError, ValueError):
+                text = repr(self.value)
+        if self.max_length and len(text) > self.max_length:
+            return f'{text[:self.max_length]}... ({len(text) - self.max_length} more characters)'
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format log records as one JSON object per line.
+
+    Every line has the time, level, logger name and message, plus the STRUCTURED_FIELDS, which are null unless given
+    with extra={...} in the log call. Exceptions are added as a formatted traceback.
+    """
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            entry[field] = getattr(record, field, None)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    A QueueHandler that never blocks the logging thread.
+
+    Records are put on a bounded queue without waiting. When the queue is full the record is dropped and counted
+    instead, so a slow disk or console can never stall the event loop that is logging. Formatting is left to the
+    handlers of the QueueListener, in its background thread.
+
+    Attributes:
+        dropped (int): The number of records dropped because the queue was full.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The default prepare formats the message here, in the logging thread. The listener formats it instead, so
+        # only the payloads and containers the caller could still change are copied here.
+        if isinstance(record.args, dict):
+            record.args = {key: _freeze(value) for key, value in record.args.items()}
+        elif record.args:
+            record.args = tuple(_freeze(arg) for arg in record.args)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _freeze(arg):
+    if isinstance(arg, Payload):
+        return arg.freeze()
+    if isinstance(arg, MUTABLE_ARGS):
+        try:
+            return copy.deepcopy(arg)
+        except Exception:
+            return str(arg)
+    return arg
+
+
+class DrainingQueueListener(QueueListener):
+    """
+    A QueueListener that waits for room in a full queue to stop, so the records already queued are written on exit.
+    """
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def compress_file(source, destination, compression):
+    """
+    Compress a file and remove the original.
+
+    Args:
+        source (str): The path of the file to compress.
+        destination (str): The path of the compressed file.
+        compression (str): 'gzip' or 'zstd'.
+
+    Returns:
+        bool: True if the file is compressed successfully, False otherwise.
+    """
+    import gzip  # Only needed once a log file is rotated, not to import the logger
+    import shutil
+    import subprocess
+    partial = f'{destination}.partial'
+    try:
+        if compression == 'zstd':
+            subprocess.check_call(['zstd', '-q', '-f', '-T1', source, '-o', partial], stderr=subprocess.DEVNULL)
+        else:
+            with open(source, 'rb') as src, gzip.open(partial, 'wb', compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(partial, destination)
+        os.remove(source)
+        return True
+    except Exception as e:
+        # Not logged, the handlers of this very log file may be rotating
+        print(f'Error compressing log file {source}: {e}', file=sys.stderr)
+        if os.path.exists(partial):
+            os.remove(partial)
+        return False
+
+
+class CompressingRotationMixin:
+    """
+    Compress the rotated segments of a rotating file handler in a background thread.
+
+    At rollover the current log file is only renamed, which is instant, and compressed afterwards by a single shared
+    compression thread, so the thread that is logging does not wait for the compression. A rollover waits for the
+    compression of the previous segment of the same file, so segments are never renamed while being compressed.
+    Once a segment is compressed, the log budget of the HandlerRegistry is enforced.
+    """
+    _executor = None
+
+    def setup_compression(self, compression):
+        import shutil
+        if compression == 'zstd' and not shutil.which('zstd'):
+            compression = 'gzip' # The zstd binary is not installed
+        self.compression = compression
+        self.namer = lambda name: name + COMPRESSION_EXTENSIONS[compression]
+        self._pending = None
+
+    def doRollover(self):
+        if self._pending:
+            self._pending.result()
+        super().doRollover()
+
+    def rotate(self, source, dest):
+        raw = dest[:-len(COMPRESSION_EXTENSIONS[self.compression])]
+        if not os.path.exists(source):
+            return
+        os.rename(source, raw)
+        if CompressingRotationMixin._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            CompressingRotationMixin._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='LogCompressor')
+        self._pending = CompressingRotationMixin._executor.submit(self._compress, raw, dest)
+
+    def _compress(self, raw, dest):
+        compress_file(raw, dest, self.compression)
+        HandlerRegistry().enforce_budget()
+
+
+class CompressingRotatingFileHandler(CompressingRotationMixin, RotatingFileHandler):
+    """
+    A RotatingFileHandler that compresses its rotated segments. See CompressingRotationMixin.
+
+    Args:
+        filename (str): The path of the log file.
+        compression (str): 'gzip' or 'zstd'. zstd falls back to gzip if the zstd binary is missing.
+        **kwargs: The arguments of RotatingFileHandler.
+    """
+    def __init__(self, filename, compression='gzip', **kwargs):
+        super().__init__(filename, **kwargs)
+        self.setup_compression(compression)
+
+
+class CompressingTimedRotatingFileHandler(CompressingRotationMixin, TimedRotatingFileHandler):
+    """
+    A TimedRotatingFileHandler that compresses its rotated segments. See CompressingRotationMixin.
+
+    Args:
+        filename (str): The path of the log file.
+        compression (str): 'gzip' or 'zstd'. zstd falls back to gzip if the zstd binary is missing.
+        **kwargs: The arguments of TimedRotatingFileHandler.
+    """
+    def __init__(self, filename, compression='gzip', **kwargs):
+        super().__init__(filename, **kwargs)
+        self.setup_compression(compression)
+
+
+class HandlerRegistry(Singleton):
+    """
+    A process-wide registry of the handlers created by Logger.
+
+    logging.getLogger returns the same logger for a name, but every Logger used to attach new file and console
+    handlers to it, so building the same component twice duplicated every line and leaked a file descriptor. The
+    registry creates one handler per key and returns it again afterwards: one file handler per log file, shared by
+    every logger writing to that file so only one of them rotates it, one console handler, and one queue handler and
+    listener per log file in async mode.
+
+    The registry also keeps the log budget: the total size of the log files of its file handlers, shared by every
+    component of the process. When it is exceeded, the oldest rotated segments of those files are removed until they
+    fit again. Other files in the log directory, such as the logs of other processes, are never removed, and neither
+    are the files that are being written to. The newest rotated segment of a file that is shipped elsewhere, such as
+    the agent log read by LogShipper, is only removed once it has been shipped.
+
+    Attributes:
+        handlers (dict): The handlers by key.
+        budget_bytes (int): The maximum size of the log files, or None for no limit.
+        shippers (dict): The callable telling whether the newest rotated segment was shipped, by log file path.
+
+    Methods:
+        get(key: tuple, factory: callable) -> logging.Handler: Gets the handler for a key, creating it on first use.
+        owns(handler: logging.Handler) -> bool: Checks if a handler was created by the registry.
+        set_budget(budget_bytes: int): Sets the log budget. The smallest budget requested is kept.
+        set_shipper(path: str, shipped: callable): Keeps the newest rotated segment of a log file until it is shipped.
+        rotated_segments(path: str) -> list: Lists the rotated segments of a log file, the newest first.
+        enforce_budget() -> int: Removes the oldest rotated segments above the log budget.
+    """
+    def __init__(self):
+        if hasattr(self, 'handlers'):
+            return  # The registry is shared, only initialize it once
+        self.handlers = {}
+        self.budget_bytes = None
+        self.shippers = {}
+        self._lock = threading.RLock()
+
+    def get(self, key, factory):
+        """
+        Get the handler for a key, creating it on first use.
+
+        Args:
+            key (tuple): The key of the handler.
+            factory (callable): Called without arguments to create the handler.
+
+        Returns:
+            logging.Handler: The handler for the key.
+        """
+        with self._lock:
+            if key not in self.handlers:
+                self.handlers[key] = factory()
+            return self.handlers[key]
+
+    def owns(self, handler):
+        with self._lock:
+            return any(handler is owned for owned in self.handlers.values())
+
+    def set_budget(self, budget_bytes):
+        with self._lock:
+            if budget_bytes and (self.budget_bytes is None or budget_bytes < self.budget_bytes):
+                self.budget_bytes = budget_bytes
+
+    def set_shipper(self, path, shipped):
+        """
+        Keep the newest rotated segment of a log file until it is shipped.
+
+        Args:
+            path (str): The path of the log file.
+            shipped (callable): Called without arguments, returns True once the newest rotated segment was shipped.
+        """
+        with self._lock:
+            self.shippers[os.path.abspath(path)] = shipped
+
+    @staticmethod
+    def rotated_segments(path):
+        """
+        List the rotated segments of a log file, as named by the size and time rotating handlers.
+
+        Args:
+            path (str): The path of the log file.
+
+        Returns:
+            list: The (mtime, path, size) of each rotated segment, compressed or not, the newest first.
+        """
+        directory, prefix = os.path.split(path)
+        segments = []
+        if not os.path.isdir(directory):
+            return segments
+        for entry in os.scandir(directory):
+            if not entry.name.startswith(prefix + '.') or not entry.is_file():
+                continue
+            suffix = entry.name[len(prefix) + 1:]
+            for extension in COMPRESSION_EXTENSIONS.values():
+                if suffix.endswith(extension):
+                    suffix = suffix[:-len(extension)]
+                    break
+            # .1, .2... by size, .2024-05-01 or .2024-05-01_12 by time
+            if suffix and all(char.isdigit() or char in '-_' for char in suffix):
+                stat = entry.stat()
+                segments.append((stat.st_mtime, entry.path, stat.st_size))
+        return sorted(segments, reverse=True)
+
+    def enforce_budget(self):
+        """
+        Remove the oldest rotated segments while the log files are larger than the log budget.
+
+        Returns:
+            int: The number of bytes removed.
+        """
+        with self._lock:
+            if not self.budget_bytes:
+                return 0
+            total = 0
+            removable = []
+            for path in {handler.baseFilename for handler in self.handlers.values()
+                         if isinstance(handler, logging.FileHandler)}:
+                if os.path.exists(path):
+                    total += os.path.getsize(path)
+                segments = self.rotated_segments(path)
+                total += sum(size for _, _, size in segments)
+                shipped = self.shippers.get(path)
+                if segments and shipped is not None and not shipped():
+                    segments = segments[1:]  # The newest segment is still waiting to be shipped
+                removable += segments
+            removed = 0
+            for _, path, size in sorted(removable):
+                if total - removed <= self.budget_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    removed += size
+                except FileNotFoundError:
+                    pass
+            return removed
+
 
 class Logger:
-    def __init__(self, name, log_file, log_level, max_bytes=10485760, backup_count=20):
+    """
+    Set up a named logger writing to a rotating log file in the log directory and to stdout.
+
+    By default every log call writes to the file and to stdout synchronously. With async_logging, the logger only
+    puts records on a bounded queue and a QueueListener thread formats and writes them, so the caller never blocks on
+    disk or console I/O. Records are dropped, and counted in dropped_records, when the queue is full.
+
+    With structured, every line is a JSON object (see JsonFormatter). Log calls pass client_id, step and duration_ms
+    with extra={...} and payloads wrapped in Payload, which is only rendered if the level is enabled.
+
+    Rotation is by size (max_bytes) or by time (rotation='time', every interval of when, see TimedRotatingFileHandler).
+    With compression, rotated segments are compressed in the background, and budget_bytes caps the total size of the
+    log files of every component of the process by removing their oldest segments. On thin clients, where overlayroot
+    keeps the log directory in RAM, this keeps the memory used by logs small and bounded.
+
+    Handlers come from the HandlerRegistry, so creating a Logger again for the same name and file is a no-op, and
+    several names logging to the same file share its handler. The size, backup and queue settings of the first Logger
+    of a file apply to it.
+
+    Args:
+        name (str): The name of the logger.
+        log_file (str): The name of the log file in the log directory.
+        log_level (str): The log level of the logger.
+        max_bytes (int): The size at which the log file is rotated.
+        backup_count (int): The number of rotated log files to keep.
+        async_logging (bool): Whether to write the log records from a background thread.
+        queue_size (int): The maximum number of records waiting to be written in async mode.
+        structured (bool): Whether to write JSON lines instead of plain text.
+        rotation (str): 'size' or 'time'. The default value is 'size'.
+        when (str): The rotation interval in time mode, as the when argument of TimedRotatingFileHandler.
+        compression (str): None, 'gzip' or 'zstd'. Rotated segments are compressed in the background.
+        budget_bytes (int): The maximum total size of the log files of the process, or None for no limit.
+    """
+    def __init__(self, name, log_file, log_level, max_bytes=10485760, backup_count=20, async_logging=False,
+                 queue_size=10000, structured=False, rotation='size', when='midnight', compression=None,
+                 budget_bytes=None):
         self.name = name
         self.log_file = log_file
         self.log_level = log_level
         self.logger = logging.getLogger(self.name)
         self.logger.setLevel(self.log_level)
-        self.formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        if structured:
+            self.formatter = JsonFormatter()
+        else:
+            self.formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         if not os.path.exists("log"):
             os.makedirs("log")
-        self.file_handler = RotatingFileHandler(f"log/{self.log_file}", maxBytes=max_bytes, backupCount=backup_count)
-        self.file_handler.setLevel(self.log_level)
-        self.file_handler.setFormatter(self.formatter)
-        self.logger.addHandler(self.file_handler)
-        self.console_handler = logging.StreamHandler(sys.stdout)
-        self.console_handler.setLevel(self.log_level)
-        self.console_handler.setFormatter(self.formatter)
-        self.logger.addHandler(self.console_handler)
-        
-if __name__ == "__main__":
-    logger = Logger("test", "test.log", "DEBUG")
-    logger.logger.debug("This is a debug message")
-    logger.logger.info("This is an info message")
-    logger.logger.warning("This is a warning message")
-    logger.logger.error("This is an error message")
-    logger.logger.critical("This is a critical message")
-    logger.logger.log(logging.DEBUG, "This is a debug message")
-    logger.logger.log(logging.INFO, "This is an info message")
-    logger.logger.log(logging.WARNING, "This is a warning message")
-    logger.logger.log(logging.ERROR, "This is an error message")
-    logger.logger.log(logging.CRITICAL, "This is a critical message")
-    logger.logger.log(0, "This is a custom level message")
-    logger.logger.log(100, "This is a custom level message")
-    logger.logger.log(200, "This is a custom level message")
-    logger.logger.log(300, "This is a custom level message")
-    logger.logger.log(400, "This is a custom level message")
-    logger.logger.log(500, "This is a custom level message")
-    logger.logger.log(600, "This is a custom level message")
-    logger.logger.log(700, "This is a custom level message")
-    logger.logger.log(800, "This is a custom level message")
-    logger.logger.log(900, "This is a custom level message")
-    logger.logger.log(1000, "This is a custom level message")
-    logger.logger.log(1100, "This is a custom level message")
-    logger.logger.log(1200, "This is a custom level message")
-    logger.logger.log(1300, "This is a custom level message")
-    logger.logger.log(1400, "This is a custom level message")
-    logger.logger.log(1500, "This is a custom level message")
-    logger.logger.log(1600, "This is a custom level message")
-    logger.logger.log(1700, "This is a custom level message")
-    logger.logger.log(1800, "This is a custom level message")
-    logger.logger.log(1900, "This is a custom level message")
-    logger.logger.log(2000, "This is a custom level message")
\ No newline at end of file
+        path = os.path.abspath(f"log/{self.log_file}")
+        registry = HandlerRegistry()
+        self.file_handler = registry.get(('file', path), lambda: self._handler(
+            self._file_handler(path, max_bytes, backup_count, rotation, when, compression)))
+        registry.set_budget(budget_bytes)
+        registry.enforce_budget()
+        self.console_handler = registry.get(('console', structured), lambda: self._handler(logging.StreamHandler(sys.stdout)))
+        self.queue_handler = None
+        self.listener = None
+        if async_logging:
+            self.queue_handler = registry.get(('queue', path), lambda: DroppingQueueHandler(queue.Queue(queue_size)))
+            self.listener = registry.get(('listener', path), self._start_listener)
+            handlers = [self.queue_handler]
+        else:
+            handlers = [self.file_handler, self.console_handler]
+        for handler in self.logger.handlers[:]:
+            if handler not in handlers and registry.owns(handler):
+                self.logger.removeHandler(handler) # The logger was set up before in the other mode
+        for handler in handlers:
+            self.logger.addHandler(handler) # No-op if the handler is already attached
+
+    @staticmethod
+    def _file_handler(path, max_bytes, backup_count, rotation, when, compression):
+        if rotation == 'time':
+            if compression:
+                return CompressingTimedRotatingFileHandler(path, compression, when=when, backupCount=backup_count)
+            return TimedRotatingFileHandler(path, when=when, backupCount=backup_count)
+        if compression:
+            return CompressingRotatingFileHandler(path, compression, maxBytes=max_bytes, backupCount=backup_count)
+        return RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+
+    def _handler(self, handler):
+        handler.setFormatter(self.formatter)
+        return handler
+
+    def _start_listener(self):
+        listener = DrainingQueueListener(self.queue_handler.queue, self.file_handler, self.console_handler,
+                                         respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop) # Flush the records still in the queue on exit
+        return listener
+
+    @property
+    def dropped_records(self):
+        return self.queue_handler.dropped if self.queue_handler else 0
@@ -0,0 +1,270 @@
+import asyncio
+import bisect
+import threading
+import time
+
+from utils.singleton import Singleton
+
+# Latency buckets in seconds, from a fast local call to a slow poll over a bad link
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape(value, quote=True):
+    # Label values escape backslashes, double quotes and line feeds in the text exposition format, help texts only
+    # backslashes and line feeds
+    value = str(value).replace('\\', '\\\\').replace('\n', '\\n')
+    return value.replace('"', '\\"') if quote else value
+
+
+def message_bytes(data):
+    """
+    Get the size of a websocket message on the wire, before compression.
+
+    Args:
+        data (str | bytes): The message, text messages are sent as UTF-8.
+
+    Returns:
+        int: The size of the message in bytes.
+    """
+    return len(data.encode('utf-8')) if isinstance(data, str) else len(data)
+
+
+class Metric:
+    """
+    Base class of the metrics.
+
+    A metric holds one value per combination of label values. Updating a metric is a dictionary update, so the
+    instrumented code pays almost nothing; the text exposition is only built when the metrics are scraped.
+
+    Attributes:
+        name (str): The name of the metric.
+        help (str): The description of the metric.
+        type (str): The type of the metric in the text exposition format.
+    """
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items())) if labels else ()
+
+    @staticmethod
+    def _labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        with self._lock:
+            if not self._values:
+                return [f'{self.name} 0']  # Expose the metric before its first update
+            return [f'{self.name}{self._labels(key)} {value}' for key, value in self._values.items()]
+
+    def render(self):
+        return [f'# HELP {self.name} {escape(self.help, quote=False)}', f'# TYPE {self.name} {self.type}'] + self.samples()
+
+
+class Counter(Metric):
+    """
+    A value that only goes up, such as a number of polls.
+
+    Methods:
+        inc(amount: float, **labels): Increments the counter.
+    """
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, such as a number of open connections.
+
+    Methods:
+        set(value: float, **labels): Sets the gauge.
+        inc(amount: float, **labels): Increments the gauge.
+        dec(amount: float, **labels): Decrements the gauge.
+    """
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """
+    A distribution of observed values, such as latencies, counted in cumulative buckets.
+
+    Methods:
+        observe(value: float, **labels): Records a value.
+        time(**labels): A context manager recording the time spent in its block.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, plus the +Inf bucket, then the sum of the values
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        lines = []
+        with self._lock:
+            for key, counts in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{self._labels(key, [("le", bound)])} {cumulative}')
+                lines.append(f'{self.name}_sum{self._labels(key)} {counts[-1]}')
+                lines.append(f'{self.name}_count{self._labels(key)} {cumulative}')
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class MetricsRegistry(Singleton):
+    """
+    The process-wide set of metrics.
+
+    Metrics are created on first use with counter(), gauge() or histogram() and returned again afterwards, so every
+    module can get the metric it updates by name without passing it around.
+
+    Example:
+        polls = MetricsRegistry().counter('thintrust_polls_started_total', 'Polls started.')
+        polls.inc()
+
+    Attributes:
+        metrics (dict): The metrics by name.
+
+    Methods:
+        counter(name: str, help: str) -> Counter: Gets or creates a counter.
+        gauge(name: str, help: str) -> Gauge: Gets or creates a gauge.
+        histogram(name: str, help: str, buckets: tuple) -> Histogram: Gets or creates a histogram.
+        render() -> str: Renders every metric in the text exposition format.
+    """
+
+    def __init__(self):
+        if hasattr(self, 'metrics'):
+            return  # The registry is shared, only initialize it once
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args):
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, *args)
+            return self.metrics[name]
+
+    def counter(self, name, help):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+
+class MetricsServer:
+    """
+    Serve the metrics in the text exposition format over HTTP.
+
+    The server runs in the event loop of the process it instruments and does nothing until it is scraped. Each scrape
+    also measures the event loop lag, the time a callback waits before the loop runs it, which shows how busy the loop
+    is at that moment.
+
+    Attributes:
+        host (str): The address to listen on. The default value is 127.0.0.1, the metrics are only served locally.
+        port (int): The port to listen on.
+
+    Methods:
+        start(): Starts serving.
+        stop(): Stops serving.
+    """
+
+    def __init__(self, port, host='127.0.0.1', registry=None):
+        self.host = host
+        self.port = port
+        self.registry = registry or MetricsRegistry()
+        self.server = None
+        self.loop_lag = self.registry.gauge('thintrust_event_loop_lag_seconds',
+                                            'Time a callback waited for the event loop, measured at scrape time.')
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _measure_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        scheduled = loop.time()
+        ran = loop.create_future()
+        loop.call_soon(lambda: ran.set_result(loop.time()))
+        self.loop_lag.set(await ran - scheduled)
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+            path = request.split(b' ')[1] if request.count(b' ') >= 2 else b'/'
+            if path in (b'/', b'/metrics'):
+                await self._measure_loop_lag()
+                body = self.registry.render().encode('utf-8')
+                status = b'200 OK'
+            else:
+                body = b'Not found\n'
+                status = b'404 Not Found'
+            writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
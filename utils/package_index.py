@@ -0,0 +1,133 @@
+import os
+
+from utils.singleton import Singleton
+
+
+class PackageIndex(Singleton):
+    """
+    An in-memory index of the installed dpkg packages.
+
+    The index parses the dpkg status database once into a map of installed packages and their versions, so checking
+    whether a package is installed no longer forks a dpkg-query process per package. The index is shared by the whole
+    process (it is a Singleton) and is rebuilt automatically when dpkg changes the status database, which is detected
+    from the mtime and size of the status file, the lock file and the updates journal directory.
+
+    Example:
+        index = PackageIndex()
+        index.is_installed('overlayroot')  # True
+        index.version('overlayroot')  # '0.47'
+
+    Attributes:
+        admin_dir (str): The dpkg admin directory, /var/lib/dpkg by default.
+        packages (dict): A dictionary of installed package names to their versions. Packages are also indexed as
+        name:architecture so multi-arch names resolve.
+
+    Args:
+        admin_dir (str): The dpkg admin directory. Only used the first time the index is created.
+
+    Methods:
+        refresh(force: bool) -> bool: Reloads the index if the dpkg database changed.
+        is_installed(package_name: str) -> bool: Checks if a package is installed.
+        version(package_name: str) -> str: Gets the installed version of a package.
+        query(*package_names: str) -> dict: Gets the installed versions of several packages.
+    """
+    def __init__(self, admin_dir='/var/lib/dpkg'):
+        if hasattr(self, 'packages'):
+            return  # The index is shared, only initialize it once
+        self.admin_dir = admin_dir
+        self.packages = {}
+        self._signature = None
+
+    def _stat_signature(self):
+        """
+        Build a signature of the dpkg database state.
+
+        Returns:
+            tuple: The inode, size and mtime of the status file, lock file and updates directory.
+        """
+        signature = []
+        for name in ('status', 'lock', 'updates'):
+            try:
+                st = os.stat(os.path.join(self.admin_dir, name))
+                signature.append((st.st_ino, st.st_size, st.st_mtime_ns))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def refresh(self, force=False):
+        """
+        Reload the index if the dpkg database changed since it was last loaded.
+
+        Args:
+            force (bool): Reload the index even if the dpkg database looks unchanged.
+
+        Returns:
+            bool: True if the index was reloaded, False if the cached index was still valid.
+        """
+        signature = self._stat_signature()
+        if not force and signature == self._signature:
+            return False
+        packages = {}
+        try:
+            with open(os.path.join(self.admin_dir, 'status'), 'r', encoding='utf-8', errors='replace') as f:
+                fields = {}
+                for line in f:
+                    if line == '\n':
+                        self._add_package(packages, fields)
+                        fields = {}
+                    elif not line[0].isspace():  # Skip the continuation lines of multi-line fields
+                        key, _, value = line.partition(':')
+                        if key in ('Package', 'Status', 'Version', 'Architecture'):
+                            fields[key] = value.strip()
+                self._add_package(packages, fields)
+        except FileNotFoundError:
+            pass
+        self.packages = packages
+        self._signature = signature
+        return True
+
+    @staticmethod
+    def _add_package(packages, fields):
+        if 'Package' in fields and fields.get('Status', '').endswith(' installed'):
+            packages[fields['Package']] = fields.get('Version')
+            if 'Architecture' in fields:
+                packages[f"{fields['Package']}:{fields['Architecture']}"] = fields.get('Version')
+
+    def is_installed(self, package_name):
+        """
+        Check if a package is installed.
+
+        Args:
+            package_name (str): The name of the package, optionally with an architecture qualifier.
+
+        Returns:
+            bool: True if the package is installed, False otherwise.
+        """
+        self.refresh()
+        return package_name in self.packages
+
+    def version(self, package_name):
+        """
+        Get the installed version of a package.
+
+        Args:
+            package_name (str): The name of the package, optionally with an architecture qualifier.
+
+        Returns:
+            str: The installed version, or None if the package is not installed.
+        """
+        self.refresh()
+        return self.packages.get(package_name)
+
+    def query(self, *package_names):
+        """
+        Get the installed versions of several packages.
+
+        Args:
+            *package_names (str): The names of the packages.
+
+        Returns:
+            dict: A dictionary of package names to their installed version, or None if the package is not installed.
+        """
+        self.refresh()
+        return {name: self.packages.get(name) for name in package_names}
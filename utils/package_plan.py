@@ -0,0 +1,169 @@
+import logging
+import os
+import subprocess
+
+from utils.package_index import PackageIndex
+
+
+class PackagePlan:
+    """
+    Collect every package ThinTrust needs and install them in a single apt transaction.
+
+    Provisioning used to call apt once per setup step, which re-read the package cache and took the dpkg lock
+    every time. A PackagePlan gathers the packages from the config and the setup steps first, drops the ones that
+    are already installed using the shared PackageIndex, and then runs one `apt-get install` for the rest.
+
+    Attributes:
+        logger (logging.Logger): The logger used to report progress.
+        packages (list): The packages added to the plan, in the order they were added and without duplicates.
+
+    Args:
+        logger (logging.Logger): The logger used to report progress. The default value is the logger of this module.
+
+    Methods:
+        add(*packages): Adds packages to the plan.
+        installed() -> set: Returns the packages from the plan that are already installed.
+        pending() -> list: Returns the packages from the plan that still need to be installed.
+        run(update: bool, archives: str) -> bool: Installs the pending packages in a single apt transaction.
+    """
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.packages = []
+
+    def add(self, *packages):
+        """
+        Add packages to the plan.
+
+        Packages that are already part of the plan are ignored, so every setup step can add what it needs without
+        checking what the other steps added.
+
+        Args:
+            *packages (str): The names of the packages to add.
+
+        Returns:
+            PackagePlan: The plan itself so calls can be chained.
+        """
+        for package in packages:
+            if package and package not in self.packages:
+                self.packages.append(package)
+        return self
+
+    def installed(self):
+        """
+        Get the packages from the plan that are already installed.
+
+        The packages are looked up in the shared PackageIndex, which only re-reads the dpkg status database when
+        dpkg changed it.
+
+        Returns:
+            set: The names of the installed packages.
+        """
+        return {name for name, version in PackageIndex().query(*self.packages).items() if version is not None}
+
+    def pending(self):
+        """
+        Get the packages from the plan that still need to be installed.
+
+        Returns:
+            list: The names of the packages that are not installed yet, in plan order.
+        """
+        installed = self.installed()
+        return [package for package in self.packages if package not in installed]
+
+    def run(self, update=True, archives=None):
+        """
+        Install the pending packages in a single apt transaction.
+
+        apt is asked to write its machine readable status lines to stdout so the progress of the download and
+        install phases can be logged while the transaction runs. Every other line is logged at debug level.
+
+        When an archives directory is given, for example the debs directory of a provisioning bundle, the .deb files
+        of the packages that are not installed yet are passed to apt as local files. apt resolves the dependencies
+        between them without package lists, so the install works on a client that never ran apt-get update, and the
+        lists are not refreshed.
+
+        Args:
+            update (bool): Whether to refresh the package lists before installing. Skipped when nothing is pending.
+            archives (str): A directory of .deb files to install from instead of the network.
+
+        Returns:
+            bool: True if all packages are installed, False otherwise.
+        """
+        pending = self.pending()
+        if not pending:
+            self.logger.info('All required packages are already installed, skipping...')
+            return True
+        self.logger.info(f'Installing {len(pending)} of {len(self.packages)} required packages...')
+        self.logger.debug(f'Pending packages: {pending}')
+        env = dict(os.environ, DEBIAN_FRONTEND='noninteractive')
+        try:
+            command = ['apt-get', 'install', '-y', '-o', 'APT::Status-Fd=1']
+            if archives:
+                targets = self._local_debs(archives, pending)
+                if targets is None:
+                    return False
+                command.append('--no-download')
+            else:
+                targets = pending
+                if update and self._apt(['apt-get', 'update', '-y'], env) != 0:
+                    self.logger.error('Error updating package lists.')
+                    return False
+            if self._apt(command + targets, env) != 0:
+                self.logger.error(f'Error installing packages: {pending}')
+                return False
+            return True
+        except Exception as e:
+            self.logger.error(f'Error installing packages: {e}')
+            return False
+
+    def _local_debs(self, archives, pending):
+        """
+        Get the .deb files to install from a directory, the pending packages and their missing dependencies.
+
+        Args:
+            archives (str): The directory of .deb files, named <package>_<version>_<arch>.deb as apt-get download
+                names them.
+            pending (list): The packages that must be installed.
+
+        Returns:
+            list: The absolute paths of the .deb files of the packages that are not installed, or None if a pending
+            package has no .deb file in the directory.
+        """
+        debs = {}
+        for name in sorted(os.listdir(archives)):
+            if name.endswith('.deb'):
+                debs[name.split('_', 1)[0]] = os.path.join(os.path.abspath(archives), name)
+        missing = [package for package in pending if package not in debs]
+        if missing:
+            self.logger.error(f'No .deb file for {missing} in {archives}.')
+            return None
+        versions = PackageIndex().query(*debs)
+        return [path for package, path in debs.items() if versions.get(package) is None]
+
+    def _apt(self, command, env):
+        """
+        Run an apt command and stream its output to the logger.
+
+        Args:
+            command (list): The command to run.
+            env (dict): The environment to run the command with.
+
+        Returns:
+            int: The exit code of the command.
+        """
+        process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        last_percent = None
+        for line in iter(process.stdout.readline, b''):
+            line = line.decode(errors='replace').strip()
+            # Status lines look like "pmstatus:<package>:<percent>:<description>"
+            if line.startswith(('dlstatus:', 'pmstatus:')):
+                parts = line.split(':', 3)
+                if len(parts) == 4:
+                    percent = int(float(parts[2]))
+                    if percent != last_percent:
+                        self.logger.info(f'[{percent:3d}%] {parts[3]}')
+                        last_percent = percent
+                continue
+            self.logger.debug(line)
+        process.stdout.close()
+        return process.wait()
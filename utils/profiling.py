@@ -0,0 +1,198 @@
+import asyncio
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+# Longest profiling window, so a forgotten profile cannot slow a process down for good
+MAX_DURATION = 300
+PROFILE_MODES = ('sample', 'cprofile')
+
+
+class StackSampler:
+    """
+    Sample the stacks of every thread of the process at a fixed interval.
+
+    The sampler runs in its own thread and reads the current frame of every other thread with sys._current_frames, so
+    the profiled code is not instrumented and runs at full speed between samples. The samples are aggregated into
+    collapsed stacks, one line per distinct stack with the number of times it was seen, the input format of
+    flamegraph.pl, speedscope and most flame graph viewers.
+
+    Attributes:
+        interval (float): The time between samples in seconds.
+        stacks (collections.Counter): The number of samples of each collapsed stack.
+        samples (int): The number of sampling rounds taken.
+
+    Methods:
+        start(): Starts sampling.
+        stop(): Stops sampling.
+        collapsed() -> str: Renders the samples as collapsed stacks.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+    def _sample(self):
+        me = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='StackSampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class Profiler:
+    """
+    Profile a running process for a bounded window, on demand.
+
+    Two modes are available. 'sample' samples the stacks of every thread with a StackSampler and writes collapsed
+    stacks (.collapsed) for flame graphs; it has a low, constant overhead and is the mode to use in production.
+    'cprofile' runs cProfile on the event loop thread and writes a pstats file (.pstats) with exact call counts,
+    at the cost of slowing the loop down while it runs. A window ends after its duration, when stop() is called or
+    when the profiler is toggled again, and the file is written to the output directory.
+
+    Example:
+        profiler = Profiler(logger, 'agent')
+        profiler.install_signal_handler()  # kill -USR2 <pid> starts, or stops, a 30 seconds window
+
+    Attributes:
+        logger (logging.Logger): The logger used to report the profile files.
+        name (str): The prefix of the profile files.
+        output_dir (str): The directory the profile files are written to.
+        last_output (str): The path of the last profile written.
+
+    Args:
+        logger (logging.Logger): The logger used to report the profile files.
+        name (str): The prefix of the profile files.
+        output_dir (str): The directory the profile files are written to. The default value is 'profiles'.
+
+    Methods:
+        start(duration: float, mode: str, interval: float) -> str: Starts a profiling window.
+        stop() -> str: Ends the profiling window and writes the profile.
+        toggle() -> str: Starts a window with the default settings, or ends the current one.
+        install_signal_handler(signum: int): Toggles the profiler when the process receives a signal.
+    """
+
+    def __init__(self, logger, name, output_dir='profiles'):
+        self.logger = logger
+        self.name = name
+        self.output_dir = output_dir
+        self.last_output = None
+        self._mode = None
+        self._output = None
+        self._sampler = None
+        self._cprofile = None
+        self._timer = None
+
+    @property
+    def active(self):
+        return self._mode is not None
+
+    def start(self, duration=30, mode='sample', interval=0.005):
+        """
+        Start a profiling window.
+
+        Must be called from the event loop thread, which is the thread cProfile profiles.
+
+        Args:
+            duration (float): The length of the window in seconds, at most MAX_DURATION.
+            mode (str): 'sample' or 'cprofile'. The default value is 'sample'.
+            interval (float): The time between samples in sample mode.
+
+        Returns:
+            str: The path the profile will be written to, or None if a window is already running.
+
+        Raises:
+            ValueError: If the mode is unknown.
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f'Unknown profiling mode {mode}, use one of {", ".join(PROFILE_MODES)}')
+        if self.active:
+            return None
+        duration = min(float(duration), MAX_DURATION)
+        os.makedirs(self.output_dir, exist_ok=True)
+        extension = 'collapsed' if mode == 'sample' else 'pstats'
+        self._output = os.path.join(self.output_dir,
+                                    f'{self.name}-{datetime.now().strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.{extension}')
+        self._mode = mode
+        if mode == 'sample':
+            self._sampler = StackSampler(interval)
+            self._sampler.start()
+        else:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        self._timer = asyncio.get_event_loop().call_later(duration, self.stop)
+        self.logger.info(f'Profiling ({mode}) for {duration:g}s, writing {self._output}')
+        return self._output
+
+    def stop(self):
+        """
+        End the profiling window and write the profile.
+
+        Returns:
+            str: The path of the profile, or None if no window was running.
+        """
+        if not self.active:
+            return None
+        self._timer.cancel()
+        if self._mode == 'sample':
+            self._sampler.stop()
+            with open(self._output, 'w') as f:
+                f.write(self._sampler.collapsed())
+            self.logger.info(f'Profile of {self._sampler.samples} samples written to {self._output}')
+        else:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self._output)
+            self.logger.info(f'Profile written to {self._output}')
+        self.last_output = self._output
+        self._mode = self._sampler = self._cprofile = self._timer = None
+        return self.last_output
+
+    def toggle(self):
+        return self.stop() if self.active else self.start()
+
+    def install_signal_handler(self, signum=signal.SIGUSR2):
+        asyncio.get_event_loop().add_signal_handler(signum, self.toggle)
+
+
+if __name__ == '__main__':
+    # Render a pstats file as the top 30 functions by cumulative time
+    import pstats
+    if len(sys.argv) != 2:
+        print('Usage: python -m utils.profiling <profile.pstats>')
+        exit(1)
+    pstats.Stats(sys.argv[1]).sort_stats('cumulative').print_stats(30)
@@ -1,20 +1,186 @@
+import functools
+import lzma
+import os
+import re
+import shutil
 import subprocess
-import shlex
+import tarfile
+import tempfile
+import time
+
+try:
+    import py7zr
+    from py7zr.callbacks import ExtractCallback
+except ImportError:
+    py7zr = None
+    ExtractCallback = object
+
+TAR_MODES = {'.tar': '', '.tar.gz': 'gz', '.tgz': 'gz', '.tar.bz2': 'bz2', '.tar.xz': 'xz', '.txz': 'xz', '.tar.zst': 'zst'}
+# The codec used by each tar compression mode, and the codecs available in 7z archives
+TAR_CODECS = {'': 'none', 'gz': 'gzip', 'bz2': 'bzip2', 'xz': 'xz', 'zst': 'zstd'}
+SEVENZIP_CODECS = ('lzma2', 'zstd')
+CHUNK_SIZE = 1024 * 1024
+# The extraction filter of tarfile, in Python 3.12 and the security releases of 3.8 to 3.11, or None
+DATA_FILTER = getattr(tarfile, 'data_filter', None)
+
+
+@functools.lru_cache(maxsize=None)
+def find_7z():
+    """
+    Resolve the path of the 7-Zip binary once per process.
+
+    Returns:
+        str: The path of the 7z (or 7za) binary, or None if it is not installed.
+    """
+    return shutil.which('7z') or shutil.which('7za')
+
+
+@functools.lru_cache(maxsize=None)
+def binary_codecs(path):
+    """
+    Get the codecs a 7-Zip binary supports, once per process.
+
+    The codecs depend on the build: the p7zip of Debian and Ubuntu has no zstd codec, while some 7-Zip builds do.
+
+    Args:
+        path (str): The path of the 7z binary.
+
+    Returns:
+        frozenset: The lowercase names of the codecs listed by '7z i', empty if the binary could not be queried.
+    """
+    try:
+        output = subprocess.check_output([path, 'i'], stderr=subprocess.DEVNULL).decode('utf-8', errors='replace')
+    except (OSError, subprocess.CalledProcessError):
+        return frozenset()
+    codecs = set()
+    section = None
+    for line in output.splitlines():
+        if line.endswith(':') and not line[:1].isspace():  # Section headers such as "Formats:" and "Codecs:"
+            section = line[:-1]
+        elif section == 'Codecs' and line.strip():
+            codecs.add(line.split()[-1].lower())  # The codec name is the last column
+    return frozenset(codecs)
+
+
+def tar_mode(archive):
+    """
+    Get the tarfile compression mode for an archive name.
+
+    Args:
+        archive (str): The path of the archive.
+
+    Returns:
+        str: The tarfile compression ('', 'gz', 'bz2' or 'xz'), or None if the archive is not a tar archive.
+    """
+    for suffix, mode in TAR_MODES.items():
+        if archive.endswith(suffix):
+            return mode
+    return None
+
+
+class _ProgressReader:
+    """A file wrapper that reports the number of bytes read through it."""
+
+    def __init__(self, file, progress):
+        self.file = file
+        self.progress = progress
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.progress(len(data))
+        return data
+
+
+class _Py7zrProgress(ExtractCallback):
+    """A py7zr extraction callback that forwards byte progress."""
+
+    def __init__(self, progress, total):
+        self.progress = progress
+        self.total = total
+        self.done = 0
+
+    def report_start_preparation(self):
+        pass
+
+    def report_start(self, processing_file_path, processing_bytes):
+        pass
+
+    def report_update(self, decompressed_bytes):
+        self.done += int(decompressed_bytes)
+        self.progress(self.done, self.total)
+
+    def report_end(self, processing_file_path, wrote_bytes):
+        pass
+
+    def report_warning(self, message):
+        pass
+
+    def report_postprocess(self):
+        pass
+
 
 class SevenZip:
     """
     A class for interacting with the 7-Zip compression utility.
+
+    Archives are handled by one of three backends. Tar archives (.tar, .tar.gz, .tar.bz2, .tar.xz) are always handled
+    in-process with the tarfile module. 7z archives are handled by the 7z binary, or in-process by py7zr when the
+    binary is missing or when the 'native' backend is requested. The in-process backends stream the archive entries
+    and report byte level progress. Extraction always happens in a temporary directory next to the destination and
+    the extracted entries are then renamed into place, so a failed extraction never leaves half-written files behind.
+
+    Attributes:
+        path (str): The path of the 7z binary, resolved once per process, or None if it is not installed.
+        backend (str): The backend to use for 7z archives: 'auto', 'binary' or 'native'.
+        logger (logging.Logger): The logger used to report errors, errors are printed when None.
+        last_error (str): The detail of the last error, or None if the last operation succeeded.
+        last_stats (dict): The codec, sizes, compression ratio and throughput of the last successful compress().
+
+    Args:
+        backend (str): The backend to use for 7z archives. 'auto' prefers the 7z binary and falls back to py7zr.
+        logger (logging.Logger): The logger used to report errors.
     """
 
-    def __init__(self):
-        try:
-            self.path = subprocess.check_output(['which', '7z']).decode('utf-8').strip()
-        except Exception as e:
-            print(f'Error getting 7zip path: {e}')
-            print('Installing 7zip...')
-            subprocess.check_output('apt-get install -y p7zip-full', shell=True)
-            self.path = subprocess.check_output(['which', '7z']).decode('utf-8').strip()
-    
+    def __init__(self, backend='auto', logger=None):
+        if backend not in ('auto', 'binary', 'native'):
+            raise ValueError(f'Invalid backend {backend}. Available backends are: auto, binary, native')
+        self.path = find_7z()
+        self.backend = backend
+        self.logger = logger
+        self.last_error = None
+        self.last_stats = None
+        if self.path is None and py7zr is None:
+            self._error('7zip is not installed and py7zr is not available, only tar archives are supported. '
+                        'Install p7zip-full or py7zr for 7z support.')
+
+    def _error(self, message):
+        self.last_error = message
+        if self.logger:
+            self.logger.error(message)
+        else:
+            print(message)
+
+    def _use_binary(self, codec=None):
+        """
+        Decide which backend handles 7z archives.
+
+        Args:
+            codec (str): The codec to compress with. When the 7z binary lacks it, 'auto' falls back to py7zr.
+
+        Returns:
+            bool: True if the 7z binary should be used, False if py7zr should be used.
+        """
+        if self.backend == 'binary' or (self.backend == 'auto' and self.path):
+            if not self.path:
+                raise RuntimeError('7zip binary not found')
+            if codec in (None, 'lzma2') or codec in binary_codecs(self.path):
+                return True
+            if self.backend == 'binary':
+                raise RuntimeError(f'{self.path} has no {codec} codec')
+        if py7zr is None:
+            raise RuntimeError('py7zr is not installed')
+        return False
+
     def get_version(self):
         """
         Get the version of the 7-Zip utility.
@@ -30,44 +196,500 @@ class SevenZip:
         except Exception as e:
             print(f'Error getting 7zip version: {e}')
             return None
-        
-    def compress(self, source, destination):
+
+    def compress(self, source, destination, progress=None, codec=None, level=None, threads=None,
+                 dictionary_size=None, volume_size=None, solid=True):
         """
-        Compress a file or directory using the 7-Zip utility.
+        Compress a file or directory.
+
+        The archive format is picked from the destination name: tar archives are written with tarfile, anything else
+        is written as a 7z archive. The archive is written to a temporary file first and renamed into place.
+
+        Multi-threaded compression is used where the codec supports it: the 7z binary and py7zr for 7z archives, and
+        the xz and zstd binaries, when installed, for .tar.xz and .tar.zst archives. The compression ratio and
+        throughput of the run are stored in last_stats.
 
         Args:
             source (str): The path to the file or directory to compress.
             destination (str): The path to the destination archive file.
+            progress (callable): Called with (done, total) while compressing. The values are bytes for the
+            in-process backends and percent for the 7z binary.
+            codec (str): 'lzma2' or 'zstd' for 7z archives. Tar archives take their codec from the destination
+            suffix ('xz', 'zstd', 'gzip' or 'bzip2'), a different codec raises a ValueError. Defaults to lzma2 or
+            the suffix codec. zstd 7z archives are written by py7zr when the 7z binary has no zstd codec.
+            level (int): The compression level, 0-9 for lzma2, xz, gzip and bzip2, 1-22 for zstd.
+            threads (int): The number of compression threads, 0 or None lets the codec use every CPU.
+            dictionary_size (int): The dictionary (window) size in bytes, for lzma2, xz and zstd.
+            volume_size (int): Split the archive into volumes of this many bytes, named destination.001, .002...
+            solid (bool): Whether to compress the files of a 7z archive as one solid block.
 
         Returns:
             bool: True if the compression was successful, False otherwise.
         """
+        self.last_error = None
+        self.last_stats = None
+        partial = f'{destination}.partial'
+        mode = tar_mode(destination)
+        if mode is not None:
+            if codec not in (None, TAR_CODECS[mode]):
+                raise ValueError(f'Codec {codec} does not match {destination}, expected {TAR_CODECS[mode]}')
+            codec = TAR_CODECS[mode]
+        elif codec is None:
+            codec = 'lzma2'
+        elif codec not in SEVENZIP_CODECS:
+            raise ValueError(f'Invalid codec {codec} for 7z archives. Available codecs are: {SEVENZIP_CODECS}')
+        start = time.perf_counter()
         try:
-            if subprocess.call([self.path, 'a', shlex.quote(destination), shlex.quote(source)]) != 0:
-                print(f'Error compressing {source} to {destination}')
-                return False
+            binary = False
+            if mode is not None:
+                self._tar_compress(source, partial, mode, progress, level, threads, dictionary_size)
+            elif self._use_binary(codec):
+                binary = True
+                command = [self.path, 'a', '-t7z', '-bsp1', '-bso0', '-y', f'-m0={codec}', f'-ms={"on" if solid else "off"}']
+                if level is not None:
+                    command.append(f'-mx={level}')
+                if threads:
+                    command.append(f'-mmt={threads}')
+                if dictionary_size:
+                    command.append(f'-md={dictionary_size}b')
+                if volume_size:
+                    command.append(f'-v{volume_size}b')
+                self._run(command + [partial, source], progress)
+            else:
+                if codec == 'zstd':
+                    filters = [{'id': py7zr.FILTER_ZSTD, 'level': 3 if level is None else level}]
+                else:
+                    filters = [{'id': py7zr.FILTER_LZMA2, 'preset': 7 if level is None else level}]
+                    if dictionary_size:
+                        filters[0]['dict_size'] = dictionary_size
+                with py7zr.SevenZipFile(partial, 'w', filters=filters, mp=threads != 1) as archive:
+                    archive.writeall(source, arcname=os.path.basename(os.path.normpath(source)))
+                if progress:
+                    size = _tree_size(source)
+                    progress(size, size)
+            outputs = _finish(partial, destination, volume_size, split=not binary)
+            seconds = time.perf_counter() - start
+            input_bytes = _tree_size(source)
+            output_bytes = sum(os.path.getsize(output) for output in outputs)
+            self.last_stats = {
+                'codec': codec,
+                'level': level,
+                'threads': threads,
+                'input_bytes': input_bytes,
+                'output_bytes': output_bytes,
+                'ratio': round(output_bytes / input_bytes, 4) if input_bytes else None,
+                'seconds': round(seconds, 4),
+                'mb_per_s': round(input_bytes / seconds / 1024 ** 2, 2) if seconds else None,
+                'volumes': len(outputs),
+            }
             return True
         except Exception as e:
-            print(f'Error compressing {source} to {destination}: {e}')
+            self._error(f'Error compressing {source} to {destination}: {e}')
+            for leftover in _volumes(partial) + [partial]:
+                if os.path.exists(leftover):
+                    os.remove(leftover)
             return False
-    
-    def decompress(self, source, destination):
+
+    def decompress(self, source, destination, members=None, progress=None, replace=False):
         """
-        Decompress an archive file using the 7-Zip utility.
+        Decompress an archive file.
+
+        The archive is extracted into a temporary directory inside the destination, then every top-level entry, or
+        every selected member, is renamed into place. An existing directory with the same name is merged with the
+        extracted one: the files in the archive replace the existing ones and the other existing files are kept,
+        unless replace is True.
 
         Args:
             source (str): The path to the archive file to decompress.
             destination (str): The path to the destination directory.
+            members (list): Only extract these entries. A directory entry selects everything below it.
+            progress (callable): Called with (done, total) while extracting. The values are bytes for the
+            in-process backends and percent for the 7z binary.
+            replace (bool): Replace existing directories as a whole, removing the files that are not in the archive.
+            The default value is False.
 
         Returns:
             bool: True if the decompression was successful, False otherwise.
         """
+        self.last_error = None
+        os.makedirs(destination, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix='.sevenzip-', dir=destination)
+        work = tempfile.mkdtemp(prefix='.sevenzip-work-', dir=destination)
         try:
-            if subprocess.call([self.path, 'x', shlex.quote(source), '-o' + shlex.quote(destination)]) != 0:
-                print(f'Error decompressing {source} to {destination}')
-                return False
+            archive_name = source[:-4] if source.endswith('.001') else source
+            mode = tar_mode(archive_name)
+            if source != archive_name and (mode is not None or not self._use_binary()):
+                # The 7z binary reads split archives itself, the in-process backends get the volumes joined
+                source = _join_volumes(source, os.path.join(work, os.path.basename(archive_name)))
+            if mode == 'zst':
+                source = self._zstd_decompress(source, os.path.join(work, 'archive.tar'))
+            if mode is not None:
+                self._tar_decompress(source, staging, members, progress)
+            elif self._use_binary():
+                self._run([self.path, 'x', '-y', '-bsp1', '-bso0', source, f'-o{staging}', *(members or [])], progress)
+            else:
+                with py7zr.SevenZipFile(source, 'r') as archive:
+                    infos = [info for info in archive.list() if _selected(info.filename, members)]
+                    callback = _Py7zrProgress(progress, sum(info.uncompressed for info in infos)) if progress else None
+                    if members:
+                        archive.extract(staging, targets=[info.filename for info in infos], callback=callback)
+                    else:
+                        archive.extractall(staging, callback=callback)
+            # Rename the selected members, or every top-level entry, into place
+            for entry in [member.strip('/') for member in members] if members else os.listdir(staging):
+                if os.path.lexists(os.path.join(staging, entry)):
+                    os.makedirs(os.path.dirname(os.path.join(destination, entry)), exist_ok=True)
+                    if replace:
+                        _replace(os.path.join(staging, entry), os.path.join(destination, entry))
+                    else:
+                        _merge(os.path.join(staging, entry), os.path.join(destination, entry))
             return True
         except Exception as e:
-            print(f'Error decompressing {source} to {destination}: {e}')
+            self._error(f'Error decompressing {source} to {destination}: {e}')
             return False
-    
\ No newline at end of file
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+            shutil.rmtree(work, ignore_errors=True)
+
+    def _run(self, command, progress):
+        """
+        Run the 7z binary, forwarding its percent progress and raising with its error output on failure.
+
+        Args:
+            command (list): The command to run. Arguments are passed as-is, without a shell.
+            progress (callable): Called with (percent, 100) as the binary reports progress.
+        """
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        buffer = b''
+        while True:
+            data = process.stdout.read1(4096) if hasattr(process.stdout, 'read1') else process.stdout.read(4096)
+            if not data:
+                break
+            # 7z redraws its progress line with backspaces, so look for the last percentage in the buffer
+            buffer = (buffer + data)[-256:]
+            found = re.findall(rb'(\d+)%', buffer)
+            if found and progress:
+                progress(int(found[-1]), 100)
+        stderr = process.stderr.read().decode('utf-8', errors='replace').strip()
+        if process.wait() != 0:
+            raise RuntimeError(f'7z exited with code {process.returncode}: {stderr}')
+        if progress:
+            progress(100, 100)
+
+    def _tar_compress(self, source, destination, mode, progress, level=None, threads=None, dictionary_size=None):
+        total = _tree_size(source) if progress else 0
+        done = 0
+
+        def advance(count):
+            nonlocal done
+            done += count
+            progress(done, total)
+
+        # xz and zstd archives are piped through their binaries, when installed, for multi-threaded compression
+        command = None
+        if mode == 'xz' and threads != 1 and shutil.which('xz'):
+            preset = 6 if level is None else level
+            command = ['xz', '-c', f'-T{threads or 0}', f'-{preset}']
+            if dictionary_size:
+                command.append(f'--lzma2=preset={preset},dict={dictionary_size}')
+        elif mode == 'zst':
+            if not shutil.which('zstd'):
+                raise RuntimeError('zstd binary not found')
+            level = 3 if level is None else level
+            command = ['zstd', '-c', '-q', f'-T{threads or 0}', f'-{level}']
+            if level > 19:
+                command.append('--ultra')
+            if dictionary_size:
+                command.append(f'--long={max(dictionary_size.bit_length() - 1, 10)}')
+
+        process = None
+        with open(destination, 'wb') as output:
+            if command:
+                process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=output, stderr=subprocess.PIPE)
+                archive = tarfile.open(fileobj=process.stdin, mode='w|')
+            elif mode == 'xz':
+                filters = [{'id': lzma.FILTER_LZMA2, 'preset': 6 if level is None else level}]
+                if dictionary_size:
+                    filters[0]['dict_size'] = dictionary_size
+                compressor = lzma.LZMAFile(output, 'wb', format=lzma.FORMAT_XZ, filters=filters)
+                archive = tarfile.open(fileobj=compressor, mode='w')
+            elif mode in ('gz', 'bz2'):
+                archive = tarfile.open(fileobj=output, mode=f'w:{mode}', compresslevel=9 if level is None else level)
+            else:
+                archive = tarfile.open(fileobj=output, mode='w')
+            try:
+                root = os.path.dirname(os.path.normpath(source))
+                for path in _walk(source):
+                    info = archive.gettarinfo(path, arcname=os.path.relpath(path, root))
+                    if info.isreg():
+                        with open(path, 'rb') as f:
+                            archive.addfile(info, _ProgressReader(f, advance) if progress else f)
+                    else:
+                        archive.addfile(info)
+            finally:
+                archive.close()
+                if command:
+                    process.stdin.close()
+                elif mode == 'xz':
+                    compressor.close()
+        if process and process.wait() != 0:
+            raise RuntimeError(f'{command[0]} exited with code {process.returncode}: '
+                               f"{process.stderr.read().decode('utf-8', errors='replace').strip()}")
+
+    def _zstd_decompress(self, source, destination):
+        if not shutil.which('zstd'):
+            raise RuntimeError('zstd binary not found')
+        result = subprocess.run(['zstd', '-d', '-q', '-f', '--long=31', source, '-o', destination], stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise RuntimeError(f"zstd exited with code {result.returncode}: {result.stderr.decode('utf-8', errors='replace').strip()}")
+        return destination
+
+    def _tar_decompress(self, source, destination, members, progress):
+        with tarfile.open(source, 'r:*') as archive:
+            infos = [info for info in archive.getmembers() if _selected(info.name, members)]
+            total = sum(info.size for info in infos if info.isreg())
+            done = 0
+            root = os.path.realpath(destination)
+            for info in infos:
+                info = _safe_member(info, destination, root)
+                target = os.path.join(destination, info.name)
+                if not info.isreg():
+                    if DATA_FILTER:
+                        archive.extract(info, destination, set_attrs=info.isdir(), filter='data')
+                    else:
+                        archive.extract(info, destination, set_attrs=info.isdir())
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                # A file, or a link made by an earlier entry, is replaced and never written through
+                if os.path.lexists(target) and not os.path.isdir(target):
+                    os.unlink(target)
+                fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+                with archive.extractfile(info) as src, open(fd, 'wb') as dst:
+                    while True:
+                        chunk = src.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        done += len(chunk)
+                        if progress:
+                            progress(done, total)
+                os.chmod(target, info.mode & 0o7777)
+                os.utime(target, (info.mtime, info.mtime))
+
+
+def _inside(path, root):
+    resolved = os.path.realpath(path)
+    # The destination itself is a valid entry, archives made with 'tar -C dir .' start with './'
+    return resolved == root or resolved.startswith(root + os.sep)
+
+
+def _safe_member(info, destination, root):
+    """
+    Check that a tar entry stays inside the destination, links included.
+
+    Args:
+        info (tarfile.TarInfo): The entry.
+        destination (str): The directory the archive is extracted to.
+        root (str): The real path of the destination.
+
+    Returns:
+        tarfile.TarInfo: The entry, with the permissions and owner the data filter of tarfile allows when available.
+
+    Raises:
+        ValueError: If the entry or the target of a link is outside the destination.
+    """
+    target = os.path.join(destination, info.name)
+    if os.path.isabs(info.name) or not _inside(target, root):
+        raise ValueError(f'Unsafe path in archive: {info.name}')
+    if info.issym() or info.islnk():
+        # Symbolic links are relative to their directory, hard links to the root of the archive
+        base = os.path.dirname(target) if info.issym() else destination
+        if os.path.isabs(info.linkname) or not _inside(os.path.join(base, info.linkname), root):
+            raise ValueError(f'Unsafe link in archive: {info.name} -> {info.linkname}')
+    if DATA_FILTER:
+        try:
+            info = DATA_FILTER(info, destination)
+        except tarfile.FilterError as e:
+            raise ValueError(f'Unsafe entry in archive: {e}')
+    return info
+
+def _selected(name, members):
+    if not members:
+        return True
+    name = name.rstrip('/')
+    return any(name == member.rstrip('/') or name.startswith(member.rstrip('/') + '/') for member in members)
+
+
+def _walk(source):
+    yield source
+    if os.path.isdir(source) and not os.path.islink(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in dirs + sorted(files):
+                yield os.path.join(root, name)
+
+
+def _tree_size(source):
+    return sum(os.path.getsize(path) for path in _walk(source) if os.path.isfile(path) and not os.path.islink(path))
+
+
+def _volumes(path):
+    volumes = []
+    while os.path.exists(f'{path}.{len(volumes) + 1:03d}'):
+        volumes.append(f'{path}.{len(volumes) + 1:03d}')
+    return volumes
+
+
+def _finish(partial, destination, volume_size, split):
+    """
+    Move a finished archive into place, splitting it into volumes of volume_size bytes when requested.
+
+    Args:
+        partial (str): The path the archive, or its volumes when the 7z binary split it, was written to.
+        destination (str): The final path of the archive.
+        volume_size (int): The volume size in bytes, or None for a single file.
+        split (bool): Whether the archive still needs to be split, False when the 7z binary already did it.
+
+    Returns:
+        list: The paths of the written archive files.
+    """
+    if not volume_size:
+        os.replace(partial, destination)
+        return [destination]
+    outputs = []
+    if split:
+        with open(partial, 'rb') as f:
+            while True:
+                chunk = f.read(volume_size)
+                if not chunk and outputs:
+                    break
+                outputs.append(f'{destination}.{len(outputs) + 1:03d}')
+                with open(outputs[-1], 'wb') as volume:
+                    volume.write(chunk)
+                if len(chunk) < volume_size:
+                    break
+        os.remove(partial)
+    else:
+        for volume in _volumes(partial):
+            outputs.append(f'{destination}{volume[len(partial):]}')
+            os.replace(volume, outputs[-1])
+    return outputs
+
+
+def _join_volumes(first, destination):
+    with open(destination, 'wb') as output:
+        for volume in _volumes(first[:-4]):
+            with open(volume, 'rb') as f:
+                shutil.copyfileobj(f, output, CHUNK_SIZE)
+    return destination
+
+
+def _replace(source, target):
+    """
+    Rename an extracted entry into place, replacing an existing file or directory.
+
+    Directories cannot be renamed over a non-empty directory, so an existing directory is first renamed out of the
+    way and only removed once the new one is in place.
+    """
+    if os.path.isdir(target) and not os.path.islink(target):
+        old = tempfile.mkdtemp(prefix='.sevenzip-old-', dir=os.path.dirname(target))
+        os.rename(target, os.path.join(old, 'entry'))
+        os.rename(source, target)
+        shutil.rmtree(old, ignore_errors=True)
+    else:
+        os.replace(source, target)
+
+
+def _merge(source, target):
+    """
+    Rename an extracted entry into place, merging an extracted directory into an existing one.
+
+    Files and links replace the existing entry with the same name, the existing entries that are not in the archive
+    are kept.
+    """
+    if os.path.isdir(source) and not os.path.islink(source) and os.path.isdir(target) and not os.path.islink(target):
+        for name in os.listdir(source):
+            _merge(os.path.join(source, name), os.path.join(target, name))
+        shutil.copystat(source, target)
+    else:
+        _replace(source, target)
+
+
+# The archive suffix and levels compared for each codec by benchmark()
+BENCHMARK_CODECS = {
+    'lzma2': ('.7z', (1, 5, 9)),
+    'zstd': ('.tar.zst', (3, 9, 19)),
+    'xz': ('.tar.xz', (1, 6, 9)),
+    'gzip': ('.tar.gz', (1, 6, 9)),
+}
+
+
+def benchmark(payloads, codecs=None, threads=None, sevenzip=None):
+    """
+    Compare the compression ratio and throughput of the codecs on representative payloads.
+
+    Args:
+        payloads (dict): A dictionary of payload names to the file or directory to compress.
+        codecs (list): The codecs to compare, every codec in BENCHMARK_CODECS by default.
+        threads (int): The number of compression threads, None lets each codec use every CPU.
+        sevenzip (SevenZip): The SevenZip instance to benchmark, a new one by default.
+
+    Returns:
+        list: One dictionary per payload, codec and level with the last_stats of the run, or the error.
+    """
+    sevenzip = sevenzip or SevenZip()
+    results = []
+    with tempfile.TemporaryDirectory(prefix='sevenzip-bench-') as workdir:
+        for name, path in payloads.items():
+            for codec in codecs or BENCHMARK_CODECS:
+                suffix, levels = BENCHMARK_CODECS[codec]
+                for level in levels:
+                    destination = os.path.join(workdir, f'{name}-{codec}-{level}{suffix}')
+                    if sevenzip.compress(path, destination, codec=codec, level=level, threads=threads):
+                        results.append({'payload': name, **sevenzip.last_stats})
+                    else:
+                        results.append({'payload': name, 'codec': codec, 'level': level, 'error': sevenzip.last_error})
+                    for output in [destination] + _volumes(destination):
+                        if os.path.exists(output):
+                            os.remove(output)
+    return results
+
+
+def _sample_payloads(workdir):
+    """
+    Create payloads resembling a log directory and a theme archive for benchmark().
+
+    Args:
+        workdir (str): The directory to create the payloads in.
+
+    Returns:
+        dict: A dictionary of payload names to their paths.
+    """
+    logs = os.path.join(workdir, 'log')
+    os.makedirs(logs)
+    for index in range(4):
+        with open(os.path.join(logs, f'component{index}.log'), 'w') as f:
+            for line in range(50000):
+                f.write(f'2024-04-28 12:{line // 3600 % 60:02d}:{line // 60 % 60:02d},{line % 1000:03d} - ThinAgent - '
+                        f'{"DEBUG" if line % 5 else "INFO"} - Routing: {{"message": "system_info?", "seq": {line}}}\n')
+    theme = os.path.join(workdir, 'theme')
+    os.makedirs(theme)
+    for index in range(8):
+        with open(os.path.join(theme, f'frame{index}.png'), 'wb') as f:
+            f.write(os.urandom(256 * 1024))  # Images are already compressed
+    with open(os.path.join(theme, 'thintrust.script'), 'w') as f:
+        f.write('Window.SetBackgroundTopColor(0.0, 0.0, 0.0);\n' * 2000)
+    return {'logs': logs, 'theme': theme}
+
+
+if __name__ == '__main__':
+    import sys
+    with tempfile.TemporaryDirectory(prefix='sevenzip-payloads-') as workdir:
+        payloads = {os.path.basename(os.path.normpath(path)): path for path in sys.argv[1:]} or _sample_payloads(workdir)
+        print(f"{'payload':<12}{'codec':<8}{'level':>6}{'input MB':>11}{'ratio':>8}{'MB/s':>9}")
+        for result in benchmark(payloads):
+            if 'error' in result:
+                print(f"{result['payload']:<12}{result['codec']:<8}{result['level']:>6}  {result['error']}")
+            else:
+                print(f"{result['payload']:<12}{result['codec']:<8}{result['level']:>6}"
+                      f"{result['input_bytes'] / 1024 ** 2:>11.2f}{result['ratio']:>8.3f}{result['mb_per_s']:>9.2f}")
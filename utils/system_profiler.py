@@ -1,22 +1,28 @@
 import subprocess
 import socket
 
+from utils.metrics import MetricsRegistry
+
+COLLECTOR_SECONDS = MetricsRegistry().histogram('thintrust_profiler_collector_seconds',
+                                                'Duration of the system profiler collectors.')
+
 
 class SystemProfiler:
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, collect=True):
         self.logger = logger
-        self.system_profile = self.system_profile()
+        if collect:
+            # Without collect, only the collectors are used, to refresh parts of a profile
+            self.system_profile = self.system_profile()
         
     def system_profile(self):
         self.logger.debug('Collecting system profile...')
         profile = {}
         profile['hostname'] = socket.gethostname()
-        profile['cpu'] = self.get_cpu_info()
-        profile['bios'] = self.get_bios_info()
-        profile['memory'] = self.get_system_memory()
-        profile['disks'] = self.get_disks()
-        profile['ips'] = self.get_ips()
-        profile['mac'] = self.get_mac_address()
+        for key, collector in (('cpu', self.get_cpu_info), ('bios', self.get_bios_info),
+                               ('memory', self.get_system_memory), ('disks', self.get_disks), ('ips', self.get_ips),
+                               ('mac', self.get_mac_address)):
+            with COLLECTOR_SECONDS.time(collector=collector.__name__):
+                profile[key] = collector()
         return profile
         
     def get_bios_info(self):
@@ -105,7 +111,7 @@ class SystemProfiler:
         try:
             for interface in psutil.net_if_addrs():
                 for address in psutil.net_if_addrs()[interface]:
-                    if address.family == socket.AF_LINK and not address.address == '00:00:00:00:00:00' and interface.startswith(('eth', 'enp', 'eno', 'ens', 'en')):
+                    if address.family == psutil.AF_LINK and not address.address == '00:00:00:00:00:00' and interface.startswith(('eth', 'enp', 'eno', 'ens', 'en')):
                         return address.address
         except Exception as e:
             self.logger.error(f'Error getting MAC address: {e}')
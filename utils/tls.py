@@ -0,0 +1,211 @@
+import ipaddress
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+
+# Sessions kept by a client context, the oldest are dropped first, about 1 KiB each
+MAX_SESSIONS = 100000
+
+
+class LocalCA:
+    """
+    A private certificate authority for the agents and the TEC server, managed with the openssl command.
+
+    The CA signs a certificate for the TEC server and one for each agent, so both ends can verify each other without a
+    public CA. Keys are ECDSA P-256, whose signatures are much cheaper than RSA ones during handshakes.
+
+    Example:
+        ca = LocalCA(logger, '/etc/thintrust/tls')
+        ca.create()
+        cert, key = ca.issue('thinclient-00042', ['10.0.3.42', 'thinclient-00042'])
+
+    Attributes:
+        logger (logging.Logger): The logger used to report errors.
+        directory (str): The directory holding the CA and the certificates it issued.
+        cert (str): The path of the CA certificate, given to load_verify_locations.
+        key (str): The path of the CA private key.
+
+    Methods:
+        create(days: int) -> bool: Creates the CA, unless it exists.
+        issue(name: str, hosts: list, days: int) -> tuple: Issues a certificate.
+    """
+
+    def __init__(self, logger, directory):
+        self.logger = logger
+        self.directory = directory
+        self.cert = os.path.join(directory, 'ca.pem')
+        self.key = os.path.join(directory, 'ca.key')
+
+    def _openssl(self, *args):
+        if shutil.which('openssl') is None:
+            self.logger.error('The openssl command is not installed.')
+            return False
+        result = subprocess.run(['openssl', *args], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            self.logger.error(f"openssl {args[0]} failed: {result.stderr.decode('utf-8', errors='replace').strip()}")
+            return False
+        return True
+
+    def create(self, days=3650):
+        """
+        Create the CA key and self-signed certificate, unless they exist.
+
+        Args:
+            days (int): The validity of the CA certificate. The default value is 3650.
+
+        Returns:
+            bool: True if the CA exists or was created.
+        """
+        if os.path.exists(self.cert) and os.path.exists(self.key):
+            return True
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        if not self._openssl('req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+                             '-keyout', self.key, '-out', self.cert, '-days', str(days), '-subj', '/CN=ThinTrust Local CA',
+                             '-addext', 'basicConstraints=critical,CA:TRUE', '-addext', 'keyUsage=critical,keyCertSign'):
+            return False
+        os.chmod(self.key, 0o600)
+        self.logger.info(f'Created the local CA in {self.directory}')
+        return True
+
+    def issue(self, name, hosts, days=825):
+        """
+        Issue a certificate valid for both server and client authentication.
+
+        Args:
+            name (str): The common name of the certificate, also the name of its files.
+            hosts (list): The IP addresses and host names the certificate is valid for.
+            days (int): The validity of the certificate. The default value is 825.
+
+        Returns:
+            tuple: The paths of the certificate and its private key, or None if the certificate could not be issued.
+        """
+        cert = os.path.join(self.directory, f'{name}.pem')
+        key = os.path.join(self.directory, f'{name}.key')
+        names = ','.join(f'IP:{host}' if _is_ip(host) else f'DNS:{host}' for host in hosts)
+        with tempfile.TemporaryDirectory(prefix='thintrust-tls-') as workdir:
+            request = os.path.join(workdir, 'request.csr')
+            extensions = os.path.join(workdir, 'extensions.cnf')
+            with open(extensions, 'w') as f:
+                f.write(f'subjectAltName={names}\nbasicConstraints=CA:FALSE\nkeyUsage=critical,digitalSignature\n'
+                        'extendedKeyUsage=serverAuth,clientAuth\n')
+            if not self._openssl('req', '-new', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+                                 '-keyout', key, '-out', request, '-subj', f'/CN={name}'):
+                return None
+            os.chmod(key, 0o600)
+            if not self._openssl('x509', '-req', '-in', request, '-CA', self.cert, '-CAkey', self.key,
+                                 '-CAcreateserial', '-out', cert, '-days', str(days), '-extfile', extensions):
+                return None
+        return cert, key
+
+
+def _is_ip(host):
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+class ResumingClientContext(ssl.SSLContext):
+    """
+    A client SSLContext that resumes the last TLS session of each host.
+
+    A full handshake costs an ECDHE key exchange and a certificate verification on both ends, a resumed one only the
+    key exchange. Python offers a session only when it is passed to wrap_socket or wrap_bio, which asyncio never does,
+    so this context offers the session remembered for the host itself, for every connection, including the ones
+    websockets and asyncio make. Sessions are remembered with remember() once the connection has received data, as
+    TLS 1.3 servers send their session tickets after the handshake.
+
+    Attributes:
+        sessions (dict): The last session of each host.
+        max_sessions (int): The number of sessions kept. The default value is MAX_SESSIONS.
+
+    Methods:
+        remember(hostname: str, ssl_object: ssl.SSLObject) -> bool: Keeps the session of a connection.
+        forget(hostname: str): Drops the session of a host.
+    """
+
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT):
+        self.sessions = {}
+        self.max_sessions = MAX_SESSIONS
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    def wrap_socket(self, sock, server_side=False, do_handshake_on_connect=True, suppress_ragged_eofs=True,
+                    server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_socket(sock, server_side, do_handshake_on_connect, suppress_ragged_eofs, server_hostname,
+                                   session)
+
+    def remember(self, hostname, ssl_object):
+        """
+        Keep the session of a connection, to resume it on the next connection to the same host.
+
+        Args:
+            hostname (str): The host name or IP address the connection was made to.
+            ssl_object (ssl.SSLObject): The TLS object of the connection, from get_extra_info('ssl_object').
+
+        Returns:
+            bool: True if the session can be resumed and was kept.
+        """
+        session = ssl_object.session if ssl_object is not None else None
+        if session is None or not session.has_ticket:
+            return False
+        self.sessions.pop(hostname, None)  # Move the host to the end, the most recently used
+        self.sessions[hostname] = session
+        if len(self.sessions) > self.max_sessions:
+            del self.sessions[next(iter(self.sessions))]
+        return True
+
+    def forget(self, hostname):
+        self.sessions.pop(hostname, None)
+
+
+def server_context(cert, key, ca=None):
+    """
+    Create the TLS context of the agent, or of any end accepting connections.
+
+    Args:
+        cert (str): The path of the certificate.
+        key (str): The path of the private key.
+        ca (str): The path of the CA certificate the clients must present a certificate of. The default value is None,
+            clients are not authenticated.
+
+    Returns:
+        ssl.SSLContext: The context, issuing session tickets so clients can resume their sessions.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert, key)
+    # Clients keep one session per host, a second TLS 1.3 ticket per handshake would only cost an encryption
+    context.num_tickets = 1
+    if ca:
+        context.load_verify_locations(ca)
+        context.verify_mode = ssl.CERT_REQUIRED
+    return context
+
+
+def client_context(ca, cert=None, key=None):
+    """
+    Create the TLS context of the TEC server, or of any end making connections.
+
+    Args:
+        ca (str): The path of the CA certificate the servers' certificates are verified with.
+        cert (str): The path of the client certificate, for servers authenticating their clients.
+        key (str): The path of the private key of the client certificate.
+
+    Returns:
+        ResumingClientContext: The context, resuming the session of each host.
+    """
+    context = ResumingClientContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_verify_locations(ca)
+    if cert:
+        context.load_cert_chain(cert, key)
+    return context
@@ -0,0 +1,132 @@
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory, ServerPerMessageDeflateFactory
+
+# Each option, its default value and the type it is converted to when read from settings stored as strings
+CHANNEL_OPTIONS = {
+    'compression': (True, bool),
+    'window_bits': (12, int),
+    'mem_level': (5, int),
+    'compress_level': (6, int),
+    'max_size': (4 * 1024 * 1024, int),
+    'max_queue': (16, int),
+    'write_limit': (64 * 1024, int),
+    'write_limit_low': (16 * 1024, int),
+    'ping_interval': (20.0, float),
+    'ping_timeout': (20.0, float),
+    'idle_timeout': (180.0, float),
+}
+
+
+class ChannelOptions:
+    """
+    The settings of the websocket channel between the agents and the TEC server.
+
+    Both ends build their websockets arguments from the same options, so the compression parameters they negotiate
+    and the limits they enforce match. The options are read from the agent settings and the TEC server config under
+    the same names, prefixed with 'ws_', such as 'ws_window_bits'.
+
+    Compression is permessage-deflate with context takeover, so the JSON keys repeated in every message are only sent
+    once per connection. Its memory cost per connection is about 2 ** (window_bits + 2) + 2 ** (mem_level + 9) bytes to
+    compress and 2 ** window_bits bytes to decompress, 32 KiB and 4 KiB with the defaults instead of the 256 KiB and
+    32 KiB of zlib's defaults, which matters with thousands of connections on the server. Run
+    'python -m bench.run wsdeflate' to measure the bytes saved and the CPU spent with other values.
+
+    Example:
+        options = ChannelOptions.from_settings(self.config)
+        websockets.serve(handler, host, port, **options.server_kwargs())
+
+    Attributes:
+        compression (bool): Whether permessage-deflate is offered. The default value is True.
+        window_bits (int): The deflate window size, as a power of 2 from 9 to 15. The default value is 12.
+        mem_level (int): The deflate memory level, from 1 to 9. The default value is 5.
+        compress_level (int): The deflate compression level, from 0 to 9. The default value is 6.
+        max_size (int): The largest message accepted, in bytes. The default value is 4 MiB, enough for the largest
+            log batch.
+        max_queue (int): The number of received messages buffered before reading from the socket stops. The default
+            value is 16.
+        write_limit (int): The size of the write buffer above which sending waits for it to drain, the high water
+            mark. The default value is 64 KiB.
+        write_limit_low (int): The size the write buffer must drain to before sending resumes, the low water mark. The
+            default value is 16 KiB.
+        ping_interval (float): The time in seconds between keepalive pings, None to disable them. The default value
+            is 20.
+        ping_timeout (float): The time in seconds to wait for a pong before closing the connection, None to wait
+            forever. The default value is 20.
+        idle_timeout (float): The time in seconds the agent waits for the next message before closing the connection.
+            It must be longer than the poll_interval of the TEC server for it to keep connections open between polls.
+            The default value is 180, three times the default poll_interval.
+
+    Methods:
+        from_settings(settings: dict, prefix: str) -> ChannelOptions: Reads the options from settings.
+        server_kwargs() -> dict: Gets the arguments of websockets.serve.
+        client_kwargs() -> dict: Gets the arguments of websockets.connect.
+    """
+
+    def __init__(self, **options):
+        unknown = options.keys() - CHANNEL_OPTIONS.keys()
+        if unknown:
+            raise TypeError(f'Unknown channel options: {", ".join(sorted(unknown))}')
+        for name, (default, _) in CHANNEL_OPTIONS.items():
+            setattr(self, name, options.get(name, default))
+        if not 9 <= self.window_bits <= 15:
+            raise ValueError(f'window_bits must be between 9 and 15, not {self.window_bits}')
+        if not 1 <= self.mem_level <= 9:
+            raise ValueError(f'mem_level must be between 1 and 9, not {self.mem_level}')
+
+    @classmethod
+    def from_settings(cls, settings, prefix='ws_'):
+        """
+        Read the options from settings, such as the agent settings or the TEC server config.
+
+        Args:
+            settings (dict): The settings. Values may be strings, as the agent stores them, and 'none' disables the
+                pings.
+            prefix (str): The prefix of the option names in the settings. The default value is 'ws_'.
+
+        Returns:
+            ChannelOptions: The options, with the default value of every option missing from the settings.
+        """
+        options = {}
+        for name, (_, kind) in CHANNEL_OPTIONS.items():
+            value = settings.get(prefix + name)
+            if isinstance(value, str):
+                if value.lower() in ('none', 'null', ''):
+                    value = None
+                elif kind is bool:
+                    value = value.lower() in ('1', 'true', 'yes', 'on')
+                else:
+                    value = kind(value)
+            if value is not None or name.startswith('ping_') and prefix + name in settings:
+                options[name] = value
+        return cls(**options)
+
+    def _compress_settings(self):
+        return {'memLevel': self.mem_level, 'level': self.compress_level}
+
+    def _common_kwargs(self):
+        return {
+            'max_size': self.max_size,
+            'max_queue': self.max_queue,
+            'write_limit': (self.write_limit, self.write_limit_low),
+            'ping_interval': self.ping_interval,
+            'ping_timeout': self.ping_timeout,
+            'compression': None,  # The extension below replaces the default deflate settings of websockets
+        }
+
+    def server_kwargs(self):
+        kwargs = self._common_kwargs()
+        if self.compression:
+            kwargs['extensions'] = [ServerPerMessageDeflateFactory(
+                server_max_window_bits=self.window_bits, client_max_window_bits=self.window_bits,
+                compress_settings=self._compress_settings())]
+        return kwargs
+
+    def client_kwargs(self):
+        kwargs = self._common_kwargs()
+        if self.compression:
+            kwargs['extensions'] = [ClientPerMessageDeflateFactory(
+                server_max_window_bits=self.window_bits, client_max_window_bits=self.window_bits,
+                compress_settings=self._compress_settings())]
+        return kwargs
+
+    def __repr__(self):
+        return 'ChannelOptions(' + ', '.join(f'{name}={getattr(self, name)!r}' for name in CHANNEL_OPTIONS) + ')'